@@ -0,0 +1,372 @@
+"""
+    Minimal non-blocking SNMP (v1 / v2c) client, built on asyncio.
+
+    All the requests are sent through a single UDP socket (`SNMPEngine`) and the responses are
+    matched to the requests by their request-id, so thousands of requests can be in flight at the
+    same time without using any threads. SNMPv3 is not supported (the jobs which need it should
+    fall back to easysnmp).
+"""
+import asyncio
+from collections import namedtuple
+import logging
+import random
+import socket
+
+
+log = logging.getLogger("{}.{}".format(__name__, "asyncsnmp"))
+
+
+class SNMPError(Exception):
+    pass
+
+
+class SNMPTimeoutError(SNMPError):
+    pass
+
+
+class SNMPTooBigError(SNMPError):
+    pass
+
+
+class SNMPDecodeError(SNMPError):
+    pass
+
+
+VarBind = namedtuple('VarBind', ['oid', 'snmp_type', 'value'])
+Message = namedtuple('Message', ['version', 'community', 'pdu_type', 'request_id', 'error_status', 'error_index', 'varbinds'])
+
+SNMP_VERSION_1 = 0
+SNMP_VERSION_2C = 1
+
+PDU_GET = 0xA0
+PDU_GETNEXT = 0xA1
+PDU_RESPONSE = 0xA2
+PDU_GETBULK = 0xA5
+
+ERROR_TOO_BIG = 1
+ERROR_NO_SUCH_NAME = 2
+
+# BER tags of the values, mapped to the type names which are used by easysnmp:
+TAG_INTEGER = 0x02
+TAG_OCTET_STRING = 0x04
+TAG_NULL = 0x05
+TAG_OID = 0x06
+TAG_SEQUENCE = 0x30
+VALUE_TYPES = {
+    TAG_INTEGER: 'INTEGER',
+    TAG_OCTET_STRING: 'OCTETSTR',
+    TAG_NULL: 'NULL',
+    TAG_OID: 'OBJECTID',
+    0x40: 'IPADDR',
+    0x41: 'COUNTER',
+    0x42: 'GAUGE',
+    0x43: 'TICKS',
+    0x44: 'OPAQUE',
+    0x46: 'COUNTER64',
+    0x80: 'NOSUCHOBJECT',
+    0x81: 'NOSUCHINSTANCE',
+    0x82: 'ENDOFMIBVIEW',
+}
+VALUE_TAGS = {snmp_type: tag for tag, snmp_type in VALUE_TYPES.items()}
+UNSIGNED_TYPES = ['COUNTER', 'GAUGE', 'TICKS', 'COUNTER64']
+NO_VALUE_TYPES = ['NULL', 'NOSUCHOBJECT', 'NOSUCHINSTANCE', 'ENDOFMIBVIEW']
+
+
+###########################
+#   BER encoding          #
+###########################
+
+def _encode_length(length):
+    if length < 0x80:
+        return bytes([length])
+    length_bytes = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([0x80 | len(length_bytes)]) + length_bytes
+
+
+def _encode_tlv(tag, content):
+    return bytes([tag]) + _encode_length(len(content)) + content
+
+
+def _encode_integer(tag, value, signed=True):
+    return _encode_tlv(tag, value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=signed))
+
+
+def _encode_oid(oid):
+    parts = [int(x) for x in oid.strip('.').split('.')]
+    if len(parts) < 2:
+        raise SNMPError(f"Invalid OID: {oid}")
+    content = bytearray([parts[0] * 40 + parts[1]])
+    for part in parts[2:]:
+        chunk = [part & 0x7F]
+        part >>= 7
+        while part:
+            chunk.append(0x80 | (part & 0x7F))
+            part >>= 7
+        content.extend(reversed(chunk))
+    return _encode_tlv(TAG_OID, bytes(content))
+
+
+def _encode_value(snmp_type, value):
+    tag = VALUE_TAGS[snmp_type]
+    if snmp_type in NO_VALUE_TYPES:
+        return _encode_tlv(tag, b'')
+    if snmp_type == 'INTEGER':
+        return _encode_integer(tag, int(value))
+    if snmp_type in UNSIGNED_TYPES:
+        return _encode_integer(tag, int(value), signed=False)
+    if snmp_type == 'OBJECTID':
+        return _encode_oid(value)
+    if snmp_type == 'IPADDR':
+        return _encode_tlv(tag, socket.inet_aton(value))
+    return _encode_tlv(tag, value.encode('utf-8') if isinstance(value, str) else bytes(value))
+
+
+def encode_message(version, community, pdu_type, request_id, error_status, error_index, varbinds):
+    """
+        Encodes a SNMP message. Note that with GETBULK requests, non-repeaters and max-repetitions
+        take the places of error status and error index. Varbinds are a list of `VarBind`s (or
+        (oid, snmp_type, value) tuples); requests should use 'NULL' as snmp_type.
+    """
+    encoded_varbinds = b''.join([_encode_tlv(TAG_SEQUENCE, _encode_oid(oid) + _encode_value(snmp_type, value)) for oid, snmp_type, value in varbinds])
+    pdu = _encode_tlv(pdu_type,
+        _encode_integer(TAG_INTEGER, request_id) +
+        _encode_integer(TAG_INTEGER, error_status) +
+        _encode_integer(TAG_INTEGER, error_index) +
+        _encode_tlv(TAG_SEQUENCE, encoded_varbinds)
+    )
+    return _encode_tlv(TAG_SEQUENCE,
+        _encode_integer(TAG_INTEGER, version) +
+        _encode_tlv(TAG_OCTET_STRING, community.encode('utf-8')) +
+        pdu
+    )
+
+
+###########################
+#   BER decoding          #
+###########################
+
+def _decode_tlv(data, offset):
+    try:
+        tag = data[offset]
+        length = data[offset + 1]
+        offset += 2
+        if length & 0x80:
+            n = length & 0x7F
+            length = int.from_bytes(data[offset:offset + n], 'big')
+            offset += n
+    except IndexError:
+        raise SNMPDecodeError("Truncated message")
+    if offset + length > len(data):
+        raise SNMPDecodeError("Truncated message")
+    return tag, data[offset:offset + length], offset + length
+
+
+def _decode_items(content):
+    items = []
+    offset = 0
+    while offset < len(content):
+        tag, value, offset = _decode_tlv(content, offset)
+        items.append((tag, value))
+    return items
+
+
+def _decode_oid(content):
+    if not content:
+        raise SNMPDecodeError("Empty OID")
+    first = content[0]
+    parts = [min(first // 40, 2), first - 40 * min(first // 40, 2)]
+    n = 0
+    for b in content[1:]:
+        n = (n << 7) | (b & 0x7F)
+        if not b & 0x80:
+            parts.append(n)
+            n = 0
+    return '.'.join([str(x) for x in parts])
+
+
+def _decode_value(tag, content):
+    snmp_type = VALUE_TYPES.get(tag)
+    if snmp_type is None:
+        raise SNMPDecodeError(f"Unknown value type: {tag}")
+    if snmp_type in NO_VALUE_TYPES:
+        return snmp_type, None
+    if snmp_type == 'INTEGER':
+        return snmp_type, str(int.from_bytes(content, 'big', signed=True))
+    if snmp_type in UNSIGNED_TYPES:
+        return snmp_type, str(int.from_bytes(content, 'big', signed=False))
+    if snmp_type == 'OBJECTID':
+        return snmp_type, '.' + _decode_oid(content)
+    if snmp_type == 'IPADDR':
+        return snmp_type, '.'.join([str(x) for x in content])
+    return snmp_type, content.decode('utf-8', errors='replace')
+
+
+def decode_message(data):
+    """
+        Decodes a SNMP message (request or response) into `Message`. OIDs of the varbinds are
+        returned without the leading dot.
+    """
+    tag, content, _ = _decode_tlv(data, 0)
+    if tag != TAG_SEQUENCE:
+        raise SNMPDecodeError(f"Unexpected tag: {tag}")
+    try:
+        (_, version), (_, community), (pdu_type, pdu) = _decode_items(content)
+        (_, request_id), (_, error_status), (_, error_index), (_, varbinds_content) = _decode_items(pdu)
+        varbinds = []
+        offset = 0
+        while offset < len(varbinds_content):
+            _, varbind, offset = _decode_tlv(varbinds_content, offset)
+            _, oid_content, value_offset = _decode_tlv(varbind, 0)
+            value_tag, value_content, _ = _decode_tlv(varbind, value_offset)
+            snmp_type, value = _decode_value(value_tag, value_content)
+            varbinds.append(VarBind(_decode_oid(oid_content), snmp_type, value))
+    except ValueError:
+        raise SNMPDecodeError("Unexpected message structure")
+    return Message(
+        int.from_bytes(version, 'big'),
+        community.decode('utf-8', errors='replace'),
+        pdu_type,
+        int.from_bytes(request_id, 'big', signed=True),
+        int.from_bytes(error_status, 'big'),
+        int.from_bytes(error_index, 'big'),
+        varbinds,
+    )
+
+
+def _oid_tuple(oid):
+    return tuple([int(x) for x in oid.strip('.').split('.')])
+
+
+###########################
+#   Engine and client     #
+###########################
+
+class SNMPEngine(asyncio.DatagramProtocol):
+    """
+        Sends requests through a single UDP socket and dispatches the responses to the waiting
+        requests by request-id.
+    """
+    def __init__(self):
+        self.transport = None
+        self.pending = {}  # request_id -> (addr, future)
+        self.next_request_id = random.randint(1, 2**30)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            message = decode_message(data)
+        except SNMPDecodeError:
+            log.debug(f"Ignoring invalid SNMP message from {addr[0]}")
+            return
+        expected_addr, future = self.pending.get(message.request_id, (None, None))
+        # ignore responses to requests which have already timed out or answered, and spoofed ones:
+        if future is None or future.done() or expected_addr != addr[:2]:
+            return
+        future.set_result(message)
+
+    def _new_request_id(self):
+        self.next_request_id = self.next_request_id % (2**31 - 1) + 1
+        return self.next_request_id
+
+    async def request(self, host, port, version, community, pdu_type, oids, timeout, retries, non_repeaters=0, max_repetitions=0):
+        request_id = self._new_request_id()
+        data = encode_message(version, community, pdu_type, request_id, non_repeaters, max_repetitions, [(oid, 'NULL', None) for oid in oids])
+        addr = (host, port)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = (addr, future)
+        try:
+            for _ in range(retries + 1):
+                self.transport.sendto(data, addr)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), timeout)
+                except asyncio.TimeoutError:
+                    continue
+            raise SNMPTimeoutError(f"Timeout while waiting for response from {host}")
+        finally:
+            del self.pending[request_id]
+
+
+async def create_engine(receive_buffer_size=4 * 1024 * 1024):
+    loop = asyncio.get_event_loop()
+    transport, engine = await loop.create_datagram_endpoint(SNMPEngine, local_addr=('0.0.0.0', 0))
+    try:
+        transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+    except OSError:
+        log.warning("Could not increase the size of SNMP socket receive buffer")
+    return engine
+
+
+class SNMPClient(object):
+    def __init__(self, engine, host, community, version=SNMP_VERSION_2C, port=161, timeout=1, retries=3):
+        self.engine = engine
+        self.host = host
+        self.community = community
+        self.version = version
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+
+    async def _request(self, pdu_type, oids, non_repeaters=0, max_repetitions=0):
+        return await self.engine.request(self.host, self.port, self.version, self.community, pdu_type, oids,
+                                         self.timeout, self.retries, non_repeaters, max_repetitions)
+
+    async def get(self, oids):
+        """
+            Returns a list of `VarBind`s, in the same order as requested OIDs. Missing values have
+            snmp_type set to NOSUCHOBJECT or NOSUCHINSTANCE (and value to None).
+        """
+        results = {}
+        remaining = [oid.strip('.') for oid in oids]
+        while remaining:
+            response = await self._request(PDU_GET, remaining)
+            if response.error_status == ERROR_TOO_BIG:
+                raise SNMPTooBigError(f"Response to GET with {len(remaining)} OIDs is too big")
+            if response.error_status == ERROR_NO_SUCH_NAME and 0 < response.error_index <= len(remaining):
+                # SNMPv1 - remove the OID that doesn't exist and resend the request:
+                missing_oid = remaining.pop(response.error_index - 1)
+                results[missing_oid] = VarBind(missing_oid, 'NOSUCHOBJECT', None)
+                continue
+            if response.error_status:
+                raise SNMPError(f"GET request failed with error status {response.error_status}")
+            for oid, varbind in zip(remaining, response.varbinds):
+                results[oid] = varbind
+            break
+        return [results.get(oid.strip('.'), VarBind(oid.strip('.'), 'NOSUCHOBJECT', None)) for oid in oids]
+
+    async def walk(self, oid, max_repetitions=0, max_rows=None):
+        """
+            Returns a list of `VarBind`s in the subtree of the OID. Uses GETBULK if max_repetitions is
+            set (SNMPv2c only), otherwise GETNEXT. If `max_rows` is set, walk stops after
+            `max_rows + 1` rows (so that the caller can tell that the limit was exceeded).
+        """
+        root = _oid_tuple(oid)
+        current_oid = oid.strip('.')
+        current = root
+        use_bulk = self.version != SNMP_VERSION_1 and max_repetitions > 0
+        results = []
+        while True:
+            if max_rows is not None and len(results) > max_rows:
+                return results
+            if use_bulk:
+                # no need to fetch (many) more rows than we will use:
+                repetitions = max_repetitions if max_rows is None else max(1, min(max_repetitions, max_rows + 1 - len(results)))
+                response = await self._request(PDU_GETBULK, [current_oid], 0, repetitions)
+            else:
+                response = await self._request(PDU_GETNEXT, [current_oid])
+            if response.error_status == ERROR_NO_SUCH_NAME:
+                return results  # SNMPv1 end of MIB view
+            if response.error_status:
+                raise SNMPError(f"Walk request failed with error status {response.error_status}")
+            if not response.varbinds:
+                return results
+            for varbind in response.varbinds:
+                if varbind.snmp_type == 'ENDOFMIBVIEW':
+                    return results
+                varbind_oid = _oid_tuple(varbind.oid)
+                # stop when we leave the subtree, or if agent is returning OIDs out of order (to avoid loops):
+                if varbind_oid[:len(root)] != root or varbind_oid <= current:
+                    return results
+                results.append(varbind)
+                current, current_oid = varbind_oid, varbind.oid
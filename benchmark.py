@@ -0,0 +1,431 @@
+import argparse
+import asyncio
+import bisect
+import concurrent.futures
+import gzip
+import http.server
+import json
+import logging
+import multiprocessing
+import random
+import re
+import resource
+import socketserver
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+import asyncsnmp
+from dbutils import migrate_if_needed, db_disconnect
+import snmpbot
+from snmpbot import SNMPBot
+
+
+log = logging.getLogger("{}.{}".format(__name__, "benchmark"))
+
+
+# Offline benchmark: polls simulated SNMP devices (a single UDP agent, devices are distinguished by
+# community) and sends the values to a stand-in for Grafolean API, both running in a separate
+# process so that their CPU usage is not attributed to the bot. Jobs are run back to back (without
+# waiting for their intervals), using the same code paths as the bot. Needs a (scratch) database,
+# configured the same way as for the bot.
+
+
+ACCOUNT_ID = 1
+FIRST_DEVICE_ID = 1000
+BOT_TOKEN = 'benchmark'
+
+OID_SYS_UPTIME = (1, 3, 6, 1, 2, 1, 1, 3, 0)
+OID_IF_NUMBER = (1, 3, 6, 1, 2, 1, 2, 1, 0)
+OID_IF_ENTRY = (1, 3, 6, 1, 2, 1, 2, 2, 1)
+OID_IF_TABLE_LAST_CHANGE = (1, 3, 6, 1, 2, 1, 31, 1, 5, 0)
+IF_INDEX, IF_DESCR, IF_SPEED, IF_OPER_STATUS, IF_IN_OCTETS, IF_OUT_OCTETS = 1, 2, 5, 8, 10, 16
+
+# sensors which are polled on every device:
+SENSORS = {
+    1: {"oids": [{"oid": "1.3.6.1.2.1.1.3.0", "fetch_method": "get"}], "expression": "$1 / 100", "output_path": "uptime"},
+    2: {"oids": [{"oid": "1.3.6.1.2.1.2.2.1.10", "fetch_method": "walk"}, {"oid": "1.3.6.1.2.1.2.2.1.16", "fetch_method": "walk"}], "expression": "($1 + $2) * 8", "output_path": "if.{$index}.bps"},
+    3: {"oids": [{"oid": "1.3.6.1.2.1.2.2.1.8", "fetch_method": "walk"}], "expression": "$1", "output_path": "if.{$index}.status"},
+}
+SENSOR_INTERVAL = 60
+
+
+###########################
+#   Simulated agent       #
+###########################
+
+class SimulatedAgent(asyncio.DatagramProtocol):
+    """
+        SNMPv1 / SNMPv2c agent which answers GET, GETNEXT and GETBULK requests for `n_devices`
+        devices (with communities `device0`, `device1`,...), each with an interface table with
+        `n_interfaces` rows. Octet counters (32 bit, so they wrap) grow by roughly `counter_rate`
+        bytes per second. Responses are delayed by `latency` seconds, and `loss` is the fraction of
+        requests which are not answered at all.
+    """
+    def __init__(self, n_devices, n_interfaces, counter_rate=1000000, latency=0., loss=0.):
+        self.n_devices = n_devices
+        self.counter_rate = counter_rate
+        self.latency = latency
+        self.loss = loss
+        self.transport = None
+        self.start_ts = time.time()
+        self.stats = {"snmp_requests": 0, "varbinds": 0, "lost": 0}
+
+        # all devices have the same OIDs, values are calculated when requested:
+        values = {
+            OID_SYS_UPTIME: lambda device, now: ('TICKS', int((now - self.start_ts) * 100)),
+            OID_IF_NUMBER: lambda device, now: ('INTEGER', n_interfaces),
+            OID_IF_TABLE_LAST_CHANGE: lambda device, now: ('TICKS', 0),
+        }
+        for i in range(1, n_interfaces + 1):
+            values[OID_IF_ENTRY + (IF_INDEX, i)] = lambda device, now, i=i: ('INTEGER', i)
+            values[OID_IF_ENTRY + (IF_DESCR, i)] = lambda device, now, i=i: ('OCTETSTR', f'eth{i - 1}')
+            values[OID_IF_ENTRY + (IF_SPEED, i)] = lambda device, now: ('GAUGE', 1000000000)
+            values[OID_IF_ENTRY + (IF_OPER_STATUS, i)] = lambda device, now, i=i: ('INTEGER', 1 if i % 10 else 2)
+            values[OID_IF_ENTRY + (IF_IN_OCTETS, i)] = lambda device, now, i=i: ('COUNTER', self._octets(device, i, now))
+            values[OID_IF_ENTRY + (IF_OUT_OCTETS, i)] = lambda device, now, i=i: ('COUNTER', self._octets(device, i, now) // 2)
+        self.oids = sorted(values.keys())
+        self.oid_strings = ['.'.join([str(x) for x in oid]) for oid in self.oids]
+        self.values = [values[oid] for oid in self.oids]
+
+    def _octets(self, device, i, now):
+        rate = self.counter_rate * (1 + (device + i) % 10 / 10.)
+        return int(rate * (now - self.start_ts) + device * 7919 + i * 104729) % 2**32
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            request = asyncsnmp.decode_message(data)
+        except asyncsnmp.SNMPDecodeError:
+            return
+        m = re.match(r'^device([0-9]+)$', request.community)
+        if m is None or int(m.group(1)) >= self.n_devices:
+            return  # wrong community, real agents don't answer either
+        self.stats["snmp_requests"] += 1
+        if self.loss > 0 and random.random() < self.loss:
+            self.stats["lost"] += 1
+            return
+        error_status, error_index, varbinds = self._respond(int(m.group(1)), request)
+        self.stats["varbinds"] += len(varbinds)
+        response = asyncsnmp.encode_message(request.version, request.community, asyncsnmp.PDU_RESPONSE, request.request_id, error_status, error_index, varbinds)
+        if self.latency > 0:
+            asyncio.get_event_loop().call_later(self.latency, self.transport.sendto, response, addr)
+        else:
+            self.transport.sendto(response, addr)
+
+    def _respond(self, device, request):
+        """
+            Returns (error_status, error_index, varbinds).
+        """
+        now = time.time()
+        oids = [asyncsnmp._oid_tuple(varbind.oid) for varbind in request.varbinds]
+        v1 = request.version == asyncsnmp.SNMP_VERSION_1
+        if request.pdu_type == asyncsnmp.PDU_GET:
+            varbinds = []
+            for n, oid in enumerate(oids):
+                i = bisect.bisect_left(self.oids, oid)
+                if i < len(self.oids) and self.oids[i] == oid:
+                    varbinds.append((self.oid_strings[i],) + self.values[i](device, now))
+                elif v1:
+                    return asyncsnmp.ERROR_NO_SUCH_NAME, n + 1, request.varbinds
+                else:
+                    varbinds.append((request.varbinds[n].oid, 'NOSUCHOBJECT', None))
+            return 0, 0, varbinds
+
+        if request.pdu_type == asyncsnmp.PDU_GETNEXT:
+            non_repeaters, max_repetitions = len(oids), 0
+        elif request.pdu_type == asyncsnmp.PDU_GETBULK and not v1:
+            # non-repeaters and max-repetitions are sent instead of error status and error index:
+            non_repeaters, max_repetitions = min(request.error_status, len(oids)), request.error_index
+        else:
+            return asyncsnmp.ERROR_NO_SUCH_NAME if v1 else 5, 0, request.varbinds  # genErr
+        varbinds = []
+        positions = [bisect.bisect_right(self.oids, oid) for oid in oids]
+        for n, i in enumerate(positions[:non_repeaters]):
+            if i >= len(self.oids):
+                if v1:
+                    return asyncsnmp.ERROR_NO_SUCH_NAME, n + 1, request.varbinds
+                varbinds.append((request.varbinds[n].oid, 'ENDOFMIBVIEW', None))
+            else:
+                varbinds.append((self.oid_strings[i],) + self.values[i](device, now))
+        repeaters = positions[non_repeaters:]
+        for _ in range(max_repetitions if repeaters else 0):
+            for n, i in enumerate(repeaters):
+                if i >= len(self.oids):
+                    varbinds.append((request.varbinds[non_repeaters + n].oid, 'ENDOFMIBVIEW', None))
+                    continue
+                varbinds.append((self.oid_strings[i],) + self.values[i](device, now))
+                repeaters[n] = i + 1
+            if all(i >= len(self.oids) for i in repeaters):
+                break
+        return 0, 0, varbinds
+
+
+###########################
+#   Fake backend          #
+###########################
+
+class FakeBackend(object):
+    """
+        Stand-in for the parts of Grafolean API which the bot uses: configuration of devices
+        (entities, credentials and sensors), interface entities and values.
+    """
+    def __init__(self, n_devices):
+        self.devices = {FIRST_DEVICE_ID + n: n for n in range(n_devices)}  # entity id -> device number
+        self.interfaces = {}  # entity id -> entity
+        self.next_entity_id = FIRST_DEVICE_ID + n_devices
+        self.lock = threading.Lock()
+        self.stats = {"values": 0, "values_requests": 0, "entity_changes": 0, "backend_requests": 0}
+
+    def handle(self, method, path, query, body):
+        """
+            Returns (status, response).
+        """
+        with self.lock:
+            self.stats["backend_requests"] += 1
+        parts = path.strip('/').split('/')
+        if method == 'GET' and parts == ['profile']:
+            return 200, {"user_id": 1}
+        if parts[:1] != ['accounts']:
+            return 404, None
+        if method == 'GET' and len(parts) == 1:
+            return 200, {"list": [{"id": ACCOUNT_ID}]}
+        if len(parts) < 3 or parts[1] != str(ACCOUNT_ID):
+            return 404, None
+        resource_type, resource_id = parts[2], int(parts[3]) if len(parts) > 3 else None
+
+        if resource_type == 'values' and method == 'POST':
+            with self.lock:
+                self.stats["values"] += len(body)
+                self.stats["values_requests"] += 1
+            return 200, None
+        if resource_type == 'credentials' and method == 'GET' and resource_id in self.devices:
+            return 200, {"details": {"version": "snmpv2c", "snmpv12_community": f'device{self.devices[resource_id]}'}}
+        if resource_type == 'sensors' and method == 'GET' and resource_id in SENSORS:
+            return 200, {"details": SENSORS[resource_id], "default_interval": SENSOR_INTERVAL}
+        if resource_type != 'entities':
+            return 404, None
+
+        with self.lock:
+            if method == 'GET' and resource_id is None and 'parent' in query:
+                parent = int(query['parent'][0])
+                return 200, {"list": [e for e in self.interfaces.values() if e["parent"] == parent]}
+            if method == 'GET' and resource_id is None:
+                return 200, {"list": [{"id": entity_id, "entity_type": "device"} for entity_id in self.devices]}
+            if method == 'GET' and resource_id in self.devices:
+                return 200, {
+                    "id": resource_id,
+                    "name": f'device{self.devices[resource_id]}',
+                    "entity_type": "device",
+                    "details": {"ipv4": "127.0.0.1"},
+                    "protocols": {"snmp": {"bot": None, "credential": resource_id, "sensors": [{"sensor": sensor_id, "interval": None} for sensor_id in SENSORS]}},
+                }
+            self.stats["entity_changes"] += 1
+            if method == 'POST' and resource_id is None:
+                entity_id = self.next_entity_id
+                self.next_entity_id += 1
+                self.interfaces[entity_id] = {**body, "id": entity_id}
+                return 201, {"id": entity_id}
+            if method == 'PUT' and resource_id in self.interfaces:
+                self.interfaces[resource_id].update(body)
+                return 204, None
+            if method == 'DELETE' and resource_id in self.interfaces:
+                del self.interfaces[resource_id]
+                return 204, None
+        return 404, None
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def _serve_backend(backend):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive
+
+        def _handle(self):
+            url = urlparse(self.path)
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            status, response = backend.handle(self.command, url.path, parse_qs(url.query), json.loads(body.decode('utf-8')) if body else None)
+            response_body = json.dumps(response).encode('utf-8') if response is not None else b''
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response_body)))
+            self.end_headers()
+            self.wfile.write(response_body)
+
+        do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, name="fake-backend", daemon=True).start()
+    return server
+
+
+def _run_simulator(args, conn):
+    """
+        Runs the simulated agent and the fake backend. Their stats are sent through `conn` whenever
+        "stats" is received; None stops them.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    transport, agent = loop.run_until_complete(loop.create_datagram_endpoint(
+        lambda: SimulatedAgent(args.devices, args.interfaces, args.counter_rate, args.latency, args.loss),
+        local_addr=('127.0.0.1', 0)))
+    backend = FakeBackend(args.devices)
+    server = _serve_backend(backend)
+    conn.send((transport.get_extra_info('sockname')[1], server.server_address[1]))
+    while loop.run_until_complete(loop.run_in_executor(None, conn.recv)) is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        with backend.lock:
+            conn.send({**agent.stats, **backend.stats, "cpu": usage.ru_utime + usage.ru_stime})
+    server.shutdown()
+    transport.close()
+
+
+def _simulator_stats(conn):
+    conn.send("stats")
+    return conn.recv()
+
+
+###########################
+#   Benchmark             #
+###########################
+
+def _timed_job(job_func, intervals, job_data):
+    """
+        Returns (duration, CPU time, ok).
+    """
+    start, start_cpu = time.monotonic(), time.process_time()
+    try:
+        job_func(intervals, **job_data)
+        ok = True
+    except Exception:
+        log.exception(f"Job for entity {job_data['entity_id']} failed")
+        ok = False
+    return time.monotonic() - start, time.process_time() - start_cpu, ok
+
+
+def _run_rounds_pool(jobs, n_rounds):
+    """
+        Runs each job in a pool of worker processes (like the easysnmp backend does), once per round.
+        Yields (after each round) a list of (job_func, duration, CPU time, ok) tuples.
+    """
+    with concurrent.futures.ProcessPoolExecutor(snmpbot.SNMP_WORKERS) as executor:
+        for _ in range(n_rounds):
+            futures = [(job_func, executor.submit(_timed_job, job_func, intervals, job_data)) for _, intervals, job_func, job_data, _ in jobs]
+            yield [(job_func,) + future.result() for job_func, future in futures]
+
+
+def _run_rounds_async(jobs, n_rounds):
+    """
+        Same as `_run_rounds_pool()`, but runs the jobs in the event loop (like the asyncio backend
+        does). CPU time of the jobs is not known (it is all spent in this process).
+    """
+    loop = asyncio.get_event_loop()
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(snmpbot.ASYNC_WORKER_THREADS))
+    snmp_engine = loop.run_until_complete(asyncsnmp.create_engine())
+    semaphore = asyncio.Semaphore(snmpbot.ASYNC_MAX_CONCURRENT_JOBS)
+    async_job_funcs = {
+        SNMPBot.do_snmp: SNMPBot.do_snmp_async,
+        SNMPBot.update_if_entities: SNMPBot.update_if_entities_async,
+    }
+
+    async def run_job(job_func, intervals, job_data):
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                await async_job_funcs[job_func](snmp_engine, intervals, **job_data)
+                ok = True
+            except Exception:
+                log.exception(f"Job for entity {job_data['entity_id']} failed")
+                ok = False
+            return job_func, time.monotonic() - start, 0., ok
+
+    for _ in range(n_rounds):
+        yield loop.run_until_complete(asyncio.gather(*[run_job(job_func, intervals, job_data) for _, intervals, job_func, job_data, _ in jobs]))
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))] if values else 0.
+
+
+def run_benchmark(args):
+    """
+        Returns the report (a list of lines). Warm-up rounds (in which counters get their first
+        values and interface entities are created) are not measured.
+    """
+    conn, child_conn = multiprocessing.Pipe()
+    simulator = multiprocessing.Process(target=_run_simulator, args=(args, child_conn), name="simulator")
+    simulator.start()
+    try:
+        agent_port, backend_port = conn.recv()
+        snmpbot.SNMP_PORT = agent_port
+        backend_url = f'http://127.0.0.1:{backend_port}'
+
+        migrate_if_needed()
+        db_disconnect()
+        shared_state_manager = snmpbot.start_services(0, 1)
+        try:
+            bot = SNMPBot(backend_url, BOT_TOKEN, 0)
+            jobs = list(bot.jobs())
+            run_rounds = _run_rounds_async if args.backend == 'asyncio' else _run_rounds_pool
+            rounds = run_rounds(jobs, args.warmup + args.rounds)
+            for _ in range(args.warmup):
+                next(rounds)
+
+            stats_before = _simulator_stats(conn)
+            start, start_cpu = time.monotonic(), time.process_time()
+            results = [result for round_results in rounds for result in round_results]
+            duration, cpu = time.monotonic() - start, time.process_time() - start_cpu
+        finally:
+            # remaining values are sent before the stats are read:
+            snmpbot.stop_services()
+            shared_state_manager.shutdown()
+        stats = _simulator_stats(conn)
+    finally:
+        conn.send(None)
+        simulator.join()
+    stats = {k: stats[k] - stats_before[k] for k in stats}
+    # CPU time of the jobs which ran in workers, and of this process (shared state process is not included):
+    cpu += sum(job_cpu for _, _, job_cpu, _ in results)
+
+    n_polls = sum(1 for job_func, _, _, _ in results if job_func == SNMPBot.do_snmp)
+    lines = [
+        f"Backend {args.backend}: {args.devices} devices with {args.interfaces} interfaces, {args.rounds} rounds in {duration:.2f}s",
+        f"  polls/s: {n_polls / duration:.1f}, varbinds/s: {stats['varbinds'] / duration:.0f}, values/s: {stats['values'] / duration:.0f}",
+    ]
+    for job_name, job_func in [('snmp', SNMPBot.do_snmp), ('interfaces', SNMPBot.update_if_entities)]:
+        durations = [d for f, d, _, _ in results if f == job_func]
+        n_failed = sum(1 for f, _, _, ok in results if f == job_func and not ok)
+        lines.append(f"  {job_name} jobs: {len(durations)} ({n_failed} failed), latency p50 {_percentile(durations, 0.5) * 1000:.1f}ms, p99 {_percentile(durations, 0.99) * 1000:.1f}ms")
+    lines.extend([
+        f"  SNMP requests: {stats['snmp_requests']} ({stats['lost']} lost), backend requests: {stats['backend_requests']} (values: {stats['values_requests']}, entity changes: {stats['entity_changes']})",
+        f"  CPU: {cpu:.2f}s ({100 * cpu / duration:.0f}%, simulator {stats['cpu']:.2f}s), max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f}MB (child processes {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.0f}MB)",
+    ])
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Polls simulated SNMP devices and reports the throughput of the bot.")
+    parser.add_argument('--backend', choices=['easysnmp', 'asyncio'], default=snmpbot.SNMP_BACKEND, help="SNMP backend (default: SNMP_BACKEND env var)")
+    parser.add_argument('--devices', type=int, default=100, help="number of simulated devices")
+    parser.add_argument('--interfaces', type=int, default=48, help="number of interfaces of each device")
+    parser.add_argument('--rounds', type=int, default=5, help="number of times each job is run (and measured)")
+    parser.add_argument('--warmup', type=int, default=1, help="number of rounds before the measured ones")
+    parser.add_argument('--counter-rate', type=int, default=1000000, help="octet counters grow by about this many bytes per second")
+    parser.add_argument('--latency', type=float, default=0., help="delay of SNMP responses (in seconds)")
+    parser.add_argument('--loss', type=float, default=0., help="fraction of SNMP requests which are not answered")
+    parser.add_argument('--log-level', default='ERROR')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(args.log_level.upper())
+
+    for line in run_benchmark(args):
+        print(line)
@@ -0,0 +1,186 @@
+import hashlib
+import logging
+import threading
+import time
+
+from psycopg2.extras import execute_values
+
+from dbutils import get_db_cursor, DB_PREFIX, DBConnectionError
+from sharding import entity_in_shard
+
+
+log = logging.getLogger("{}.{}".format(__name__, "counterstore"))
+
+
+# stale counters are deleted from DB in batches of this size:
+PRUNE_BATCH_SIZE = 1000
+
+
+def counter_key(counter_ident):
+    """
+        Converts counter ident (entity_id/sensor_id/<positions of result>/oid/oid_index) to the
+        key used in DB: (entity_id, sensor_id, oid_hash, oid_index), where oid_hash is a 64bit
+        hash of the result positions and OID.
+    """
+    entity_id, sensor_id, rest = counter_ident.split('/', 2)
+    path, oid_index = rest.rsplit('/', 1)
+    return int(entity_id), int(sensor_id), _oid_hash(path), oid_index
+
+
+def _oid_hash(path):
+    return int.from_bytes(hashlib.blake2b(path.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+def prune_counters(ttl):
+    """
+        Deletes the counters which were not updated in the last `ttl` seconds (because the
+        sensor, interface,... no longer exists). Small batches are used so that the table is
+        never locked for long. Returns the number of deleted counters.
+    """
+    n_deleted = 0
+    while True:
+        with get_db_cursor() as c:
+            c.execute(f'DELETE FROM {DB_PREFIX}bot_counters WHERE ctid = ANY(ARRAY('
+                      f'  SELECT ctid FROM {DB_PREFIX}bot_counters WHERE ts < %s LIMIT %s'
+                      f'));', (time.time() - ttl, PRUNE_BATCH_SIZE))
+            n_deleted += c.rowcount
+            if c.rowcount < PRUNE_BATCH_SIZE:
+                return n_deleted
+
+
+class CounterStore(object):
+    """
+        Keeps the last known counter values in memory and only periodically persists the changes
+        to DB, which thus serves as a crash-recovery store. Counter values are grouped by counter
+        ident prefix (entity_id/sensor_id), so that all the counters of a sensor can be exchanged
+        with a single call.
+
+        Note that the instance lives in the shared state process (see `sharedstate`), which
+        serves each client connection in a separate thread - so all access to the internal state
+        must be locked.
+
+        When entities are sharded, only the counters of the entities in this shard are loaded.
+        Multiple shards can share the same table; a counter is never overwritten with an older
+        value, which could otherwise happen while an entity is moving between shards.
+
+        If `ttl` is set, counters which were not updated for this many seconds are forgotten (they
+        are deleted from DB by `CounterPruner`).
+    """
+    def __init__(self, flush_interval, shard_index=0, shard_count=1, ttl=0):
+        self.counters = {}  # counter_ident_prefix -> { (oid_hash, oid_index): (value, ts) }
+        self.dirty = set()  # counter ident prefixes with values that were not persisted yet
+        self.lock = threading.Lock()
+        self.flush_interval = flush_interval
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.ttl = ttl
+        self._warm_up()
+
+        flusher = threading.Thread(target=self._flush_periodically, name="counterstore-flusher", daemon=True)
+        flusher.start()
+
+    def _warm_up(self):
+        while True:
+            try:
+                with get_db_cursor() as c:
+                    c.execute(f'SELECT entity_id, sensor_id, oid_hash, oid_index, value, ts FROM {DB_PREFIX}bot_counters;')
+                    for entity_id, sensor_id, oid_hash, oid_index, v, t in c:
+                        if not entity_in_shard(entity_id, self.shard_index, self.shard_count):
+                            continue
+                        counter_ident_prefix = f'{entity_id}/{sensor_id}'
+                        self.counters.setdefault(counter_ident_prefix, {})[(oid_hash, oid_index)] = (int(v), float(t))
+                log.info(f"Counter store loaded {len(self.counters)} sensors' counters from DB")
+                return
+            except DBConnectionError:
+                log.info("DB connection failed - waiting for DB to become available to load counters, sleeping 5s")
+                time.sleep(5)
+
+    def exchange(self, counter_ident_prefix, new_values, now):
+        """
+            Saves new counter values and returns the previous (value, ts) pairs of the same counters.
+        """
+        keys = {counter_ident: counter_key(counter_ident)[2:] for counter_ident in new_values}
+        with self.lock:
+            sensor_counters = self.counters.setdefault(counter_ident_prefix, {})
+            previous_values = {counter_ident: sensor_counters[key] for counter_ident, key in keys.items() if key in sensor_counters}
+            for counter_ident, new_value in new_values.items():
+                sensor_counters[keys[counter_ident]] = (new_value, now)
+            self.dirty.add(counter_ident_prefix)
+        return previous_values
+
+    def retain(self, counter_ident_prefixes):
+        """
+            Evicts the counters of all the sensors which are not listed (because either the sensor or
+            its entity no longer exists).
+        """
+        counter_ident_prefixes = set(counter_ident_prefixes)
+        with self.lock:
+            for counter_ident_prefix in list(self.counters.keys()):
+                if counter_ident_prefix not in counter_ident_prefixes:
+                    del self.counters[counter_ident_prefix]
+                    self.dirty.discard(counter_ident_prefix)
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            if self.ttl:
+                self._forget_stale(dirty, time.time() - self.ttl)
+            rows = [
+                (*map(int, counter_ident_prefix.split('/')), oid_hash, oid_index, v, t)
+                for counter_ident_prefix in dirty if counter_ident_prefix in self.counters
+                for (oid_hash, oid_index), (v, t) in self.counters[counter_ident_prefix].items()
+            ]
+        if not rows:
+            return
+        try:
+            with get_db_cursor() as c:
+                execute_values(c, f"INSERT INTO {DB_PREFIX}bot_counters (entity_id, sensor_id, oid_hash, oid_index, value, ts) VALUES %s "
+                                  f"ON CONFLICT (entity_id, sensor_id, oid_hash, oid_index) DO UPDATE SET value = EXCLUDED.value, ts = EXCLUDED.ts WHERE {DB_PREFIX}bot_counters.ts <= EXCLUDED.ts;",
+                               rows, page_size=1000)
+            log.debug(f"Counter store persisted {len(rows)} counters")
+        except DBConnectionError:
+            log.warning(f"Could not persist {len(rows)} counters due to DB error, will retry")
+            with self.lock:
+                self.dirty.update(dirty)
+
+    def _forget_stale(self, counter_ident_prefixes, limit_ts):
+        """
+            Removes the counters which were not updated since `limit_ts` from memory, so that they
+            are not written to DB again (once they are pruned). Must be called with lock held.
+        """
+        for counter_ident_prefix in counter_ident_prefixes:
+            sensor_counters = self.counters.get(counter_ident_prefix, {})
+            for key in [key for key, (_, t) in sensor_counters.items() if t < limit_ts]:
+                del sensor_counters[key]
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except:
+                log.exception("Error persisting counters")
+
+
+class CounterPruner(object):
+    """
+        Every `prune_interval` seconds deletes the counters which were not updated in the last `ttl`
+        seconds from DB. Like `CounterStore`, the instance lives in the shared state process, but
+        it is used even if counters are not kept in memory (and are written to DB by the jobs).
+    """
+    def __init__(self, ttl, prune_interval=3600):
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        pruner = threading.Thread(target=self._prune_periodically, name="counter-pruner", daemon=True)
+        pruner.start()
+
+    def _prune_periodically(self):
+        while True:
+            try:
+                n_deleted = prune_counters(self.ttl)
+                log.info(f"Deleted {n_deleted} stale counters")
+            except DBConnectionError:
+                log.warning("Could not delete stale counters due to DB error, will retry")
+            except:
+                log.exception("Error deleting stale counters")
+            time.sleep(self.prune_interval)
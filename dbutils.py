@@ -5,12 +5,12 @@ import os
 import sys
 import copy
 import json
+import threading
 import time
 
 import psycopg2
-from psycopg2.pool import ThreadedConnectionPool
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, register_adapter
-from psycopg2.extras import Json
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, TRANSACTION_STATUS_IDLE, register_adapter
+from psycopg2.extras import Json, execute_values
 
 IS_DEBUG = os.environ.get('DEBUG', 'false') in ['true', 'yes', '1']
 logging.basicConfig(format='%(asctime)s.%(msecs)03d | %(levelname)s | %(message)s',
@@ -30,31 +30,142 @@ db_pool = None
 DB_PREFIX = 'snmp_'
 register_adapter(dict, Json)
 
+# connections which were idle for longer than this (in seconds) are checked before they are used:
+DB_HEALTH_CHECK_IDLE = 30
+# checkouts which take longer than this (in seconds) are logged:
+DB_SLOW_CHECKOUT = 1.
+
+
+class DBPool(object):
+    """
+        Thread-safe pool of DB connections. Unlike psycopg2's `ThreadedConnectionPool`, when all
+        `max_conn` connections are in use `getconn()` waits (at most `timeout` seconds) for one
+        of them to be returned, instead of raising `PoolError`. Connections are checked before
+        they are reused, and broken connections are replaced one by one, so that a single error
+        doesn't make all the users of the pool reconnect at once.
+    """
+    def __init__(self, min_conn, max_conn, timeout, **connect_kwargs):
+        self.timeout = timeout
+        self.connect_kwargs = connect_kwargs
+        self.semaphore = threading.BoundedSemaphore(max_conn)
+        self.idle = []  # (conn, ts) of the connections which are not in use, most recently used last
+        self.lock = threading.Lock()
+        self.stats = {"checkouts": 0, "waits": 0, "wait_time": 0., "max_wait_time": 0., "timeouts": 0, "in_use": 0, "connects": 0, "replaced": 0}
+        for _ in range(min_conn):
+            self.idle.append((self._connect(), time.monotonic()))
+
+    def getconn(self):
+        """
+            Raises `DBConnectionError` if no connection could be acquired in time, or
+            `psycopg2.OperationalError` if DB is not available.
+        """
+        start = time.monotonic()
+        if not self.semaphore.acquire(timeout=self.timeout):
+            with self.lock:
+                self.stats["timeouts"] += 1
+            raise DBConnectionError(f"No DB connection available in {self.timeout}s")
+        wait_time = time.monotonic() - start
+        try:
+            with self.lock:
+                conn, ts = self.idle.pop() if self.idle else (None, None)
+            if conn is not None and not self._is_healthy(conn, ts):
+                log.info("Replacing broken DB connection")
+                self._close(conn)
+                conn = None
+                with self.lock:
+                    self.stats["replaced"] += 1
+            if conn is None:
+                conn = self._connect()
+        except:
+            self.semaphore.release()
+            raise
+
+        with self.lock:
+            self.stats["checkouts"] += 1
+            self.stats["in_use"] += 1
+            self.stats["wait_time"] += wait_time
+            self.stats["max_wait_time"] = max(self.stats["max_wait_time"], wait_time)
+            if wait_time > 0.001:
+                self.stats["waits"] += 1
+        if wait_time > DB_SLOW_CHECKOUT:
+            log.warning(f"Waited {wait_time:.1f}s for DB connection")
+        return conn
+
+    def putconn(self, conn, close=False):
+        if close or conn.closed:
+            self._close(conn)
+        else:
+            with self.lock:
+                self.idle.append((conn, time.monotonic()))
+        with self.lock:
+            self.stats["in_use"] -= 1
+        self.semaphore.release()
+
+    def closeall(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, "idle": len(self.idle)}
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.connect_kwargs)
+        with self.lock:
+            self.stats["connects"] += 1
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn, ts):
+        if conn.closed or conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - ts < DB_HEALTH_CHECK_IDLE:
+            return True
+        try:
+            with conn.cursor() as c:
+                c.execute('SELECT 1;')
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
 
 # https://medium.com/@thegavrikstory/manage-raw-database-connection-pool-in-flask-b11e50cbad3
 @contextmanager
 def get_db_connection():
-    global db_pool
     if db_pool is None:
         db_connect()
+    pool = db_pool
+    if pool is None:
+        # connecting to DB failed
+        yield None
+        return
     try:
-        if db_pool is None:
-            # connecting to DB failed
-            raise DBConnectionError()
-        conn = db_pool.getconn()
-        if conn is None:
-            # pool wasn't able to return a valid connection
-            raise DBConnectionError()
+        conn = pool.getconn()
+    except (DBConnectionError, psycopg2.OperationalError) as ex:
+        log.warning(f"Could not get DB connection: {ex}")
+        yield None
+        return
 
+    broken = False
+    try:
         conn.autocommit = True
         conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
         yield conn
-    except (DBConnectionError, psycopg2.OperationalError):
-        db_pool = None  # make sure that we reconnect next time
-        yield None
+    except psycopg2.OperationalError as ex:
+        # only this connection is replaced, the others are still usable:
+        broken = True
+        raise DBConnectionError(str(ex)) from ex
     finally:
-        if db_pool is not None:
-            db_pool.putconn(conn)
+        pool.putconn(conn, close=broken)
 
 
 @contextmanager
@@ -83,27 +194,41 @@ class InvalidDBCursor(object):
 
 def db_connect():
     global db_pool
-    host, dbname, user, password, connect_timeout = (
+    host, port, dbname, user, password, connect_timeout = (
         os.environ.get('DB_HOST', 'localhost'),
+        int(os.environ.get('DB_PORT', '5432')),
         os.environ.get('DB_DATABASE', 'grafolean'),
         os.environ.get('DB_USERNAME', 'admin'),
         os.environ.get('DB_PASSWORD', 'admin'),
         int(os.environ.get('DB_CONNECT_TIMEOUT', '10'))
     )
+    pool_min, pool_max, pool_timeout = (
+        int(os.environ.get('DB_POOL_MIN', '1')),
+        int(os.environ.get('DB_POOL_MAX', '20')),
+        float(os.environ.get('DB_POOL_TIMEOUT', '30')),
+    )
     try:
         log.info("Connecting to database, host: [{}], db: [{}], user: [{}]".format(host, dbname, user))
-        db_pool = ThreadedConnectionPool(1, 20,
-                              database=dbname,
-                              user=user,
-                              password=password,
-                              host=host,
-                              port=5432,
-                              connect_timeout=connect_timeout)
+        db_pool = DBPool(pool_min, pool_max, pool_timeout,
+                         database=dbname,
+                         user=user,
+                         password=password,
+                         host=host,
+                         port=port,
+                         connect_timeout=connect_timeout)
     except:
         db_pool = None
         log.warning("DB connection failed")
 
 
+def get_db_pool_stats():
+    """
+        Returns the stats of the DB connection pool of this process, or None if it is not connected.
+    """
+    pool = db_pool
+    return pool.get_stats() if pool is not None else None
+
+
 def db_disconnect():
     global db_pool
     if not db_pool:
@@ -179,3 +304,37 @@ def migration_step_1():
 def migration_step_2():
     with get_db_cursor() as c:
         c.execute(f'CREATE TABLE {DB_PREFIX}bot_counters (id TEXT NOT NULL PRIMARY KEY, value BIGSERIAL, ts NUMERIC(16, 6) NOT NULL);')
+
+def migration_step_3():
+    """ Values which could not be sent to Grafolean are spooled here until the backend is available again. """
+    with get_db_cursor() as c:
+        c.execute(f'CREATE TABLE {DB_PREFIX}values_spool (id BIGSERIAL NOT NULL PRIMARY KEY, ts NUMERIC(16, 6) NOT NULL, backend_url TEXT NOT NULL, bot_token TEXT NOT NULL, account_id INTEGER NOT NULL, n_values INTEGER NOT NULL, payload JSONB NOT NULL);')
+
+def migration_step_4():
+    """ When entities are sharded, each shard replays only its own spooled values. """
+    with get_db_cursor() as c:
+        c.execute(f'ALTER TABLE {DB_PREFIX}values_spool ADD COLUMN shard INTEGER NOT NULL DEFAULT 0;')
+        c.execute(f'CREATE INDEX {DB_PREFIX}values_spool_shard ON {DB_PREFIX}values_spool (shard, id);')
+
+def migration_step_5():
+    """
+        Counters are keyed by typed columns instead of a long text ident, and the index on ts
+        allows deleting stale counters. Existing counters are converted.
+    """
+    from counterstore import counter_key
+    with get_db_cursor() as c:
+        c.execute('BEGIN;')
+        c.execute(f'ALTER TABLE {DB_PREFIX}bot_counters RENAME TO {DB_PREFIX}bot_counters_old;')
+        c.execute(f'CREATE TABLE {DB_PREFIX}bot_counters (entity_id INTEGER NOT NULL, sensor_id INTEGER NOT NULL, oid_hash BIGINT NOT NULL, oid_index TEXT NOT NULL, value BIGINT NOT NULL, ts NUMERIC(16, 6) NOT NULL, '
+                  f'PRIMARY KEY (entity_id, sensor_id, oid_hash, oid_index));')
+        c.execute(f'CREATE INDEX {DB_PREFIX}bot_counters_ts ON {DB_PREFIX}bot_counters (ts);')
+        c.execute(f'SELECT id, value, ts FROM {DB_PREFIX}bot_counters_old;')
+        rows = []
+        for counter_ident, v, t in c.fetchall():
+            try:
+                rows.append((*counter_key(counter_ident), v, t))
+            except ValueError:
+                log.warning(f"Dropping counter with invalid ident: {counter_ident}")
+        execute_values(c, f'INSERT INTO {DB_PREFIX}bot_counters (entity_id, sensor_id, oid_hash, oid_index, value, ts) VALUES %s ON CONFLICT DO NOTHING;', rows, page_size=1000)
+        c.execute(f'DROP TABLE {DB_PREFIX}bot_counters_old;')
+        c.execute('COMMIT;')
@@ -0,0 +1,240 @@
+from functools import lru_cache
+import inspect
+import re
+
+from mathjspy import MathJS
+from mathjspy.constants import FUNCTION_MAP, OPERATOR_MAP
+import numpy as np
+
+
+EXPRESSION_CACHE_SIZE = 1024
+R_VARIABLE = re.compile(r'^\$([1-9][0-9]*)$')
+# (min, max) number of arguments of the functions whose signatures are not available (builtins):
+FUNCTION_ARITIES = {
+    'log': (1, 2),
+    'max': (2, None),
+    'min': (2, None),
+}
+
+
+class ExpressionError(Exception):
+    pass
+
+
+class NotVectorizable(Exception):
+    pass
+
+
+def _vector_div(a, b):
+    # MathJS evaluates division by zero to 0:
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=float), np.asarray(b, dtype=float))
+    result = np.zeros(a.shape)
+    np.divide(a, b, out=result, where=(b != 0))
+    return result
+
+
+# arithmetic functions which give exactly the same results when applied to whole numpy arrays:
+VECTOR_FUNCTION_MAP = {
+    'add': np.add,
+    'sub': np.subtract,
+    'mul': np.multiply,
+    'div': _vector_div,
+}
+
+
+class CompiledExpression(object):
+    """
+        Sensor expression, parsed only once. Calling it with a list of values (`$1` is the first
+        one) returns the same result as MathJS would. Only values at `variable_indexes` (0-based)
+        are used, others can be left as None.
+
+        If the expression only uses basic arithmetic, `evaluate_columns` can be called with a list
+        of numpy arrays (columns) instead, and it returns an array of results, one for each row.
+        Otherwise `evaluate_columns` is None.
+    """
+    def __init__(self, expression, evaluate, variable_indexes, evaluate_columns=None):
+        self.expression = expression
+        self.evaluate = evaluate
+        self.variable_indexes = variable_indexes
+        self.evaluate_columns = evaluate_columns
+
+    def __call__(self, values):
+        return self.evaluate(values)
+
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def compile_expression(expression):
+    """
+        Parses the expression using MathJS (so that the operator precedence is exactly the same),
+        then converts the parsed tokens to a tree of closures. Raises ExpressionError if the
+        expression is invalid.
+    """
+    mjs = MathJS()
+    try:
+        tokens = mjs.tokenize(expression)
+        clean_expression = mjs.operator_formatter(tokens)[0]
+        parsed_tokens = mjs.parse(mjs.tokenize(clean_expression))
+    except (SyntaxError, IndexError) as ex:
+        raise ExpressionError(f"Invalid expression [{expression}]: {str(ex)}")
+    # MathJS ignores the extra closing parentheses:
+    if tokens.count('(') != tokens.count(')'):
+        raise ExpressionError(f"Unbalanced parentheses in expression [{expression}]")
+    variable_indexes = set()
+    evaluate, returns_tuple = _compile_tokens(parsed_tokens, expression, variable_indexes)
+    if returns_tuple:
+        raise ExpressionError(f"Expression [{expression}] has more than one value")
+
+    evaluate_columns = None
+    if variable_indexes:  # results of constant expressions are not arrays
+        try:
+            evaluate_columns, returns_tuple = _compile_tokens(parsed_tokens, expression, set(), vectorized=True)
+            if returns_tuple:
+                evaluate_columns = None
+        except NotVectorizable:
+            pass
+    return CompiledExpression(expression, evaluate, frozenset(variable_indexes), evaluate_columns)
+
+
+def _compile_tokens(parsed_tokens, expression, variable_indexes, vectorized=False, function_args=False):
+    """
+        Mirrors `MathJS.eval_parsed_tokens()`, except that instead of calculating the value, it
+        returns a function that calculates it. Since the kind of each token (and thus the code path
+        taken) is known in advance, only the calculation itself is left for later. Unlike MathJS,
+        it raises ExpressionError for the expressions that can't be evaluated (like missing
+        operators or operands, or a wrong number of function arguments).
+
+        If `vectorized` is set, the resulting function operates on numpy arrays; NotVectorizable
+        is raised if this is not possible.
+
+        Returns a tuple (evaluate, returns_tuple).
+    """
+    if not parsed_tokens and not function_args:
+        raise ExpressionError(f"Missing value in expression [{expression}]")
+    multiple_values = []
+    value = (_constant(0), False)
+    current_fn = None
+    current_operator = None  # (operator, evaluate left operand)
+    expecting_value = True  # at the start, and after an operator or a comma
+    token_values = []  # for each token: (evaluate, returns_tuple), or None if token has no value
+    for i, v in enumerate(parsed_tokens):
+        if current_fn and not isinstance(v, list):
+            raise ExpressionError(f"Missing arguments of function [{current_fn}] in expression [{expression}]")
+        if v == ',' or isinstance(v, str) and v in OPERATOR_MAP:
+            if expecting_value and v == ',':
+                raise ExpressionError(f"Missing value before ',' in expression [{expression}]")
+            expecting_value = True
+        elif not current_fn:  # function arguments are a part of the function call value
+            if not expecting_value:
+                raise ExpressionError(f"Missing operator before [{v}] in expression [{expression}]")
+            expecting_value = False
+
+        token_value = None
+        if v == ',':
+            multiple_values.append(value)
+            value = (_constant(0), False)
+        elif isinstance(v, list):
+            if current_fn:
+                n_args = v.count(',') + 1 if v else 0
+                _check_arity(current_fn, n_args, expression)
+            token_value = _compile_tokens(v, expression, variable_indexes, vectorized, function_args=bool(current_fn))
+            if current_fn and vectorized:
+                if current_fn not in VECTOR_FUNCTION_MAP:
+                    raise NotVectorizable()
+                value = (_call_vector_function(VECTOR_FUNCTION_MAP[current_fn], *token_value), False)
+                current_fn = None
+            elif current_fn:
+                value = (_call_function(FUNCTION_MAP[current_fn], *token_value), False)
+                current_fn = None
+            else:
+                value = token_value
+        elif isinstance(v, str) and v in FUNCTION_MAP:
+            current_fn = v
+        elif isinstance(v, str) and v in OPERATOR_MAP:
+            if vectorized:
+                raise NotVectorizable()
+            if i == 0:
+                raise ExpressionError(f"Invalid first operator [{v}] in expression [{expression}]")
+            if token_values[i - 1] is None:
+                raise ExpressionError(f"Missing left operand of operator [{v}] in expression [{expression}]")
+            current_operator = (OPERATOR_MAP[v], token_values[i - 1][0])
+        else:
+            if isinstance(v, str):
+                m = R_VARIABLE.match(v)
+                if m is None:
+                    raise ExpressionError(f"Unknown symbol [{v}] in expression [{expression}]")
+                index = int(m.group(1)) - 1
+                variable_indexes.add(index)
+                token_value = (_variable(index), False)
+            else:
+                token_value = (_constant(v), False)
+            if current_operator:
+                value = (_apply_operator(current_operator[0], current_operator[1], token_value[0]), False)
+                current_operator = None
+            else:
+                value = token_value
+        token_values.append(token_value)
+
+    if current_fn:
+        raise ExpressionError(f"Missing arguments of function [{current_fn}] in expression [{expression}]")
+    if expecting_value and parsed_tokens:
+        raise ExpressionError(f"Missing value at the end of expression [{expression}]")
+    if multiple_values:
+        multiple_values.append(value)
+        return _tuple([evaluate for evaluate, _ in multiple_values]), True
+    return value
+
+
+def _check_arity(function_name, n_args, expression):
+    if function_name in FUNCTION_ARITIES:
+        min_args, max_args = FUNCTION_ARITIES[function_name]
+        valid = min_args <= n_args and (max_args is None or n_args <= max_args)
+    else:
+        try:
+            inspect.signature(FUNCTION_MAP[function_name]).bind(*range(n_args))
+            valid = n_args > 0
+        except TypeError:
+            valid = False
+        except ValueError:  # signature is not available
+            valid = True
+    if not valid:
+        raise ExpressionError(f"Wrong number of arguments ({n_args}) of function [{function_name}] in expression [{expression}]")
+
+
+def _constant(c):
+    return lambda values: c
+
+
+def _variable(index):
+    return lambda values: values[index]
+
+
+def _tuple(evaluates):
+    return lambda values: tuple(evaluate(values) for evaluate in evaluates)
+
+
+def _apply_operator(operator, left, right):
+    return lambda values: operator(left(values), right(values))
+
+
+def _call_function(fn, evaluate_args, args_are_tuple):
+    if args_are_tuple:
+        def call(values):
+            args = evaluate_args(values)
+            try:
+                return fn(*args)
+            except ZeroDivisionError:
+                return 0
+    else:
+        def call(values):
+            arg = evaluate_args(values)
+            try:
+                return fn(arg)
+            except ZeroDivisionError:
+                return 0
+    return call
+
+
+def _call_vector_function(fn, evaluate_args, args_are_tuple):
+    if args_are_tuple:
+        return lambda values: fn(*evaluate_args(values))
+    return lambda values: fn(evaluate_args(values))
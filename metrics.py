@@ -0,0 +1,257 @@
+import bisect
+from contextlib import contextmanager
+import http.server
+import logging
+import multiprocessing
+import os
+import queue
+import socketserver
+import threading
+import time
+
+
+log = logging.getLogger("{}.{}".format(__name__, "metrics"))
+
+
+# Metrics are collected by the main process, which serves them over HTTP (in Prometheus text
+# format). Jobs in worker processes aggregate their observations locally and periodically push
+# them to the collector's queue, which is created before the workers are forked. If the
+# collector is not set, all the functions here do nothing.
+collector = None
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+# workers push their metrics at most this often (in seconds):
+PUSH_INTERVAL = 5
+
+
+class Registry(object):
+    """
+        Counters and histograms, addressable by metric name and labels. Histograms keep a count
+        for each bucket (not cumulative), followed by the sum and count of observations.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [n in bucket 1, ..., n in bucket +Inf, sum, count]
+
+    def inc(self, name, labels, value):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            h = self.histograms.get((name, labels))
+            if h is None:
+                h = self.histograms[(name, labels)] = [0] * (len(DEFAULT_BUCKETS) + 3)
+            h[bisect.bisect_left(DEFAULT_BUCKETS, value)] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def take(self):
+        """
+            Returns the collected metrics and starts from scratch.
+        """
+        with self.lock:
+            counters, histograms = self.counters, self.histograms
+            self.counters, self.histograms = {}, {}
+        return counters, histograms
+
+    def merge(self, counters, histograms):
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, values in histograms.items():
+                h = self.histograms.get(key)
+                if h is None:
+                    self.histograms[key] = list(values)
+                else:
+                    for i, v in enumerate(values):
+                        h[i] += v
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        lines = []
+        last_name = None
+        for (name, labels), value in counters:
+            if name != last_name:
+                lines.append(f'# TYPE {name} counter')
+                last_name = name
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        for (name, labels), h in histograms:
+            if name != last_name:
+                lines.append(f'# TYPE {name} histogram')
+                last_name = name
+            cumulative = 0
+            for le, n in zip(DEFAULT_BUCKETS + ('+Inf',), h):
+                cumulative += n
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", str(le)),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(h[-2])}')
+            lines.append(f'{name}_count{_format_labels(labels)} {h[-1]}')
+        return lines
+
+
+class MetricsCollector(object):
+    """
+        Merges the metrics pushed by the workers, and serves them (together with the gauges and
+        counters given as callbacks, which are read when metrics are requested) on `http://<host>:<port>/metrics`.
+    """
+    def __init__(self, port, queue_size=10000):
+        self.port = port
+        self.pid = os.getpid()
+        self.queue = multiprocessing.Queue(queue_size)
+        self.registry = Registry()
+        self.callbacks = []  # (name, type, callback), callback returns a dict {labels: value}
+        self.server = None
+
+    def start(self):
+        threading.Thread(target=self._merge_pushed, name="metrics-merger", daemon=True).start()
+        collector = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = collector.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer(('', self.port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True).start()
+        log.info(f"Serving metrics on port {self.port}")
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def add_gauge(self, name, callback):
+        self.callbacks.append((name, 'gauge', callback))
+
+    def add_counter(self, name, callback):
+        """
+            Adds a counter whose (cumulative) values are maintained elsewhere, e.g. in the stats of
+            the values sender.
+        """
+        self.callbacks.append((name, 'counter', callback))
+
+    def render(self):
+        lines = self.registry.render()
+        for name, metric_type, callback in self.callbacks:
+            try:
+                values = callback()
+            except Exception:
+                log.exception(f"Error reading {metric_type} {name}")
+                continue
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in sorted(values.items()):
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def _merge_pushed(self):
+        while True:
+            counters, histograms = self.queue.get()
+            self.registry.merge(counters, histograms)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+# metrics of this (worker) process which were not pushed yet:
+_local = None
+_local_pid = None
+_last_push = 0.
+
+
+def _registry():
+    global _local, _local_pid
+    if os.getpid() == collector.pid:
+        return collector.registry
+    if _local_pid != os.getpid():
+        # (the registry of the parent process is not inherited)
+        _local, _local_pid = Registry(), os.getpid()
+    return _local
+
+
+def inc(name, value=1, **labels):
+    if collector is None:
+        return
+    _registry().inc(name, _labels(labels), value)
+    _maybe_push()
+
+
+def observe(name, value, **labels):
+    if collector is None:
+        return
+    _registry().observe(name, _labels(labels), value)
+    _maybe_push()
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+        Observes the duration of the block (also if it raises an exception).
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start, **labels)
+
+
+def push():
+    """
+        Sends the metrics of this worker process to the collector. Never blocks - if the queue is
+        full, the metrics are dropped.
+    """
+    global _last_push
+    if collector is None or os.getpid() == collector.pid or _local_pid != os.getpid():
+        return
+    _last_push = time.monotonic()
+    counters, histograms = _local.take()
+    if not counters and not histograms:
+        return
+    try:
+        collector.queue.put_nowait((counters, histograms))
+    except queue.Full:
+        log.warning("Metrics queue is full, dropping metrics")
+
+
+def _maybe_push():
+    if time.monotonic() - _last_push >= PUSH_INTERVAL:
+        push()
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def start_metrics(port):
+    """
+        Starts the metrics collector. Must be called before the job workers are forked.
+    """
+    global collector
+    collector = MetricsCollector(port)
+    collector.start()
+    return collector
@@ -0,0 +1,84 @@
+import hashlib
+import logging
+import multiprocessing
+import signal
+import time
+
+
+log = logging.getLogger("{}.{}".format(__name__, "sharding"))
+
+
+# if a shard process exits, it is restarted after this many seconds:
+RESTART_DELAY = 10
+
+
+def entity_shard(entity_id, shard_count):
+    """
+        Returns the shard that the entity belongs to. Note that the hash is not related to the
+        one used for phase offsets of jobs, so that jobs of each shard are still spread evenly.
+    """
+    digest = hashlib.sha1(str(entity_id).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+
+def entity_in_shard(entity_id, shard_index, shard_count):
+    return shard_count <= 1 or entity_shard(entity_id, shard_count) == shard_index
+
+
+def local_shards(shard_index, shard_count, n_processes):
+    """
+        When each of the `shard_count` bot instances runs `n_processes` processes, every process
+        is a shard of its own. Shards are numbered so that entities of an instance are still
+        exactly those in its own shard (`entity_shard(entity_id, shard_count) == shard_index`).
+
+        Returns a list of (shard_index, shard_count) tuples, one for each local process.
+    """
+    return [(shard_index + i * shard_count, shard_count * n_processes) for i in range(n_processes)]
+
+
+def stop_on_sigterm():
+    """
+        Makes SIGTERM (for example `docker stop`) behave like SIGINT (Ctrl+C), so that the bot
+        can shut down cleanly. Processes which are started afterwards inherit this handler.
+    """
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, stop)
+
+
+def run_sharded(shards, target):
+    """
+        Starts a process for each shard (calling `target(shard_index, shard_count)`) and restarts
+        the processes which exit. Blocking; when interrupted (SIGINT / SIGTERM), terminates all
+        the processes.
+    """
+    processes = {}  # shard -> process
+
+    # (shard processes inherit this handler, so they too can shut down cleanly)
+    stop_on_sigterm()
+
+    def start(shard):
+        process = multiprocessing.Process(target=target, args=shard, name=f'shard-{shard[0]}')
+        process.start()
+        log.info(f"Started process {process.pid} for shard {shard[0]} of {shard[1]}")
+        processes[shard] = process
+
+    try:
+        for shard in shards:
+            start(shard)
+        while True:
+            time.sleep(1)
+            for shard, process in list(processes.items()):
+                if process.is_alive():
+                    continue
+                log.error(f"Process for shard {shard[0]} exited with code {process.exitcode}, restarting it in {RESTART_DELAY}s")
+                time.sleep(RESTART_DELAY)
+                start(shard)
+    except KeyboardInterrupt:
+        log.info("Got exit signal, stopping shard processes.")
+    finally:
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in processes.values():
+            process.join()
@@ -0,0 +1,215 @@
+from multiprocessing.managers import BaseManager
+import logging
+import signal
+import threading
+import time
+
+from counterstore import CounterStore, CounterPruner
+from dbutils import get_db_pool_stats
+from valuespool import ValuesSpool
+
+
+log = logging.getLogger("{}.{}".format(__name__, "sharedstate"))
+
+
+# Jobs are executed by a pool of worker processes, so any state that should be shared between jobs
+# lives in a separate (manager) process, and the workers access it through these proxies. They are
+# created by the main process before the workers are forked. If they are not set, the jobs work
+# without them (counters are read from and written to DB directly, walk results are not cached,
+# values which could not be sent are dropped, interfaces are always walked and fetched from backend,
+# unreachable devices are polled normally).
+counter_store = None
+walk_cache = None
+values_spool = None
+interface_cache = None
+device_health = None
+db_pool_stats = None
+# not used by the jobs, but the reference must be kept (otherwise the instance is deleted):
+counter_pruner = None
+
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_PROBE = 'probe'
+
+
+class WalkCache(object):
+    """
+        Remembers recent SNMP WALK results of entities, so that they can be reused by other jobs.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}  # (entity_id, oid) -> (ts, results)
+        self.lock = threading.Lock()
+
+    def get(self, entity_id, oid):
+        with self.lock:
+            ts, results = self.entries.get((entity_id, oid), (None, None))
+            if ts is None or time.time() - ts > self.ttl:
+                return None
+            return results
+
+    def put(self, entity_id, oid, results):
+        now = time.time()
+        with self.lock:
+            self.entries[(entity_id, oid)] = (now, results)
+            for key in [k for k, (ts, _) in self.entries.items() if now - ts > self.ttl]:
+                del self.entries[key]
+
+
+class InterfaceCache(object):
+    """
+        Remembers the interface entities of each parent entity (as they are on the backend) and
+        the fingerprint of the interface data they were synced from. Entries expire after `ttl`
+        seconds, so that the changes made on the backend by others are eventually noticed.
+
+        It also remembers the change markers (see `snmpbot._interfaces_change_markers()`) of each
+        parent entity at the time of its last successful sync.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}  # parent_entity_id -> (ts, fingerprint, entities)
+        self.markers = {}  # parent_entity_id -> (ts, markers)
+        self.lock = threading.Lock()
+
+    def get(self, parent_entity_id):
+        """
+            Returns a tuple (fingerprint, entities) or None.
+        """
+        with self.lock:
+            ts, fingerprint, entities = self.entries.get(parent_entity_id, (None, None, None))
+            if ts is None or time.time() - ts > self.ttl:
+                return None
+            return fingerprint, entities
+
+    def put(self, parent_entity_id, fingerprint, entities):
+        with self.lock:
+            self.entries[parent_entity_id] = (time.time(), fingerprint, entities)
+
+    def invalidate(self, parent_entity_id):
+        with self.lock:
+            self.entries.pop(parent_entity_id, None)
+            self.markers.pop(parent_entity_id, None)
+
+    def get_markers(self, parent_entity_id):
+        """
+            Returns a tuple (ts, markers) or None.
+        """
+        with self.lock:
+            return self.markers.get(parent_entity_id)
+
+    def put_markers(self, parent_entity_id, markers):
+        with self.lock:
+            self.markers[parent_entity_id] = (time.time(), markers)
+
+
+class DeviceHealth(object):
+    """
+        Circuit breaker for each device (entity). After `failure_threshold` consecutive timeouts the
+        device is considered unreachable and its jobs are skipped (BREAKER_OPEN), except that once
+        in a while (with exponential backoff, from `min_backoff` to `max_backoff` seconds) a single
+        job is allowed to check if the device responds again (BREAKER_PROBE).
+    """
+    def __init__(self, failure_threshold, min_backoff, max_backoff):
+        self.failure_threshold = failure_threshold
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.entries = {}  # entity_id -> (consecutive_failures, next_probe_ts)
+        self.lock = threading.Lock()
+
+    def acquire(self, entity_id):
+        """
+            Returns the state of the breaker for this device (which tells if the job should run).
+        """
+        with self.lock:
+            failures, next_probe_ts = self.entries.get(entity_id, (0, None))
+            if failures < self.failure_threshold:
+                return BREAKER_CLOSED
+            now = time.time()
+            if now < next_probe_ts:
+                return BREAKER_OPEN
+            # only one job gets to probe the device, the others are skipped until the next probe:
+            self.entries[entity_id] = (failures, now + self._backoff(failures))
+            return BREAKER_PROBE
+
+    def record_failure(self, entity_id):
+        """
+            Returns True if the breaker has just opened.
+        """
+        with self.lock:
+            failures, _ = self.entries.get(entity_id, (0, None))
+            failures += 1
+            next_probe_ts = time.time() + self._backoff(failures) if failures >= self.failure_threshold else None
+            self.entries[entity_id] = (failures, next_probe_ts)
+            return failures == self.failure_threshold
+
+    def record_success(self, entity_id):
+        """
+            Returns True if the breaker was open.
+        """
+        with self.lock:
+            failures, _ = self.entries.pop(entity_id, (0, None))
+            return failures >= self.failure_threshold
+
+    def open_breakers(self):
+        """
+            Returns a dict with the number of consecutive failures of each unreachable device.
+        """
+        with self.lock:
+            return {entity_id: failures for entity_id, (failures, _) in self.entries.items() if failures >= self.failure_threshold}
+
+    def _backoff(self, failures):
+        return min(self.max_backoff, self.min_backoff * 2 ** min(failures - self.failure_threshold, 20))
+
+
+class DBPoolStats(object):
+    """
+        Exposes the stats of the DB connection pool of the shared state process (which is used by
+        `CounterStore` and `ValuesSpool`), so that they can be reported by the main process.
+    """
+    def get(self):
+        return get_db_pool_stats()
+
+
+class SharedStateManager(BaseManager):
+    pass
+
+
+SharedStateManager.register('CounterStore', CounterStore)
+SharedStateManager.register('CounterPruner', CounterPruner)
+SharedStateManager.register('WalkCache', WalkCache)
+SharedStateManager.register('ValuesSpool', ValuesSpool)
+SharedStateManager.register('InterfaceCache', InterfaceCache)
+SharedStateManager.register('DeviceHealth', DeviceHealth)
+SharedStateManager.register('DBPoolStats', DBPoolStats)
+
+
+def _ignore_sigint():
+    # the main process takes care of shutting down (and flushing the counters) on Ctrl+C:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def start_shared_state(counters_flush_interval, walk_cache_ttl, spool_max_values=0, spool_max_age=0, interface_cache_ttl=0,
+                       breaker_threshold=0, breaker_min_backoff=30, breaker_max_backoff=600, shard_index=0, shard_count=1, counters_ttl=0):
+    """
+        Starts the shared state process. Must be called before the job workers are forked, and
+        while the main process holds no DB connections (the shared state process opens its own).
+    """
+    global counter_store, counter_pruner, walk_cache, values_spool, interface_cache, device_health, db_pool_stats
+    manager = SharedStateManager()
+    manager.start(_ignore_sigint)
+    if counters_flush_interval > 0:
+        counter_store = manager.CounterStore(counters_flush_interval, shard_index, shard_count, counters_ttl)
+    # stale counters are deleted from DB regardless of whether counters are kept in memory:
+    if counters_ttl > 0:
+        counter_pruner = manager.CounterPruner(counters_ttl)
+    if walk_cache_ttl > 0:
+        walk_cache = manager.WalkCache(walk_cache_ttl)
+    if spool_max_values > 0:
+        values_spool = manager.ValuesSpool(spool_max_values, spool_max_age, shard_index)
+    # even if entities are not cached (ttl is 0), change markers of interfaces are:
+    interface_cache = manager.InterfaceCache(interface_cache_ttl)
+    if breaker_threshold > 0:
+        device_health = manager.DeviceHealth(breaker_threshold, breaker_min_backoff, breaker_max_backoff)
+    db_pool_stats = manager.DBPoolStats()
+    return manager
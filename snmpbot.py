@@ -3,18 +3,40 @@ import dotenv
 import logging
 import json
 import time
+import asyncio
+import concurrent.futures
+import threading
+import hashlib
+import itertools
+from contextlib import contextmanager
+import functools
+from functools import lru_cache
+from datetime import datetime
 from pytz import utc
 from colors import color
 import requests
+import random
 import re
+import zlib
 
-from easysnmp import Session, SNMPVariable
-from mathjspy import MathJS
+from easysnmp import Session, EasySNMPError, EasySNMPTimeoutError
 from slugify import slugify
+import numpy as np
 import psycopg2
+from psycopg2.extras import execute_values
 
 from grafoleancollector import Collector
-from dbutils import get_db_cursor, DB_PREFIX, initial_wait_for_db, migrate_if_needed, db_disconnect, DBConnectionError
+from grafoleancollector.collector import MultipleIntervalsTrigger, IntervalsAwareProcessPoolExecutor
+from apscheduler.schedulers.background import BackgroundScheduler
+import asyncsnmp
+from snmpresult import SNMPResult
+from counterstore import counter_key
+import metrics
+import sharedstate
+import sharding
+import valuesender
+from expressions import compile_expression, ExpressionError
+from dbutils import get_db_cursor, DB_PREFIX, initial_wait_for_db, migrate_if_needed, db_disconnect, get_db_pool_stats, DBConnectionError
 
 
 logging.basicConfig(format='%(asctime)s | %(levelname)s | %(message)s',
@@ -36,159 +58,380 @@ class InvalidOutputPath(Exception):
 
 OID_IF_DESCR = '1.3.6.1.2.1.2.2.1.2'
 OID_IF_SPEED = '1.3.6.1.2.1.2.2.1.5'
-
-
-def _get_previous_counter_value(counter_ident):
+# if sensors walk these OIDs, the results are reused by interfaces job (when walk cache is enabled):
+INTERFACES_WALK_OIDS = [OID_IF_DESCR, OID_IF_SPEED]
+# interfaces are only walked when one of these changes (ifNumber, ifTableLastChange, sysUpTime):
+OID_IF_NUMBER = '1.3.6.1.2.1.2.1.0'
+OID_IF_TABLE_LAST_CHANGE = '1.3.6.1.2.1.31.1.5.0'
+OID_SYS_UPTIME = '1.3.6.1.2.1.1.3.0'
+INTERFACES_CHANGE_OIDS = [OID_IF_NUMBER, OID_IF_TABLE_LAST_CHANGE, OID_SYS_UPTIME]
+
+# default number of rows per GETBULK response when walking (SNMPv2c and SNMPv3 only), can be
+# overridden per credential or per sensor; 0 means that walks use GETNEXT:
+SNMP_MAX_REPETITIONS = int(os.environ.get('SNMP_MAX_REPETITIONS', 25))
+# maximum number of OIDs requested in a single GET request:
+SNMP_MAX_GET_VARBINDS = int(os.environ.get('SNMP_MAX_GET_VARBINDS', 20))
+
+# Jobs can be executed either by worker processes using easysnmp ('easysnmp'), or concurrently in a
+# single event loop using asyncsnmp ('asyncio'). Note that asyncsnmp doesn't support SNMPv3, so such
+# jobs are still executed using easysnmp (in a thread).
+SNMP_BACKEND = os.environ.get('SNMP_BACKEND', 'easysnmp')
+ASYNC_MAX_CONCURRENT_JOBS = int(os.environ.get('ASYNC_MAX_CONCURRENT_JOBS', 1000))
+ASYNC_WORKER_THREADS = int(os.environ.get('ASYNC_WORKER_THREADS', 20))
+# number of worker processes (when using easysnmp backend), i.e. the maximum number of jobs running at the same time:
+SNMP_WORKERS = int(os.environ.get('SNMP_WORKERS', 10))
+# walks are stopped after this many rows (can be overridden per sensor by `max_rows`, 0 means no limit):
+SNMP_WALK_MAX_ROWS = int(os.environ.get('SNMP_WALK_MAX_ROWS', 50000))
+# walk rows are processed (and values are sent) in chunks of this size:
+STREAM_CHUNK_SIZE = 5000
+# UDP port of the SNMP agents (the benchmark points it to the simulated agent):
+SNMP_PORT = 161
+# easysnmp sessions which were not used for this many seconds are closed:
+SNMP_SESSION_MAX_IDLE = int(os.environ.get('SNMP_SESSION_MAX_IDLE', 600))
+SNMP_SESSION_MAX_COUNT = int(os.environ.get('SNMP_SESSION_MAX_COUNT', 200))
+# maximum number of concurrent requests when syncing interface entities with backend:
+INTERFACES_SYNC_CONCURRENCY = int(os.environ.get('INTERFACES_SYNC_CONCURRENCY', 8))
+INTERFACES_SYNC_TIMEOUT = 10
+# interfaces jobs check for changes at this interval (in seconds), but the interfaces are walked
+# and synced only if they changed, or if the last sync is older than INTERFACES_MAX_STALENESS:
+INTERFACES_CHECK_INTERVAL = int(os.environ.get('INTERFACES_CHECK_INTERVAL', 60))
+INTERFACES_MAX_STALENESS = int(os.environ.get('INTERFACES_MAX_STALENESS', 3600))
+# payloads (SNMP results and values) are logged at DEBUG level only, except for this fraction of
+# snmp jobs, whose payloads are logged at INFO level:
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get('LOG_PAYLOAD_SAMPLE_RATE', 0))
+
+
+def _get_previous_counter_values(counter_idents):
+    if not counter_idents:
+        return {}
+    keys = {counter_key(counter_ident): counter_ident for counter_ident in counter_idents}
     with get_db_cursor() as c:
         try:
-            c.execute(f'SELECT value, ts FROM {DB_PREFIX}bot_counters WHERE id = %s;', (counter_ident,))
-            rec = c.fetchone()
-            if rec is None:
-                return None, None
+            # (counter idents passed here always belong to the same sensor)
+            entity_id, sensor_id, _, _ = next(iter(keys))
+            c.execute(f'SELECT oid_hash, oid_index, value, ts FROM {DB_PREFIX}bot_counters WHERE entity_id = %s AND sensor_id = %s AND oid_hash = ANY(%s);',
+                      (entity_id, sensor_id, list(set(key[2] for key in keys))))
+            previous_values = {}
+            for oid_hash, oid_index, v, t in c.fetchall():
+                counter_ident = keys.get((entity_id, sensor_id, oid_hash, oid_index))
+                if counter_ident is not None:
+                    previous_values[counter_ident] = (int(v), float(t))
+            return previous_values
         except psycopg2.ProgrammingError:
-            log.exception(f'Error executing: SELECT value, ts FROM {DB_PREFIX}bot_counters WHERE id = %s; [{counter_ident}]')
-            return None, None
-        v, t = rec
-        return int(v), float(t)
+            log.exception(f'Error fetching previous counter values [{len(counter_idents)} idents]')
+            return {}
 
 
-def _save_current_counter_value(new_value, now, counter_ident):
+def _save_current_counter_values(new_values, now):
+    if not new_values:
+        return
     with get_db_cursor() as c:
-        c.execute(f"INSERT INTO {DB_PREFIX}bot_counters (id, value, ts) VALUES (%s, %s, %s) ON CONFLICT (id) DO UPDATE SET value = %s, ts = %s;",
-                (counter_ident, new_value, now, new_value, now))
+        # idents are dict keys, so they are unique - otherwise ON CONFLICT would complain about affecting the same row twice;
+        # like with `CounterStore.flush()`, a newer counter value is never overwritten with an older one:
+        execute_values(c, f"INSERT INTO {DB_PREFIX}bot_counters (entity_id, sensor_id, oid_hash, oid_index, value, ts) VALUES %s "
+                          f"ON CONFLICT (entity_id, sensor_id, oid_hash, oid_index) DO UPDATE SET value = EXCLUDED.value, ts = EXCLUDED.ts WHERE {DB_PREFIX}bot_counters.ts <= EXCLUDED.ts;",
+                       [(*counter_key(counter_ident), new_value, now) for counter_ident, new_value in new_values.items()])
 
 
-def _convert_counters_to_values(results, now, counter_ident_prefix):
-    new_results = []
+def _collect_counter_values(results, counter_ident_prefix, counter_values):
     for i, v in enumerate(results):
         if isinstance(v, list):
-            new_results.append(_convert_counters_to_values(v, now, counter_ident_prefix + f'/{i}'))
+            _collect_counter_values(v, counter_ident_prefix + f'/{i}', counter_values)
             continue
         if v.snmp_type not in ['COUNTER', 'COUNTER64']:
-            new_results.append(v)
             continue
-
-        # counter - deal with it:
-        new_value = int(float(v.value))
         counter_ident = counter_ident_prefix + f'/{i}/{v.oid}/{v.oid_index}'
-        try:
-            old_value, t = _get_previous_counter_value(counter_ident)
-            _save_current_counter_value(new_value, now, counter_ident)
-            if old_value is None:
-                new_results.append(SNMPVariable(oid=v.oid, oid_index=v.oid_index, value=None, snmp_type='COUNTER_PER_S'))
-                continue
+        counter_values[counter_ident] = int(float(v.value))
 
-            # it seems like the counter overflow happened, discard result:
-            if new_value < old_value:
-                new_results.append(SNMPVariable(oid=v.oid, oid_index=v.oid_index, value=None, snmp_type='COUNTER_PER_S'))
-                log.warning(f"Counter overflow detected for oid {v.oid}, oid index {v.oid_index}, entity_id/sensor_id: {counter_ident_prefix}; discarding value - if this happens often, consider using OIDS with 64bit counters (if available) or decreasing polling interval.")
-                continue
 
-            dt = now - t
-            dv = (new_value - old_value) / dt
-            new_results.append(SNMPVariable(oid=v.oid, oid_index=v.oid_index, value=dv, snmp_type='COUNTER_PER_S'))
-        except DBConnectionError:
-            log.error(f"Could not convert counter due to DB error: {counter_ident} / {new_value}")
+def _convert_counters_to_values(results, now, counter_ident_prefix):
+    """
+        Counters are converted to rates (per second) by comparing them with the values from the
+        previous run. All the counters are first collected, so that the previous values can be
+        fetched and the new ones saved in a single call to counter store (or with a single query
+        each, if counter store is not running).
+    """
+    new_counter_values = {}
+    _collect_counter_values(results, counter_ident_prefix, new_counter_values)
+    if not new_counter_values:
+        return results
+
+    try:
+        with metrics.timer('snmpbot_counter_store_seconds'):
+            if sharedstate.counter_store is not None:
+                previous_counter_values = sharedstate.counter_store.exchange(counter_ident_prefix, new_counter_values, now)
+            else:
+                previous_counter_values = _get_previous_counter_values(new_counter_values.keys())
+                _save_current_counter_values(new_counter_values, now)
+    except DBConnectionError:
+        log.error(f"Could not convert counters due to DB error: {counter_ident_prefix} / {len(new_counter_values)} counters")
+        previous_counter_values = {}
+    except (EOFError, ConnectionError):
+        log.error(f"Could not convert counters, counter store is not available: {counter_ident_prefix} / {len(new_counter_values)} counters")
+        previous_counter_values = {}
+    return _apply_counter_values(results, now, counter_ident_prefix, new_counter_values, previous_counter_values)
+
+
+def _apply_counter_values(results, now, counter_ident_prefix, new_counter_values, previous_counter_values):
+    new_results = list(results)
+    counter_positions = []
+    for i, v in enumerate(results):
+        if isinstance(v, list):
+            new_results[i] = _apply_counter_values(v, now, counter_ident_prefix + f'/{i}', new_counter_values, previous_counter_values)
+        elif v.snmp_type in ['COUNTER', 'COUNTER64']:
+            counter_positions.append(i)
+    if not counter_positions:
+        return new_results
+
+    # counters - rates of all of them (for example whole walk) are calculated at once:
+    counter_idents = [counter_ident_prefix + f'/{i}/{results[i].oid}/{results[i].oid_index}' for i in counter_positions]
+    rates, overflows = _calculate_counter_rates(
+        [new_counter_values[counter_ident] for counter_ident in counter_idents],
+        [previous_counter_values.get(counter_ident, (None, None)) for counter_ident in counter_idents],
+        now,
+    )
+    for i, rate, overflow in zip(counter_positions, rates, overflows):
+        v = results[i]
+        if overflow:
+            log.warning(f"Counter overflow detected for oid {v.oid}, oid index {v.oid_index}, entity_id/sensor_id: {counter_ident_prefix}; discarding value - if this happens often, consider using OIDS with 64bit counters (if available) or decreasing polling interval.")
+        new_results[i] = SNMPResult(v.oid, v.oid_index, rate, 'COUNTER_PER_S')
     return new_results
 
 
-def _construct_output_path(template, addressable_results, oid_index):
+def _calculate_counter_rates(new_values, previous_values, now):
+    """
+        Calculates per-second rates of counters. Returns a list of rates (None if there is no
+        previous value, or if it seems that the counter overflow happened) and a list of overflow
+        flags.
+    """
+    n = len(new_values)
+    has_previous = np.fromiter((old_value is not None for old_value, _ in previous_values), dtype=bool, count=n)
+    old_values = [old_value if old_value is not None else 0 for old_value, _ in previous_values]
+    try:
+        # 64bit counters don't fit into int64, and float64 would lose precision:
+        new_arr = np.array(new_values, dtype=np.uint64)
+        old_arr = np.array(old_values, dtype=np.uint64)
+    except OverflowError:  # negative values (not really counters?) - use Python ints
+        new_arr = np.array(new_values, dtype=object)
+        old_arr = np.array(old_values, dtype=object)
+    ts = np.fromiter((float(t) if t is not None else now for _, t in previous_values), dtype=float, count=n)
+
+    overflows = has_previous & (new_arr < old_arr)
+    valid = has_previous & ~overflows
+    dv = np.where(valid, new_arr - np.where(valid, old_arr, new_arr), 0).astype(float)
+    rates = np.zeros(n)
+    np.divide(dv, now - ts, out=rates, where=valid)
+    return [rate if ok else None for rate, ok in zip(rates.tolist(), valid.tolist())], overflows.tolist()
+
+
+def _counter_ident_prefix(entity_id, sensor_id):
+    return f'{entity_id}/{sensor_id}'
+
+
+@lru_cache(maxsize=16384)
+def _compile_output_path(template):
+    """
+        Parses output path template into a list of segments, which are either literal strings,
+        numbers (index of the result whose value should be used) or None (oid index). Also
+        returns the lowest and the highest result index used.
+    """
     # make sure that only valid characters are in the template:
     if not re.match(r'^([.0-9a-zA-Z_-]+|[{][^}]+[}])+$', template):
         raise InvalidOutputPath("Invalid output path template, could not parse")
-    result_parts = []
+    segments = []
     for between_dots in template.split('.'):
         OUTPUT_PATH_REGEX = r'([0-9a-zA-Z_-]+|[{][^}]+[}])'  # split parts with curly braces from those without
         for part in re.findall(OUTPUT_PATH_REGEX, between_dots):
             if part[0] != '{':
-                result_parts.append(part)
+                segments.append(part)
                 continue
             # expression parsing is currently a bit limited, we only replace {$1} to {$N} and {$index}
             if part[1] != '$':
                 raise InvalidOutputPath("Only simple substitutions are currently supported (like 'abc.{$2}.{$index}.def') - was expecting '$' after '{'.")
             expression = part[2:-1]
             if expression == 'index':
-                result_parts.append(oid_index)
+                segments.append(None)
             else:
                 if not expression.isdigit():
                     raise InvalidOutputPath("Only simple substitutions are currently supported (like 'abc.{$2}.{$index}.def') - was expecting either 'index' or a number after '$'.")
-                i = int(expression) - 1
-                if not 0 <= i < len(addressable_results):
-                    raise InvalidOutputPath(f"Could not create output path - the number after '$' should be between 1 and {len(addressable_results)} inclusive.")
-                v = addressable_results[i][oid_index]
-                clean_value = slugify(v.value, regex_pattern=r'[^0-9a-zA-Z_-]+', lowercase=False)
-                result_parts.append(clean_value)
+                segments.append(int(expression) - 1)
+        segments.append('.')
+    segments.pop()
+
+    # join consecutive literal strings:
+    compiled_segments = []
+    for segment in segments:
+        if isinstance(segment, str) and compiled_segments and isinstance(compiled_segments[-1], str):
+            compiled_segments[-1] += segment
+        else:
+            compiled_segments.append(segment)
+    result_indexes = [segment for segment in compiled_segments if isinstance(segment, int)]
+    return compiled_segments, min(result_indexes, default=0), max(result_indexes, default=-1)
+
+
+@lru_cache(maxsize=65536)
+def _slugify_label(value):
+    # label values (like interface names) are usually the same on every poll:
+    return slugify(value, regex_pattern=r'[^0-9a-zA-Z_-]+', lowercase=False)
 
-        result_parts.append('.')
-    return ''.join(result_parts)[:-1]
+
+def _construct_output_path(template, addressable_results, oid_index):
+    return _construct_output_path_for_row(template, [r.get(oid_index) for r in addressable_results], oid_index)
+
+
+def _construct_output_path_for_row(template, row, oid_index):
+    segments, min_result_index, max_result_index = _compile_output_path(template)
+    if min_result_index < 0 or max_result_index >= len(row):
+        raise InvalidOutputPath(f"Could not create output path - the number after '$' should be between 1 and {len(row)} inclusive.")
+    result_parts = []
+    for segment in segments:
+        if isinstance(segment, str):
+            result_parts.append(segment)
+        elif segment is None:
+            result_parts.append(oid_index)
+        else:
+            result_parts.append(_slugify_label(row[segment].value))
+    return ''.join(result_parts)
+
+
+def _align_walk_results(snmp_results, methods):
+    """
+        Joins the results by oid index; the order of oid indexes is taken from the first walk
+        result. Returns the list of oid indexes and a list of columns (one for each result), with
+        a value (SNMPResult) for each of the oid indexes, or None if it is missing. GET result
+        is used for all oid indexes.
+
+        Agents don't necessarily return the walk results in the same order (and some indexes
+        might be missing), so the columns which are not already aligned are joined using a
+        dict of their oid indexes.
+    """
+    walk_indexes = [v.oid_index for v in snmp_results[methods.index('walk')]]
+    n = len(walk_indexes)
+    columns = []
+    for method, snmp_result in zip(methods, snmp_results):
+        if method == 'get':
+            columns.append([snmp_result] * n)
+        elif len(snmp_result) == n and all(v.oid_index == oid_index for v, oid_index in zip(snmp_result, walk_indexes)):
+            columns.append(list(snmp_result))
+        else:
+            by_oid_index = {v.oid_index: v for v in snmp_result}
+            columns.append([by_oid_index.get(oid_index) for oid_index in walk_indexes])
+    return walk_indexes, columns
+
+
+def _expression_columns(columns, variable_indexes):
+    """
+        Converts the aligned columns which are used by expression to numpy arrays (others are
+        None), and returns them together with a mask of rows for which all the columns have a value.
+    """
+    n = len(columns[0]) if columns else 0
+    present = np.ones(n, dtype=bool)
+    value_columns = [None] * len(columns)
+    for i, column in enumerate(columns):
+        # oid index might not be present, or there might be no value (probably the first time we're asking for a counter):
+        column_present = np.fromiter((v is not None and v.value is not None for v in column), dtype=bool, count=n)
+        present &= column_present
+        if i in variable_indexes:  # not all values are used - some might be used by output_path
+            value_columns[i] = np.fromiter((float(v.value) if ok else 0. for v, ok in zip(column, column_present)), dtype=float, count=n)
+    return value_columns, present
 
 
 def _apply_expression_to_results(snmp_results, methods, expression, output_path_template):
+    return list(_iter_expression_values(snmp_results, methods, expression, output_path_template))
+
+
+def _iter_expression_values(snmp_results, methods, expression, output_path_template):
+    """
+        Yields the values calculated from SNMP results. Walk results are processed in chunks of
+        rows, so that the intermediate data (and values) are never created for all of the rows
+        at once.
+    """
+    compiled_expression = compile_expression(expression)
+    variable_indexes = compiled_expression.variable_indexes
     if 'walk' in methods:
         """
-            - determine which oid indexes are used
-            - rearrange SNMP results so that they are in dicts, addressable by oid_indexes
-            - for each oid_index, calculate expression value
+            - join SNMP results by oid indexes into aligned columns (GET value is repeated)
+            - for each chunk of rows:
+              - convert the values used by expression into numpy arrays
+              - calculate expression values for all rows at once (or row by row, if expression
+                can't be vectorized)
         """
-        walk_indexes = [v.oid_index for v in snmp_results[methods.index('walk')]]
-
-        addressable_results = []
-        for i, snmp_result in enumerate(snmp_results):
-            if methods[i] == 'get':
-                # GET value is used n-times, to simulate walk
-                addressable_results.append({oid_index: snmp_result for oid_index in walk_indexes})
-            elif methods[i] == 'walk':
-                addressable_results.append({o.oid_index: o for o in snmp_result})
-
-        result = []
-        for oid_index in walk_indexes:
-            known_output_paths = set()
-            try:
-                mjs = MathJS()
-                for i, r in enumerate(addressable_results):
-                    v = r.get(oid_index)
-                    if v is None:  # oid index wasn't present
-                        raise NoValueForOid()
-                    if v.value is None:  # no value (probably the first time we're asking for a counter)
-                        raise NoValueForOid()
-                    var_name = f'${i + 1}'
-                    if var_name in expression:  # not all values are used - some might be used by output_path
-                        mjs.set(var_name, float(v.value))
-                value = mjs.eval(expression)
-
-                output_path = _construct_output_path(output_path_template, addressable_results, oid_index)
-                if output_path in known_output_paths:
-                    raise InvalidOutputPath("The same path was already constructed from a previous result, please include {$index} in the output path template, or make sure it is unique!")
-                known_output_paths.add(output_path)
-                result.append({
-                    'p': output_path,
-                    'v': value,
-                })
-            except NoValueForOid:
-                log.warning(f'Missing value for oid index: {oid_index}')
-            except InvalidOutputPath as ex:
-                log.warning(f'Invalid output path for oid index [{oid_index}]: {str(ex)}')
-        return result
+        walk_indexes, columns = _align_walk_results(snmp_results, methods)
+        for start in range(0, len(walk_indexes), STREAM_CHUNK_SIZE):
+            end = start + STREAM_CHUNK_SIZE
+            yield from _evaluate_walk_chunk(compiled_expression, walk_indexes[start:end], [column[start:end] for column in columns], output_path_template)
 
     else:
         try:
             dummy_oid_index = '0'
-            addressable_results = [{dummy_oid_index: v} for v in snmp_results]
-            mjs = MathJS()
+            row = [None] * len(snmp_results)
             for i, v in enumerate(snmp_results):
                 if v.value is None:  # no value (probably the first time we're asking for a counter)
                     raise NoValueForOid()
-                var_name = f'${i + 1}'
-                if var_name in expression:  # not all values are used - some might be used by output_path
-                    mjs.set(var_name, float(v.value))
-            value = mjs.eval(expression)
-            output_path = _construct_output_path(output_path_template, addressable_results, dummy_oid_index)
-            return [
-                {'p': output_path, 'v': value},
-            ]
+                if i in variable_indexes:  # not all values are used - some might be used by output_path
+                    row[i] = float(v.value)
+            value = compiled_expression(row)
+            output_path = _construct_output_path_for_row(output_path_template, snmp_results, dummy_oid_index)
+            yield {'p': output_path, 'v': value}
         except NoValueForOid:
             log.warning(f'Missing OID value (counter?)')
-            return []
+
+
+def _evaluate_walk_chunk(compiled_expression, walk_indexes, columns, output_path_template):
+    value_columns, present = _expression_columns(columns, compiled_expression.variable_indexes)
+    if compiled_expression.evaluate_columns is not None:
+        with np.errstate(all='ignore'):  # same as with Python floats, overflows result in inf / nan
+            values = np.broadcast_to(compiled_expression.evaluate_columns(value_columns), present.shape).tolist()
+    else:
+        rows = zip(*[c.tolist() if c is not None else [None] * len(walk_indexes) for c in value_columns])
+        values = [compiled_expression(list(row)) if ok else None for row, ok in zip(rows, present.tolist())]
+
+    for j, (oid_index, value, ok) in enumerate(zip(walk_indexes, values, present.tolist())):
+        known_output_paths = set()
+        try:
+            if not ok:
+                raise NoValueForOid()
+
+            output_path = _construct_output_path_for_row(output_path_template, [column[j] for column in columns], oid_index)
+            if output_path in known_output_paths:
+                raise InvalidOutputPath("The same path was already constructed from a previous result, please include {$index} in the output path template, or make sure it is unique!")
+            known_output_paths.add(output_path)
+            yield {
+                'p': output_path,
+                'v': value,
+            }
+        except NoValueForOid:
+            log.warning(f'Missing value for oid index: {oid_index}')
+        except InvalidOutputPath as ex:
+            log.warning(f'Invalid output path for oid index [{oid_index}]: {str(ex)}')
+
+
+def _output_path_template(entity_id, sensor_details):
+    return f'entity.{entity_id}.snmp.{sensor_details["output_path"]}'
+
+
+def _is_sensor_valid(entity_id, sensor_info):
+    """
+        Compiles the expression and output path template in advance (so that they are cached), and
+        checks that they only use the values of sensor's OIDs.
+    """
+    sensor_details = sensor_info["sensor_details"]
+    n_oids = len(sensor_details["oids"])
+    try:
+        compiled_expression = compile_expression(sensor_details["expression"])
+        if any(i >= n_oids for i in compiled_expression.variable_indexes):
+            raise ExpressionError(f"Expression [{sensor_details['expression']}] uses more values than the sensor has OIDs ({n_oids})")
+    except ExpressionError as ex:
+        log.error(f"Sensor {sensor_info['sensor_id']} on entity {entity_id} will not be polled, invalid expression: {str(ex)}")
+        return False
+    try:
+        _, min_result_index, max_result_index = _compile_output_path(_output_path_template(entity_id, sensor_details))
+        if min_result_index < 0 or max_result_index >= n_oids:
+            raise InvalidOutputPath(f"The number after '$' should be between 1 and {n_oids} inclusive.")
+    except InvalidOutputPath as ex:
+        log.error(f"Sensor {sensor_info['sensor_id']} on entity {entity_id} will not be polled, invalid output path: {str(ex)}")
+        return False
+    return True
 
 
 def send_results_to_grafolean(backend_url, bot_token, account_id, values):
@@ -198,22 +441,635 @@ def send_results_to_grafolean(backend_url, bot_token, account_id, values):
         log.warning("No results available to be sent to Grafolean, skipping.")
         return
 
-    log.info("Sending results to Grafolean")
+    if valuesender.sender is not None:
+        # values are sent in batches by the values sender in the main process:
+        valuesender.sender.enqueue(backend_url, bot_token, account_id, values)
+        return
+
     try:
-        r = requests.post(url, json=values)
+        with metrics.timer('snmpbot_send_seconds'):
+            r = requests.post(url, json=values)
         r.raise_for_status()
-        log.info("Results sent: {}".format(values))
+        log.debug("Sent %d values to Grafolean", len(values))
     except:
+        metrics.inc('snmpbot_send_failures_total')
         log.exception("Error sending data to Grafolean")
 
 
+def _get_max_repetitions(credential_details, sensor_details=None):
+    if sensor_details and sensor_details.get("max_repetitions") is not None:
+        return int(sensor_details["max_repetitions"])
+    if credential_details.get("snmp_max_repetitions") is not None:
+        return int(credential_details["snmp_max_repetitions"])
+    return SNMP_MAX_REPETITIONS
+
+
+def _get_max_rows(sensor_details=None):
+    if sensor_details and sensor_details.get("max_rows") is not None:
+        return int(sensor_details["max_rows"])
+    return SNMP_WALK_MAX_ROWS
+
+
+def _snmp_walk_iter(session, oid, max_repetitions, max_rows):
+    """
+        Walks the subtree of OID using GETBULK (or GETNEXT if max_repetitions is 0), yielding the
+        results one by one. Unlike easysnmp's walk / bulkwalk, it never fetches many more rows
+        than `max_rows`.
+    """
+    root = asyncsnmp._oid_tuple(oid)
+    current, current_oid = root, oid
+    n_rows = 0
+    while True:
+        if max_repetitions > 0:
+            repetitions = max_repetitions if not max_rows else max(1, min(max_repetitions, max_rows + 1 - n_rows))
+            results = session.get_bulk([current_oid], non_repeaters=0, max_repetitions=repetitions)
+        else:
+            results = session.get_next([current_oid])
+        if not results:
+            return
+        for v in results:
+            if v.snmp_type in ['ENDOFMIBVIEW', 'NOSUCHOBJECT', 'NOSUCHINSTANCE', 'NOSUCHNAME']:
+                return
+            full_oid = f'{v.oid}.{v.oid_index}' if v.oid_index else v.oid
+            v_oid = asyncsnmp._oid_tuple(full_oid)
+            # stop when we leave the subtree, or if agent is returning OIDs out of order (to avoid loops):
+            if v_oid[:len(root)] != root or v_oid <= current:
+                return
+            yield SNMPResult.from_snmp_variable(v)
+            n_rows += 1
+            current, current_oid = v_oid, full_oid
+
+
+def _limit_walk_rows(results, oid, max_rows):
+    if max_rows and len(results) > max_rows:
+        log.warning(f"Walk of OID {oid} returned more than {max_rows} rows, ignoring the rest")
+        return results[:max_rows]
+    return results
+
+
+def _snmp_walk(session, oid, max_repetitions, max_rows=SNMP_WALK_MAX_ROWS):
+    # SNMPv1 doesn't know about GETBULK, so it is walked using GETNEXT (it signals the end of walk
+    # with noSuchName error, which easysnmp reports as NOSUCHNAME result because of `retry_no_such`):
+    if session.version == 1:
+        max_repetitions = 0
+    walk_iter = _snmp_walk_iter(session, oid, max_repetitions, max_rows)
+    if max_rows:
+        walk_iter = itertools.islice(walk_iter, max_rows + 1)  # one more, so that we know that the limit was exceeded
+    return _limit_walk_rows(list(walk_iter), oid, max_rows)
+
+
+def _snmp_walk_cached(session, entity_id, oid, max_repetitions, max_rows=SNMP_WALK_MAX_ROWS):
+    results = _cached_walk_results(entity_id, oid)
+    if results is not None:
+        return _limit_walk_rows(results, oid, max_rows)
+    return _snmp_walk(session, oid, max_repetitions, max_rows)
+
+
+def _cached_walk_results(entity_id, oid):
+    if sharedstate.walk_cache is None:
+        return None
+    return sharedstate.walk_cache.get(entity_id, oid)
+
+
+def _snmp_get_multiple(session, oids, max_varbinds):
+    """
+        Fetches OIDs using as few GET requests as possible and returns results in a dict, addressable
+        by the requested OIDs.
+    """
+    results = {}
+    for i in range(0, len(oids), max_varbinds):
+        results.update(_snmp_get_chunk(session, oids[i:i + max_varbinds]))
+    return results
+
+
+def _snmp_get_chunk(session, oids):
+    try:
+        return dict(zip(oids, _snmp_results_from_variables(session.get(oids))))
+    except EasySNMPTimeoutError:
+        raise
+    except EasySNMPError:
+        if len(oids) == 1:
+            raise
+        # the response was probably too big for the agent, try with smaller requests:
+        log.warning(f"GET request with {len(oids)} OIDs failed, splitting it in two")
+        half = len(oids) // 2
+        return {**_snmp_get_chunk(session, oids[:half]), **_snmp_get_chunk(session, oids[half:])}
+
+
+def _snmp_results_from_variables(snmp_variables):
+    """
+        Results are converted from easysnmp's `SNMPVariable`s to `SNMPResult`s as soon as they
+        are fetched.
+    """
+    return [SNMPResult.from_snmp_variable(v) for v in snmp_variables]
+
+
+def _snmp_result_from_varbind(varbind, walk_oid=None):
+    # easysnmp splits OIDs into oid and oid_index, so we must do the same:
+    if walk_oid is None:
+        oid, oid_index = varbind.oid.rsplit('.', 1)
+    else:
+        oid, oid_index = walk_oid, varbind.oid[len(walk_oid) + 1:]
+    return SNMPResult('.' + oid, oid_index, varbind.value, varbind.snmp_type)
+
+
+async def _snmp_walk_async(client, oid, max_repetitions, max_rows=SNMP_WALK_MAX_ROWS):
+    walk_oid = oid.strip('.')
+    varbinds = await client.walk(walk_oid, max_repetitions, max_rows or None)
+    return _limit_walk_rows([_snmp_result_from_varbind(varbind, walk_oid) for varbind in varbinds], oid, max_rows)
+
+
+async def _snmp_get_multiple_async(client, oids, max_varbinds):
+    results = {}
+    for i in range(0, len(oids), max_varbinds):
+        results.update(await _snmp_get_chunk_async(client, oids[i:i + max_varbinds]))
+    return results
+
+
+async def _snmp_get_chunk_async(client, oids):
+    try:
+        varbinds = await client.get(oids)
+        return {oid: _snmp_result_from_varbind(varbind) for oid, varbind in zip(oids, varbinds)}
+    except asyncsnmp.SNMPTooBigError:
+        if len(oids) == 1:
+            raise
+        log.warning(f"GET request with {len(oids)} OIDs failed, splitting it in two")
+        half = len(oids) // 2
+        return {**(await _snmp_get_chunk_async(client, oids[:half])), **(await _snmp_get_chunk_async(client, oids[half:]))}
+
+
+def _walk_max_rows(activated_sensors):
+    """
+        Each OID is walked only once, so the highest limit of all the sensors that use it is
+        applied to the walk (and then each sensor applies its own).
+    """
+    walk_max_rows = {}
+    for sensor in activated_sensors:
+        max_rows = _get_max_rows(sensor["sensor_details"])
+        for o in sensor["sensor_details"]["oids"]:
+            if o["fetch_method"] != 'walk':
+                continue
+            previous_max_rows = walk_max_rows.get(o["oid"], max_rows)
+            walk_max_rows[o["oid"]] = 0 if 0 in [previous_max_rows, max_rows] else max(previous_max_rows, max_rows)
+    return walk_max_rows
+
+
+def _fetch_steps(job_info, activated_sensors):
+    """
+        Decides what needs to be fetched for the activated sensors, without doing any I/O itself:
+        yields the requests, either ('get', oids) or ('walk', oid, max_repetitions, max_rows), and
+        expects their results to be sent back. This way the same logic is used by sync and async
+        jobs (see `_fetch_sensors_results()` and `_fetch_sensors_results_async()`), which also
+        publish the walk results to the walk cache.
+
+        Returns a list of (sensor, results, fetch_ts) tuples, where `fetch_ts` is the time when the
+        last of sensor's results was fetched (counter rates are calculated using this time).
+    """
+    # GET OIDs of all activated sensors are fetched together (each of them only once):
+    entity_id = job_info["entity_id"]
+    get_oids = list(dict.fromkeys([o["oid"] for s in activated_sensors for o in s["sensor_details"]["oids"] if o["fetch_method"] == 'get']))
+    if get_oids:
+        with metrics.timer('snmpbot_snmp_request_seconds', entity_id=entity_id, operation='get'):
+            get_results = yield ('get', get_oids)
+        get_ts = time.time()
+        metrics.inc('snmpbot_snmp_varbinds_total', len(get_results), entity_id=entity_id)
+    else:
+        get_results, get_ts = {}, None
+
+    walk_results = {}  # each OID is walked only once, even if multiple sensors use it
+    walk_ts = {}
+    walk_max_rows = _walk_max_rows(activated_sensors)
+    sensors_results = []
+    for sensor in activated_sensors:
+        results = []
+        fetch_ts = 0.
+        max_repetitions = _get_max_repetitions(job_info["credential_details"], sensor["sensor_details"])
+        max_rows = _get_max_rows(sensor["sensor_details"])
+        for o in sensor["sensor_details"]["oids"]:
+            oid = o["oid"]
+            if o["fetch_method"] == 'get':
+                results.append(get_results[oid])
+                fetch_ts = max(fetch_ts, get_ts)
+                continue
+
+            if oid not in walk_results:
+                with metrics.timer('snmpbot_snmp_request_seconds', entity_id=entity_id, operation='walk'):
+                    walk_results[oid] = yield ('walk', oid, max_repetitions, walk_max_rows[oid])
+                walk_ts[oid] = time.time()
+                metrics.inc('snmpbot_snmp_varbinds_total', len(walk_results[oid]), entity_id=entity_id)
+            results.append(_limit_walk_rows(walk_results[oid], oid, max_rows))
+            fetch_ts = max(fetch_ts, walk_ts[oid])
+            metrics.inc('snmpbot_walk_rows_total', len(results[-1]), entity_id=entity_id, sensor_id=sensor["sensor_id"])
+        sensors_results.append((sensor, results, fetch_ts))
+    return sensors_results
+
+
+def _fetch_sensors_results(session, job_info, activated_sensors):
+    """
+        Returns a list of (sensor, results, fetch_ts) tuples.
+    """
+    steps = _fetch_steps(job_info, activated_sensors)
+    try:
+        request = next(steps)
+        while True:
+            try:
+                if request[0] == 'get':
+                    result = _snmp_get_multiple(session, request[1], SNMP_MAX_GET_VARBINDS)
+                else:
+                    result = _snmp_walk(session, *request[1:])
+            except Exception as ex:
+                steps.throw(ex)  # (re-raised by the generator)
+            if request[0] == 'walk' and _is_walk_published(request[1]):
+                _publish_walk_results(job_info["entity_id"], request[1], result)
+            request = steps.send(result)
+    except StopIteration as ex:
+        return ex.value
+
+
+async def _fetch_sensors_results_async(client, job_info, activated_sensors, published_walks):
+    """
+        Same as `_fetch_sensors_results()`, but uses asyncsnmp client. Since calls to shared state
+        block, walk results are not published here, but appended (as (oid, results) tuples) to
+        `published_walks`, so that the caller can publish them in a thread.
+    """
+    steps = _fetch_steps(job_info, activated_sensors)
+    try:
+        request = next(steps)
+        while True:
+            try:
+                if request[0] == 'get':
+                    result = await _snmp_get_multiple_async(client, request[1], SNMP_MAX_GET_VARBINDS)
+                else:
+                    result = await _snmp_walk_async(client, *request[1:])
+            except Exception as ex:
+                steps.throw(ex)
+            if request[0] == 'walk' and _is_walk_published(request[1]):
+                published_walks.append((request[1], result))
+            request = steps.send(result)
+    except StopIteration as ex:
+        return ex.value
+
+
+def _calculate_values(job_info, sensors_results, payload_log_level=None):
+    """
+        Converts counters and applies expressions to the SNMP results of each sensor, yielding
+        the values. Parameter `sensors_results` is a list of (sensor, results, fetch_ts) tuples. If
+        `payload_log_level` is set, SNMP results are logged at this level.
+    """
+    for sensor, results, fetch_ts in sensors_results:
+        oids = [o["oid"] for o in sensor["sensor_details"]["oids"]]
+        methods = [o["fetch_method"] for o in sensor["sensor_details"]["oids"]]
+        if payload_log_level is not None:
+            log.log(payload_log_level, "Results of sensor %s: %s", sensor["sensor_id"], list(zip(oids, methods, results)))
+
+        counter_ident_prefix = _counter_ident_prefix(job_info["entity_id"], sensor["sensor_id"])
+        results_no_counters = _convert_counters_to_values(results, fetch_ts, counter_ident_prefix)
+
+        # We have SNMP results and expression - let's calculate value(s). The trick here is that
+        # if some of the data is fetched via SNMP WALK, we will have many results; if only SNMP
+        # GET was used, we get one.
+        expression = sensor["sensor_details"]["expression"]
+        output_path = _output_path_template(job_info["entity_id"], sensor["sensor_details"])
+        yield from _iter_expression_values(results_no_counters, methods, expression, output_path)
+
+
+def _send_values_in_chunks(job_info, values, payload_log_level=None):
+    """
+        Sends values (any iterable) to Grafolean in chunks, so that they are never all in memory.
+        If `payload_log_level` is set, values are logged at this level. Returns the number of values.
+    """
+    values = iter(values)
+    n_values = 0
+    for chunk in iter(lambda: list(itertools.islice(values, STREAM_CHUNK_SIZE)), []):
+        if payload_log_level is not None:
+            log.log(payload_log_level, "Values: %s", chunk)
+        send_results_to_grafolean(job_info['backend_url'], job_info['bot_token'], job_info['account_id'], chunk)
+        n_values += len(chunk)
+    if n_values == 0:
+        send_results_to_grafolean(job_info['backend_url'], job_info['bot_token'], job_info['account_id'], [])
+    return n_values
+
+
+def _payload_log_level():
+    """
+        Returns the level at which payloads of a job should be logged, or None if they should not
+        be logged at all (so that they are not even formatted).
+    """
+    if LOG_PAYLOAD_SAMPLE_RATE > 0 and random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        return logging.INFO
+    if log.isEnabledFor(logging.DEBUG):
+        return logging.DEBUG
+    return None
+
+
+def _snmp_value_size(v):
+    return len(v.value) if isinstance(v.value, (str, bytes)) else 8
+
+
+def _log_job_summary(job_info, sensors_results, n_values, start):
+    n_results, n_bytes = 0, 0
+    for _, results, _ in sensors_results:
+        for r in results:
+            if isinstance(r, list):
+                n_results += len(r)
+                n_bytes += sum(_snmp_value_size(v) for v in r)
+            else:
+                n_results += 1
+                n_bytes += _snmp_value_size(r)
+    log.info("Finished snmp job for account [{account_id}], IP [{ipv4}]: {n_sensors} sensors, {n_results} SNMP results ({n_bytes} bytes), {n_values} values in {duration:.3f}s".format(
+        account_id=job_info["account_id"],
+        ipv4=job_info["details"]["ipv4"],
+        n_sensors=len(sensors_results),
+        n_results=n_results,
+        n_bytes=n_bytes,
+        n_values=n_values,
+        duration=time.monotonic() - start,
+    ))
+
+
+def _is_walk_published(oid):
+    """
+        Walk results of interface OIDs are shared with the interfaces job (if walk cache is enabled).
+    """
+    return sharedstate.walk_cache is not None and oid.lstrip('.') in INTERFACES_WALK_OIDS
+
+
+def _publish_walk_results(entity_id, oid, results):
+    sharedstate.walk_cache.put(entity_id, oid.lstrip('.'), results)
+
+
+def _device_breaker_state(entity_id):
+    if sharedstate.device_health is None:
+        return sharedstate.BREAKER_CLOSED
+    state = sharedstate.device_health.acquire(entity_id)
+    if state == sharedstate.BREAKER_OPEN:
+        log.debug(f"Device {entity_id} is not reachable, skipping job.")
+    elif state == sharedstate.BREAKER_PROBE:
+        log.info(f"Checking if device {entity_id} is reachable again.")
+    return state
+
+
+@contextmanager
+def _device_health_tracking(entity_id):
+    """
+        Records timeouts (and successful polls) of the device, so that unreachable devices can be skipped.
+    """
+    try:
+        yield
+    except (EasySNMPTimeoutError, asyncsnmp.SNMPTimeoutError):
+        _record_device_failure(entity_id)
+        raise
+    _record_device_success(entity_id)
+
+
+async def _device_failures_tracked(entity_id, coro):
+    """
+        Async counterpart of `_device_health_tracking()` - awaits the coroutine and records timeouts
+        in a thread, so that the event loop is not blocked by the calls to shared state. To avoid
+        another roundtrip to a thread, successful polls must be recorded by the caller (using
+        `_record_device_success()`), together with the rest of its blocking work.
+    """
+    try:
+        return await coro
+    except asyncsnmp.SNMPTimeoutError:
+        if sharedstate.device_health is not None:
+            await asyncio.get_event_loop().run_in_executor(None, _record_device_failure, entity_id)
+        raise
+
+
+def _record_device_failure(entity_id):
+    if sharedstate.device_health is not None and sharedstate.device_health.record_failure(entity_id):
+        log.warning(f"Device {entity_id} is not reachable, polling it only occasionally until it responds again.")
+
+
+def _record_device_success(entity_id):
+    if sharedstate.device_health is not None and sharedstate.device_health.record_success(entity_id):
+        log.info(f"Device {entity_id} is reachable again.")
+
+
+def _job_phase_offset(job_id, intervals):
+    """
+        To avoid all the jobs firing at the same time, each of them gets a fixed phase offset within
+        its (longest) interval. The offset is derived from job id, so it doesn't change when the
+        jobs are refreshed.
+    """
+    if not intervals:
+        return None
+    return zlib.crc32(job_id.encode('utf-8')) % max(intervals)
+
+
+def _schedule_drift(job_info, affecting_intervals, now):
+    """
+        Returns the number of seconds the job was started after it was scheduled, or None if unknown.
+    """
+    phase_offset = job_info.get("phase_offset")
+    if phase_offset is None or not affecting_intervals:
+        return None
+    return (now - phase_offset) % max(affecting_intervals)
+
+
+def _log_job_start(job_name, job_info, affecting_intervals):
+    drift = _schedule_drift(job_info, affecting_intervals, time.time())
+    if drift is not None:
+        metrics.observe('snmpbot_schedule_lag_seconds', drift, job=job_name)
+    log.info("Running {job_name} job for account [{account_id}], IP [{ipv4}]{drift}".format(
+        job_name=job_name,
+        account_id=job_info["account_id"],
+        ipv4=job_info["details"]["ipv4"],
+        drift='' if drift is None else f' (drift {drift:.3f}s)',
+    ))
+
+
+def _instrumented_job(job_name):
+    """
+        Records the number of job runs (by result) and the time spent in them (which together with
+        the number of workers gives worker utilization), then pushes the metrics of this worker.
+    """
+    def record(start, result):
+        metrics.inc('snmpbot_job_seconds_total', time.monotonic() - start, job=job_name)
+        metrics.inc('snmpbot_jobs_total', job=job_name, result=result)
+        metrics.push()
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.monotonic()
+                try:
+                    retval = await func(*args, **kwargs)
+                except Exception:
+                    record(start, 'error')
+                    raise
+                record(start, 'ok')
+                return retval
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.monotonic()
+                try:
+                    retval = func(*args, **kwargs)
+                except Exception:
+                    record(start, 'error')
+                    raise
+                record(start, 'ok')
+                return retval
+        return wrapper
+    return decorator
+
+
+def _interfaces_change_markers(results):
+    """
+        Returns a tuple (ifNumber, ifTableLastChange, sysUpTime), with None for the values which
+        the agent doesn't have.
+    """
+    markers = []
+    for oid in INTERFACES_CHANGE_OIDS:
+        v = results.get(oid)
+        if v is None or v.snmp_type in ['NOSUCHOBJECT', 'NOSUCHINSTANCE', 'NOSUCHNAME', 'ENDOFMIBVIEW']:
+            markers.append(None)
+            continue
+        try:
+            markers.append(int(v.value))
+        except (TypeError, ValueError):
+            markers.append(None)
+    return tuple(markers)
+
+
+def _interfaces_changed(previous, markers, now):
+    """
+        Decides if interfaces need to be walked again. `previous` is a tuple (ts, markers) which
+        was saved after the last successful sync, or None.
+    """
+    if previous is None:
+        return True
+    ts, (previous_if_number, previous_last_change, previous_uptime) = previous
+    if now - ts >= INTERFACES_MAX_STALENESS:
+        return True
+    if_number, last_change, uptime = markers
+    if if_number is None and last_change is None:
+        return True  # there is no way to tell
+    if if_number != previous_if_number or last_change != previous_last_change:
+        return True
+    # agent was restarted (or uptime wrapped around) - interfaces could have been renumbered:
+    if uptime is not None and previous_uptime is not None and uptime < previous_uptime:
+        return True
+    return False
+
+
+def _interfaces_fingerprint(interfaces):
+    """
+        Returns a hash of the list of (oid_index, descr, speed_bps) tuples.
+    """
+    return hashlib.sha256(json.dumps(interfaces, default=str).encode('utf-8')).hexdigest()
+
+
+_backend_session = None
+_backend_session_pid = None
+
+
+def _get_backend_session():
+    """
+        Returns a `requests.Session` with a keep-alive connection pool large enough for concurrent
+        requests to backend. Each worker process creates its own (connections can't be shared
+        with forked processes).
+    """
+    global _backend_session, _backend_session_pid
+    if _backend_session is None or _backend_session_pid != os.getpid():
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=INTERFACES_SYNC_CONCURRENCY)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _backend_session, _backend_session_pid = session, os.getpid()
+    return _backend_session
+
+
+def _send_entity_change(requests_session, method, url, payload):
+    """
+        Sends a single change of interface entity to backend, returns the parsed response (if any).
+    """
+    r = requests_session.request(method, url, json=payload, timeout=INTERFACES_SYNC_TIMEOUT)
+    r.raise_for_status()
+    try:
+        return r.json()
+    except ValueError:
+        return None
+
+
+class SNMPSessionPool(object):
+    """
+        Creating an easysnmp session is not free (with SNMPv3 it involves engine ID discovery and key
+        localization), so the sessions are reused between job runs. Each worker process has its own
+        pool. The sessions are keyed by host and credential fingerprint, so they are automatically
+        replaced when the credentials change. A session is only used by one job at a time.
+
+        Each session holds a socket, so at most `max_sessions` idle sessions are kept (if set), and
+        the least recently used ones are closed first. (Easysnmp closes the session when it is
+        garbage collected, so it is enough to drop it.)
+    """
+    def __init__(self, max_idle_time, max_sessions=0):
+        self.max_idle_time = max_idle_time
+        self.max_sessions = max_sessions
+        self.idle_sessions = {}  # (hostname, fingerprint) -> [(last_used_ts, session), ...]
+        self.fingerprints = {}  # hostname -> fingerprint of the last used credentials
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _fingerprint(credential_details):
+        return hashlib.sha256(json.dumps(credential_details, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _evict(self, now):
+        oldest_allowed_ts = now - self.max_idle_time
+        if self.max_sessions:
+            idle_ts = sorted((ts for sessions in self.idle_sessions.values() for ts, _ in sessions), reverse=True)
+            if len(idle_ts) > self.max_sessions:
+                oldest_allowed_ts = max(oldest_allowed_ts, idle_ts[self.max_sessions - 1])
+        for key in list(self.idle_sessions.keys()):
+            self.idle_sessions[key] = [(ts, session) for ts, session in self.idle_sessions[key] if ts >= oldest_allowed_ts]
+            if not self.idle_sessions[key]:
+                del self.idle_sessions[key]
+
+    @contextmanager
+    def checkout(self, job_info):
+        hostname = job_info["details"]["ipv4"]
+        fingerprint = SNMPSessionPool._fingerprint(job_info["credential_details"])
+        key = (hostname, fingerprint)
+        session = None
+        with self.lock:
+            self._evict(time.time())
+            # if credentials have changed, sessions with the old ones are no longer needed:
+            old_fingerprint = self.fingerprints.get(hostname)
+            if old_fingerprint is not None and old_fingerprint != fingerprint:
+                self.idle_sessions.pop((hostname, old_fingerprint), None)
+            self.fingerprints[hostname] = fingerprint
+            if self.idle_sessions.get(key):
+                _, session = self.idle_sessions[key].pop()
+        if session is None:
+            session = SNMPBot._create_snmp_sesssion(job_info)
+
+        yield session
+
+        # the session is only returned to the pool if there was no exception while using it:
+        with self.lock:
+            now = time.time()
+            self.idle_sessions.setdefault(key, []).append((now, session))
+            self._evict(now)
+
+
+snmp_sessions = SNMPSessionPool(SNMP_SESSION_MAX_IDLE, SNMP_SESSION_MAX_COUNT)
+
+
 class SNMPBot(Collector):
+    def __init__(self, backend_url, bot_token, jobs_refresh_interval, shard_index=0, shard_count=1):
+        super().__init__(backend_url, bot_token, jobs_refresh_interval)
+        self.shard_index = shard_index
+        self.shard_count = shard_count
 
     @staticmethod
     def _create_snmp_sesssion(job_info):
         # initialize SNMP session:
         session_kwargs = {
             "hostname": job_info["details"]["ipv4"],
+            "remote_port": SNMP_PORT,
             "use_numeric": True,
         }
         cred = job_info["credential_details"]
@@ -221,6 +1077,9 @@ class SNMPBot(Collector):
         session_kwargs["version"] = snmp_version
         if snmp_version in [1, 2]:
             session_kwargs["community"] = cred["snmpv12_community"]
+            # with SNMPv1, a single missing OID would fail the whole (multi-OID) GET request - so we
+            # instruct net-snmp to remove the missing OIDs and resend the request:
+            session_kwargs["retry_no_such"] = snmp_version == 1
         elif snmp_version == 3:
             session_kwargs = {
                 **session_kwargs,
@@ -237,6 +1096,18 @@ class SNMPBot(Collector):
         return session
 
     @staticmethod
+    def _create_async_snmp_client(snmp_engine, job_info):
+        cred = job_info["credential_details"]
+        snmp_version = int(cred["version"][5:6])
+        if snmp_version == 1:
+            return asyncsnmp.SNMPClient(snmp_engine, job_info["details"]["ipv4"], cred["snmpv12_community"], asyncsnmp.SNMP_VERSION_1, SNMP_PORT)
+        elif snmp_version == 2:
+            return asyncsnmp.SNMPClient(snmp_engine, job_info["details"]["ipv4"], cred["snmpv12_community"], asyncsnmp.SNMP_VERSION_2C, SNMP_PORT)
+        # SNMPv3 is not supported by asyncsnmp:
+        return None
+
+    @staticmethod
+    @_instrumented_job('snmp')
     def do_snmp(*args, **job_info):
         """
             {
@@ -285,146 +1156,376 @@ class SNMPBot(Collector):
                 ]
             }
         """
-        log.info("Running job for account [{account_id}], IP [{ipv4}]".format(
-            account_id=job_info["account_id"],
-            ipv4=job_info["details"]["ipv4"],
-        ))
-
-        session = SNMPBot._create_snmp_sesssion(job_info)
-
         # filter out only those sensors that are supposed to run at this interval:
         affecting_intervals, = args
+        start = time.monotonic()
+        _log_job_start("snmp", job_info, affecting_intervals)
         activated_sensors = [s for s in job_info["sensors"] if s["interval"] in affecting_intervals]
-        values = []
-        for sensor in activated_sensors:
-            results = []
-            oids = [o["oid"] for o in sensor["sensor_details"]["oids"]]
-            methods = [o["fetch_method"] for o in sensor["sensor_details"]["oids"]]
-            walk_indexes = None
-            for oid, fetch_method in zip(oids, methods):
-                if fetch_method == 'get':
-                    result = session.get(oid)
-                    results.append(result)
-                else:
-                    result = session.walk(oid)
-                    results.append(result)
-                    # while we are at it, save the indexes of the results:
-                    if not walk_indexes:
-                        walk_indexes = [r.oid_index for r in result]
-            log.info("Results: {}".format(list(zip(oids, methods, results))))
 
-            counter_ident_prefix = f'{job_info["entity_id"]}/{sensor["sensor_id"]}'
-            results_no_counters = _convert_counters_to_values(results, time.time(), counter_ident_prefix)
+        # if device is not reachable, we only check once in a while if it responds (using a single GET):
+        breaker_state = _device_breaker_state(job_info["entity_id"])
+        if breaker_state == sharedstate.BREAKER_OPEN:
+            return
+        with snmp_sessions.checkout(job_info) as session, _device_health_tracking(job_info["entity_id"]):
+            if breaker_state == sharedstate.BREAKER_PROBE:
+                _snmp_get_chunk(session, [OID_SYS_UPTIME])
+            sensors_results = _fetch_sensors_results(session, job_info, activated_sensors)
+
+        payload_log_level = _payload_log_level()
+        n_values = _send_values_in_chunks(job_info, _calculate_values(job_info, sensors_results, payload_log_level), payload_log_level)
+        _log_job_summary(job_info, sensors_results, n_values, start)
 
-            # We have SNMP results and expression - let's calculate value(s). The trick here is that
-            # if some of the data is fetched via SNMP WALK, we will have many results; if only SNMP
-            # GET was used, we get one.
-            expression = sensor["sensor_details"]["expression"]
-            output_path = f'entity.{job_info["entity_id"]}.snmp.{sensor["sensor_details"]["output_path"]}'
-            new_values = _apply_expression_to_results(results_no_counters, methods, expression, output_path)
-            values.extend(new_values)
+    @staticmethod
+    @_instrumented_job('snmp')
+    async def do_snmp_async(snmp_engine, affecting_intervals, **job_info):
+        """
+            Same as `do_snmp`, except that it uses asyncsnmp (if possible) and runs in event loop.
+        """
+        loop = asyncio.get_event_loop()
+        client = SNMPBot._create_async_snmp_client(snmp_engine, job_info)
+        if client is None:
+            # (the run is already recorded by this job, so the sync job is called without its instrumentation)
+            await loop.run_in_executor(None, lambda: SNMPBot.do_snmp.__wrapped__(affecting_intervals, **job_info))
+            return
 
-        send_results_to_grafolean(job_info['backend_url'], job_info['bot_token'], job_info['account_id'], values)
+        start = time.monotonic()
+        _log_job_start("snmp", job_info, affecting_intervals)
+        activated_sensors = [s for s in job_info["sensors"] if s["interval"] in affecting_intervals]
+
+        breaker_state = await loop.run_in_executor(None, _device_breaker_state, job_info["entity_id"])
+        if breaker_state == sharedstate.BREAKER_OPEN:
+            return
+
+        async def fetch():
+            if breaker_state == sharedstate.BREAKER_PROBE:
+                await _snmp_get_chunk_async(client, [OID_SYS_UPTIME])
+            return await _fetch_sensors_results_async(client, job_info, activated_sensors, published_walks)
+        published_walks = []
+        sensors_results = await _device_failures_tracked(job_info["entity_id"], fetch())
+
+        # shared state, counters, expressions and sending the values to Grafolean are blocking, so they are done in a thread:
+        def calculate_and_send():
+            _record_device_success(job_info["entity_id"])
+            for oid, results in published_walks:
+                _publish_walk_results(job_info["entity_id"], oid, results)
+            payload_log_level = _payload_log_level()
+            n_values = _send_values_in_chunks(job_info, _calculate_values(job_info, sensors_results, payload_log_level), payload_log_level)
+            _log_job_summary(job_info, sensors_results, n_values, start)
+        await loop.run_in_executor(None, calculate_and_send)
 
 
     @staticmethod
+    @_instrumented_job('interfaces')
     def update_if_entities(*args, **job_info):
-        log.info("Running interfaces job for account [{account_id}], IP [{ipv4}]".format(
-            account_id=job_info["account_id"],
-            ipv4=job_info["details"]["ipv4"],
-        ))
+        affecting_intervals, = args
+        _log_job_start("interfaces", job_info, affecting_intervals)
+
+        parent_entity_id = job_info["entity_id"]
+        # (change markers are fetched with a single GET, so unreachable devices don't need a separate probe)
+        if _device_breaker_state(parent_entity_id) == sharedstate.BREAKER_OPEN:
+            return
+        # fetch interfaces and update the interface entities (but only if something changed):
+        max_repetitions = _get_max_repetitions(job_info["credential_details"])
+        with snmp_sessions.checkout(job_info) as session, _device_health_tracking(parent_entity_id):
+            markers = _interfaces_change_markers(_snmp_get_multiple(session, INTERFACES_CHANGE_OIDS, SNMP_MAX_GET_VARBINDS))
+            if not SNMPBot._interfaces_need_sync(parent_entity_id, markers):
+                return
+            result_descr = _snmp_walk_cached(session, parent_entity_id, OID_IF_DESCR, max_repetitions)
+            result_speed = _snmp_walk_cached(session, parent_entity_id, OID_IF_SPEED, max_repetitions)
+
+        if SNMPBot._update_interface_entities(job_info, result_descr, result_speed):
+            SNMPBot._interfaces_synced(parent_entity_id, markers)
+
+    @staticmethod
+    @_instrumented_job('interfaces')
+    async def update_if_entities_async(snmp_engine, affecting_intervals, **job_info):
+        loop = asyncio.get_event_loop()
+        client = SNMPBot._create_async_snmp_client(snmp_engine, job_info)
+        if client is None:
+            # (the run is already recorded by this job, so the sync job is called without its instrumentation)
+            await loop.run_in_executor(None, lambda: SNMPBot.update_if_entities.__wrapped__(affecting_intervals, **job_info))
+            return
+
+        _log_job_start("interfaces", job_info, affecting_intervals)
+        parent_entity_id = job_info["entity_id"]
+        if await loop.run_in_executor(None, _device_breaker_state, parent_entity_id) == sharedstate.BREAKER_OPEN:
+            return
+        max_repetitions = _get_max_repetitions(job_info["credential_details"])
+
+        # calls to shared state block, so they are done in a thread (all of them at once where possible):
+        def cached_walks(markers):
+            if not SNMPBot._interfaces_need_sync(parent_entity_id, markers):
+                return None
+            return [_cached_walk_results(parent_entity_id, oid) for oid in [OID_IF_DESCR, OID_IF_SPEED]]
+
+        async def fetch():
+            markers = _interfaces_change_markers(await _snmp_get_multiple_async(client, INTERFACES_CHANGE_OIDS, SNMP_MAX_GET_VARBINDS))
+            cached = await loop.run_in_executor(None, cached_walks, markers)
+            if cached is None:
+                return markers, None
+            results = []
+            for oid, result in zip([OID_IF_DESCR, OID_IF_SPEED], cached):
+                if result is None:
+                    result = await _snmp_walk_async(client, oid, max_repetitions)
+                results.append(result)
+            return markers, results
+        markers, results = await _device_failures_tracked(parent_entity_id, fetch())
+
+        def update_entities():
+            _record_device_success(parent_entity_id)
+            if results is None:
+                return
+            if SNMPBot._update_interface_entities(job_info, *results):
+                SNMPBot._interfaces_synced(parent_entity_id, markers)
+        await loop.run_in_executor(None, update_entities)
+
+    @staticmethod
+    def _interfaces_need_sync(parent_entity_id, markers):
+        if sharedstate.interface_cache is None:
+            return True
+        if not _interfaces_changed(sharedstate.interface_cache.get_markers(parent_entity_id), markers, time.time()):
+            log.debug(f"Interfaces of entity {parent_entity_id} didn't change (ifNumber, ifTableLastChange, sysUpTime: {markers}), not walking them.")
+            return False
+        return True
 
-        session = SNMPBot._create_snmp_sesssion(job_info)
+    @staticmethod
+    def _interfaces_synced(parent_entity_id, markers):
+        if sharedstate.interface_cache is not None:
+            sharedstate.interface_cache.put_markers(parent_entity_id, markers)
 
+    @staticmethod
+    def _update_interface_entities(job_info, result_descr, result_speed):
+        """
+            Creates, updates and removes interface entities so that they match the walked interfaces.
+            Returns False if some of the changes failed.
+        """
         parent_entity_id = job_info["entity_id"]
         account_id = job_info["account_id"]
         backend_url = job_info['backend_url']
         bot_token = job_info['bot_token']
-        # fetch interfaces and update the interface entities:
-        result_descr = session.walk(OID_IF_DESCR)
-        result_speed = session.walk(OID_IF_SPEED)
-
-        # make sure that indexes of results are aligned - we don't want to have incorrect data:
-        if any([if_speed.oid_index != if_descr.oid_index for if_descr, if_speed in zip(result_descr, result_speed)]):
-            log.warning(f"Out-of-order results for interface names on entity {parent_entity_id}, sorting not yet implemented, bailing out!")
-            return
-
-        # - get those entities on this account, which have this entity as their parent and filter them by type ('interface')
-        requests_session = requests.Session()
-        url = f'{backend_url}/accounts/{account_id}/entities/?parent={parent_entity_id}&entity_type=interface&b={bot_token}'
-        r = requests_session.get(url)
-        r.raise_for_status()
-        # existing_entities = {x['details']['snmp_index']: (x['name'], x['details']['speed_bps'], x['id'],) for x in r.json()['list']}
-        # Temporary, until we implement filtering in API:
-        existing_entities = {x['details']['snmp_index']: (x['name'], x['details']['speed_bps'], x['id'],) for x in r.json()['list'] if x["entity_type"] == 'interface' and x["parent"] == parent_entity_id}
 
+        # make sure that speeds are matched with the correct interfaces, even if the agent returned them in a different order:
+        _, (result_descr, result_speed) = _align_walk_results([result_descr, result_speed], ['walk', 'walk'])
+        interfaces = []
         for if_descr_snmpvalue, if_speed_snmpvalue in zip(result_descr, result_speed):
-            oid_index = if_descr_snmpvalue.oid_index
-            descr = if_descr_snmpvalue.value
-            speed_bps = if_speed_snmpvalue.value
+            if if_speed_snmpvalue is None:
+                log.warning(f"Missing speed for interface {if_descr_snmpvalue.value} (OID index {if_descr_snmpvalue.oid_index}) on entity {parent_entity_id}")
+            speed_bps = if_speed_snmpvalue.value if if_speed_snmpvalue is not None else None
+            interfaces.append((if_descr_snmpvalue.oid_index, if_descr_snmpvalue.value, speed_bps))
+
+        # if interfaces didn't change since the last sync, there is nothing to do:
+        fingerprint = _interfaces_fingerprint(interfaces)
+        cached = sharedstate.interface_cache.get(parent_entity_id) if sharedstate.interface_cache is not None else None
+        if cached is not None and cached[0] == fingerprint:
+            log.debug(f"Interfaces of entity {parent_entity_id} didn't change.")
+            return True
+
+        requests_session = _get_backend_session()
+        if cached is not None:
+            existing_entities = dict(cached[1])
+        else:
+            # - get those entities on this account, which have this entity as their parent and filter them by type ('interface')
+            url = f'{backend_url}/accounts/{account_id}/entities/?parent={parent_entity_id}&entity_type=interface&b={bot_token}'
+            r = requests_session.get(url, timeout=INTERFACES_SYNC_TIMEOUT)
+            r.raise_for_status()
+            # existing_entities = {x['details']['snmp_index']: (x['name'], x['details']['speed_bps'], x['id'],) for x in r.json()['list']}
+            # Temporary, until we implement filtering in API:
+            existing_entities = {x['details']['snmp_index']: (x['name'], x['details']['speed_bps'], x['id'],) for x in r.json()['list'] if x["entity_type"] == 'interface' and x["parent"] == parent_entity_id}
+
+        synced_entities = {}
+        changes = []  # (oid_index, method, url, payload)
+        for oid_index, descr, speed_bps in interfaces:
+            payload = {
+                "name": descr,
+                "entity_type": "interface",
+                "details":{
+                    "snmp_index": oid_index,
+                    "speed_bps": speed_bps,
+                },
+            }
             # - for each new entity:
             #   - make sure it exists (if not, create it - POST)
             if oid_index not in existing_entities:
                 log.debug(f"Entity with OID index {oid_index} is new, inserting.")
                 url = f'{backend_url}/accounts/{account_id}/entities/?b={bot_token}'
-                payload = {
-                    "name": descr,
-                    "entity_type": "interface",
-                    "parent": parent_entity_id,
-                    "details":{
-                        "snmp_index": oid_index,
-                        "speed_bps": speed_bps,
-                    },
-                }
-                r = requests_session.post(url, json=payload)
+                changes.append((oid_index, 'post', url, {**payload, "parent": parent_entity_id}))
                 continue
 
             #   - make sure the description and speed are correct (if not, update them - PUT)
-            existing_descr, existing_speed, existing_id = existing_entities[oid_index]
+            #     (changing entity parent is not possible)
+            existing_descr, existing_speed, existing_id = existing_entities.pop(oid_index)
+            synced_entities[oid_index] = (descr, speed_bps, existing_id)
             if existing_descr != descr or existing_speed != speed_bps:
                 log.debug(f"Entity with OID index {oid_index} changed data, updating.")
                 url = f'{backend_url}/accounts/{account_id}/entities/{existing_id}/?b={bot_token}'
-                payload = {
-                    "name": descr,
-                    "entity_type": "interface",
-                    # "parent": parent_entity_id,  # changing entity parent is not possible
-                    "details":{
-                        "snmp_index": oid_index,
-                        "speed_bps": speed_bps,
-                    },
-                }
-                r = requests_session.put(url, json=payload)
-                del existing_entities[oid_index]
+                changes.append((oid_index, 'put', url, payload))
                 continue
 
-            #   - mark it as processed
             log.debug(f"Entity with OID index {oid_index} didn't change.")
-            del existing_entities[oid_index]
 
         # - for every existing entity that is not among the new ones, remove it (no point in keeping it - we don't keep old versions of enities data either)
-        for oid_index in existing_entities:
-            _, _, existing_id = existing_entities[oid_index]
+        for oid_index, (_, _, existing_id) in existing_entities.items():
             log.debug(f"Entity with OID index {oid_index} no longer exists, removing.")
             url = f'{backend_url}/accounts/{account_id}/entities/{existing_id}/?b={bot_token}'
-            r = requests_session.delete(url)
+            changes.append((oid_index, 'delete', url, None))
+
+        # the changes are independent of each other, so they can be sent concurrently:
+        all_ok = True
+        if changes:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(changes), INTERFACES_SYNC_CONCURRENCY)) as executor:
+                futures = [executor.submit(_send_entity_change, requests_session, method, url, payload) for _, method, url, payload in changes]
+            for (oid_index, method, _, payload), future in zip(changes, futures):
+                try:
+                    response = future.result()
+                except Exception as ex:
+                    log.error(f"Error syncing interface entity with OID index {oid_index} of entity {parent_entity_id}: {ex}")
+                    all_ok = False
+                    continue
+                if method == 'post':
+                    entity_id = response.get('id') if isinstance(response, dict) else None
+                    if entity_id is None:
+                        all_ok = False
+                        continue
+                    synced_entities[oid_index] = (payload["name"], payload["details"]["speed_bps"], entity_id)
+
+        # remember the result, unless we are not sure what the entities on backend look like:
+        if sharedstate.interface_cache is not None:
+            if all_ok:
+                sharedstate.interface_cache.put(parent_entity_id, fingerprint, synced_entities)
+            else:
+                sharedstate.interface_cache.invalidate(parent_entity_id)
+        return all_ok
+
+    def execute(self):
+        if SNMP_BACKEND == 'asyncio':
+            try:
+                asyncio.get_event_loop().run_until_complete(self.execute_async())
+            except KeyboardInterrupt:
+                log.info("Got exit signal, exiting.")
+        else:
+            self.execute_pool()
 
+    def execute_pool(self):
+        """
+            Same as `Collector.execute()`, except that the number of worker processes can be
+            configured. Blocking.
+        """
+        job_defaults = {
+            'coalesce': True,  # if multiple jobs "misfire", re-run only one instance of a missed job
+            'max_instances': 100,
+        }
+        self.scheduler = BackgroundScheduler(job_defaults=job_defaults, timezone=utc)
+        self.scheduler.add_executor(IntervalsAwareProcessPoolExecutor(SNMP_WORKERS), 'iaexecutor')
+        try:
+            self.scheduler.start()
+            while True:
+                try:
+                    self.refresh_jobs()
+                except:
+                    log.exception("Error refreshing jobs.")
+                time.sleep(self.jobs_refresh_interval)
+        except KeyboardInterrupt:
+            log.info("Got exit signal, exiting.")
+        finally:
+            self.scheduler.shutdown()
+
+    async def execute_async(self):
+        """
+            Alternative to `Collector.execute()`, which runs all the jobs in a single event loop
+            (instead of in a pool of worker processes). Blocking.
+        """
+        loop = asyncio.get_event_loop()
+        loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(ASYNC_WORKER_THREADS))
+        snmp_engine = await asyncsnmp.create_engine()
+        semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENT_JOBS)
+        async_job_funcs = {
+            SNMPBot.do_snmp: SNMPBot.do_snmp_async,
+            SNMPBot.update_if_entities: SNMPBot.update_if_entities_async,
+        }
+        running_jobs = {}  # job_id -> (job_data, task)
+        while True:
+            try:
+                wanted_jobs = await loop.run_in_executor(None, lambda: list(self.jobs()))
+            except:
+                log.exception("Error refreshing jobs.")
+                wanted_jobs = None
+
+            if wanted_jobs is not None:
+                wanted_job_ids = set()
+                for job_id, intervals, job_func, job_data, start_ts in wanted_jobs:
+                    wanted_job_ids.add(job_id)
+                    # if the existing job's configuration is the same, leave it alone, otherwise the trigger will be reset:
+                    if job_id in running_jobs:
+                        if running_jobs[job_id][0] == job_data:
+                            continue
+                        running_jobs[job_id][1].cancel()
+                    log.info(f"Adding job: {job_id}")
+                    try:
+                        trigger = MultipleIntervalsTrigger(intervals, start_ts=start_ts)
+                    except Exception:
+                        log.exception(f"Invalid job {job_id}, skipping it")
+                        running_jobs.pop(job_id, None)
+                        continue
+                    task = asyncio.ensure_future(SNMPBot._run_job_periodically(job_id, trigger, async_job_funcs[job_func], job_data, snmp_engine, semaphore))
+                    running_jobs[job_id] = (job_data, task)
+
+                # remove any jobs that are currently running but are no longer wanted:
+                for job_id in set(running_jobs.keys()) - wanted_job_ids:
+                    running_jobs[job_id][1].cancel()
+                    del running_jobs[job_id]
+
+            await asyncio.sleep(self.jobs_refresh_interval)
+
+    @staticmethod
+    async def _run_job_periodically(job_id, trigger, job_func, job_data, snmp_engine, semaphore):
+        last_fire_ts = 0
+        while True:
+            # make sure that we never fire twice for the same time, even if we wake up a bit too soon:
+            now = max(time.time(), last_fire_ts + 0.001)
+            next_fire_ts = trigger.get_next_fire_time(None, datetime.fromtimestamp(now, tz=utc)).timestamp()
+            await asyncio.sleep(max(0, next_fire_ts - time.time()))
+            last_fire_ts = next_fire_ts
+            affecting_intervals = trigger.affecting_intervals[next_fire_ts]
+            async with semaphore:
+                try:
+                    await job_func(snmp_engine, affecting_intervals, **job_data)
+                except asyncio.CancelledError:
+                    raise
+                except:
+                    log.exception(f'Job "{job_id}" raised an exception')
 
     def jobs(self):
         """
             Each entity (device) is a single job, no matter how many sensors it has. The reason is
             that when the intervals align, we can then issue a single SNMP Bulk GET/WALK.
+
+            Jobs are spread over their intervals (see `_job_phase_offset()`) by passing `start_ts`
+            to the trigger. If entities are sharded, only the jobs of this shard are returned.
         """
+        counter_ident_prefixes = set()
         for entity_info in self.fetch_job_configs('snmp'):
+            if not sharding.entity_in_shard(entity_info["entity_id"], self.shard_index, self.shard_count):
+                continue
+            entity_info["sensors"] = [sensor_info for sensor_info in entity_info["sensors"] if _is_sensor_valid(entity_info["entity_id"], sensor_info)]
+            counter_ident_prefixes.update([_counter_ident_prefix(entity_info["entity_id"], sensor_info["sensor_id"]) for sensor_info in entity_info["sensors"]])
             intervals = list(set([sensor_info["interval"] for sensor_info in entity_info["sensors"]]))
             job_info = { **entity_info, "backend_url": self.backend_url, "bot_token": self.bot_token }
-            job_id = f'{entity_info["entity_id"]}'
-            yield job_id, intervals, SNMPBot.do_snmp, job_info
+            # if none of the sensors are valid, there is nothing to poll (but interfaces are still synced):
+            if intervals:
+                job_id = f'{entity_info["entity_id"]}'
+                phase_offset = _job_phase_offset(job_id, intervals)
+                yield job_id, intervals, SNMPBot.do_snmp, { **job_info, "phase_offset": phase_offset }, phase_offset
 
             # We also collect interface data from each entity; the assumption is that everyone who wants
             # to use SNMP also wants to know about network interfaces.
             # Since `job_info` has all the necessary data, we simply pass it along:
             job_id = f'{entity_info["entity_id"]}-interfaces'
-            yield job_id, [5*60], SNMPBot.update_if_entities, job_info
+            phase_offset = _job_phase_offset(job_id, [INTERFACES_CHECK_INTERVAL])
+            yield job_id, [INTERFACES_CHECK_INTERVAL], SNMPBot.update_if_entities, { **job_info, "phase_offset": phase_offset }, phase_offset
+
+        # counters of sensors which are no longer active are not needed anymore:
+        if sharedstate.counter_store is not None:
+            sharedstate.counter_store.retain(counter_ident_prefixes)
 
 
 def wait_for_grafolean(backend_url):
@@ -444,6 +1545,98 @@ def wait_for_grafolean(backend_url):
         time.sleep(10)
 
 
+def _add_metrics_callbacks(collector):
+    """
+        Gauges and counters which are read (in the main process) whenever the metrics are requested.
+    """
+    collector.add_gauge('snmpbot_workers', lambda: {(): ASYNC_MAX_CONCURRENT_JOBS if SNMP_BACKEND == 'asyncio' else SNMP_WORKERS})
+    if valuesender.sender is not None:
+        collector.add_gauge('snmpbot_send_queue_depth', lambda: {(): valuesender.sender.queue_depth() or 0})
+        collector.add_counter('snmpbot_sender_values_total', lambda: {(('result', k),): valuesender.sender.stats[k] for k in ['sent', 'dropped', 'spooled', 'replayed']})
+    if sharedstate.device_health is not None:
+        collector.add_gauge('snmpbot_unreachable_devices', lambda: {(): len(sharedstate.device_health.open_breakers())})
+    collector.add_gauge('snmpbot_db_connections', lambda: {
+        (('process', process), ('state', state)): stats[state] for process, stats in _db_pool_stats().items() for state in ['in_use', 'idle']
+    })
+    collector.add_counter('snmpbot_db_pool_events_total', lambda: {
+        (('event', event), ('process', process)): stats[event] for process, stats in _db_pool_stats().items() for event in ['checkouts', 'waits', 'timeouts', 'connects', 'replaced']
+    })
+    collector.add_counter('snmpbot_db_pool_wait_seconds_total', lambda: {(('process', process),): stats['wait_time'] for process, stats in _db_pool_stats().items()})
+
+
+def _db_pool_stats():
+    """
+        Returns the stats of the DB connection pools of the main and shared state processes (the
+        ones which are connected).
+    """
+    pools_stats = {'main': get_db_pool_stats()}
+    if sharedstate.db_pool_stats is not None:
+        pools_stats['shared_state'] = sharedstate.db_pool_stats.get()
+    return {process: stats for process, stats in pools_stats.items() if stats is not None}
+
+
+def start_services(shard_index, shard_count, metrics_port=0):
+    """
+        Starts everything that the jobs need besides the worker pool. Must be called before the
+        workers are forked. Returns the shared state manager (which is shut down when it is
+        garbage collected, so the caller must keep the reference to it).
+    """
+    counters_flush_interval = int(os.environ.get('COUNTERS_FLUSH_INTERVAL', 30))
+    counters_ttl = int(os.environ.get('COUNTERS_TTL', 7 * 24 * 3600))
+    walk_cache_ttl = int(os.environ.get('WALK_CACHE_TTL', 0))
+    interface_cache_ttl = int(os.environ.get('INTERFACE_CACHE_TTL', 3600))
+    breaker_threshold = int(os.environ.get('SNMP_BREAKER_THRESHOLD', 3))
+    breaker_min_backoff = int(os.environ.get('SNMP_BREAKER_MIN_BACKOFF', 30))
+    breaker_max_backoff = int(os.environ.get('SNMP_BREAKER_MAX_BACKOFF', 600))
+    send_flush_interval_ms = int(os.environ.get('SEND_FLUSH_INTERVAL_MS', 500))
+    send_max_batch_size = int(os.environ.get('SEND_MAX_BATCH_SIZE', 5000))
+    send_queue_size = int(os.environ.get('SEND_QUEUE_SIZE', 10000))
+    send_compress = os.environ.get('SEND_COMPRESS', 'false').lower() in ['true', 'yes', '1']
+    spool_max_values = int(os.environ.get('SPOOL_MAX_VALUES', 1000000))
+    spool_max_age = int(os.environ.get('SPOOL_MAX_AGE', 24 * 3600))
+
+    # counter values are kept in memory (shared by all workers) and only periodically written to DB,
+    # recent walk results of interface OIDs are shared with the interfaces job, and values which
+    # could not be sent to Grafolean are spooled to DB; interfaces and health of devices are tracked
+    # across jobs (keep the reference to manager, otherwise the process is shut down):
+    shared_state_manager = sharedstate.start_shared_state(counters_flush_interval, walk_cache_ttl, spool_max_values, spool_max_age, interface_cache_ttl,
+                                                          breaker_threshold, breaker_min_backoff, breaker_max_backoff, shard_index, shard_count, counters_ttl)
+
+    # values of all jobs are merged and sent in batches:
+    if send_flush_interval_ms > 0:
+        valuesender.start_values_sender(send_flush_interval_ms / 1000., send_max_batch_size, send_queue_size, send_compress, sharedstate.values_spool)
+
+    # metrics of all the workers are collected and served by this process:
+    if metrics_port > 0:
+        _add_metrics_callbacks(metrics.start_metrics(metrics_port))
+    return shared_state_manager
+
+
+def stop_services():
+    """
+        Sends the values which are still waiting and persists the counters.
+    """
+    if metrics.collector is not None:
+        metrics.collector.stop()
+    if valuesender.sender is not None:
+        valuesender.sender.stop()
+    if sharedstate.counter_store is not None:
+        sharedstate.counter_store.flush()
+
+
+def run_bot(backend_url, bot_token, shard_index, shard_count, metrics_port=0):
+    """
+        Runs the bot for a single shard of entities. Blocking.
+    """
+    jobs_refresh_interval = int(os.environ.get('JOBS_REFRESH_INTERVAL', 120))
+    shared_state_manager = start_services(shard_index, shard_count, metrics_port)
+    try:
+        c = SNMPBot(backend_url, bot_token, jobs_refresh_interval, shard_index, shard_count)
+        c.execute()
+    finally:
+        stop_services()
+
+
 if __name__ == "__main__":
     dotenv.load_dotenv()
 
@@ -452,8 +1645,6 @@ if __name__ == "__main__":
     db_disconnect()  # each worker should open their own connection pool
 
     backend_url = os.environ.get('BACKEND_URL')
-    jobs_refresh_interval = int(os.environ.get('JOBS_REFRESH_INTERVAL', 120))
-
     if not backend_url:
         raise Exception("Please specify BACKEND_URL and BOT_TOKEN / BOT_TOKEN_FROM_FILE env vars.")
 
@@ -470,5 +1661,17 @@ if __name__ == "__main__":
     if not bot_token:
         raise Exception("Please specify BOT_TOKEN / BOT_TOKEN_FROM_FILE env var.")
 
-    c = SNMPBot(backend_url, bot_token, jobs_refresh_interval)
-    c.execute()
+    shard_index = int(os.environ.get('SHARD_INDEX', 0))
+    shard_count = int(os.environ.get('SHARD_COUNT', 1))
+    n_processes = int(os.environ.get('SNMPBOT_PROCESSES', 1))
+    metrics_port = int(os.environ.get('METRICS_PORT', 0))
+    if n_processes > 1:
+        # each process is a separate shard (with its own worker pool, shared state, sender and metrics port):
+        def run_shard(i, n):
+            local_index = (i - shard_index) // shard_count
+            run_bot(backend_url, bot_token, i, n, metrics_port + local_index if metrics_port > 0 else 0)
+        sharding.run_sharded(sharding.local_shards(shard_index, shard_count, n_processes), run_shard)
+    else:
+        # the services must be stopped cleanly (counters flushed and queued values sent) also on SIGTERM:
+        sharding.stop_on_sigterm()
+        run_bot(backend_url, bot_token, shard_index, shard_count, metrics_port)
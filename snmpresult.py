@@ -0,0 +1,39 @@
+class SNMPResult(object):
+    """
+        Lightweight replacement for easysnmp's `SNMPVariable`, used for all the results once they
+        are fetched. Unlike `SNMPVariable` it doesn't have a `__dict__` and it doesn't convert
+        values to strings, so calculated values (like counter rates) can stay numeric.
+
+        Comparison works the same as with `SNMPVariable` (values are compared as strings), and
+        instances can be compared to `SNMPVariable`s too.
+    """
+    __slots__ = ('oid', 'oid_index', 'value', 'snmp_type')
+
+    def __init__(self, oid, oid_index, value, snmp_type):
+        self.oid = oid
+        self.oid_index = oid_index
+        self.value = value
+        self.snmp_type = snmp_type
+
+    @classmethod
+    def from_snmp_variable(cls, v):
+        return cls(v.oid, v.oid_index, v.value, v.snmp_type)
+
+    def __eq__(self, other):
+        try:
+            return (self.oid, self.oid_index, _tostr(self.value), self.snmp_type) == (other.oid, other.oid_index, _tostr(other.value), other.snmp_type)
+        except AttributeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return f"<SNMPResult value='{self.value}' (oid='{self.oid}', oid_index='{self.oid_index}', snmp_type='{self.snmp_type}')>"
+
+    def __getstate__(self):
+        return (self.oid, self.oid_index, self.value, self.snmp_type)
+
+    def __setstate__(self, state):
+        self.oid, self.oid_index, self.value, self.snmp_type = state
+
+
+def _tostr(value):
+    return value if value is None or isinstance(value, str) else str(value)
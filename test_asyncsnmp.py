@@ -0,0 +1,45 @@
+import pytest
+
+from asyncsnmp import encode_message, decode_message, VarBind, SNMPDecodeError, PDU_GET, PDU_RESPONSE, SNMP_VERSION_1, SNMP_VERSION_2C
+
+
+def test_encode_get_request():
+    """ GET request for sysUpTime.0, byte for byte """
+    expected = bytes.fromhex('3026' '020101' '0406' + 'public'.encode().hex() + 'a019' '020101' '020100' '020100' '300e' '300c' '06082b06010201010300' '0500')
+    assert encode_message(SNMP_VERSION_2C, 'public', PDU_GET, 1, 0, 0, [('1.3.6.1.2.1.1.3.0', 'NULL', None)]) == expected
+
+
+@pytest.mark.parametrize("varbind", [
+    VarBind('1.3.6.1.2.1.1.3.0', 'TICKS', '123456'),
+    VarBind('1.3.6.1.2.1.1.9.0', 'INTEGER', '-129'),
+    VarBind('1.3.6.1.2.1.1.5.0', 'OCTETSTR', 'Core switch 1'),
+    VarBind('1.3.6.1.2.1.1.2.0', 'OBJECTID', '.1.3.6.1.4.1.8072.3.2.10'),
+    VarBind('1.3.6.1.2.1.4.20.1.1.10.0.0.1', 'IPADDR', '10.0.0.1'),
+    VarBind('1.3.6.1.2.1.2.2.1.10.1', 'COUNTER', '4294967295'),
+    VarBind('1.3.6.1.2.1.2.2.1.5.1', 'GAUGE', '1000000000'),
+    VarBind('1.3.6.1.2.1.31.1.1.1.6.1', 'COUNTER64', '18446744073709551615'),
+    VarBind('1.3.6.1.2.1.99.0', 'NOSUCHOBJECT', None),
+    VarBind('1.3.6.1.2.1.99.0.0', 'NOSUCHINSTANCE', None),
+    VarBind('1.3.6.1.2.1.999999.0', 'ENDOFMIBVIEW', None),
+])
+def test_encode_decode_response(varbind):
+    data = encode_message(SNMP_VERSION_1, 'secret', PDU_RESPONSE, 1234567, 0, 0, [varbind])
+    message = decode_message(data)
+    assert message.version == SNMP_VERSION_1
+    assert message.community == 'secret'
+    assert message.pdu_type == PDU_RESPONSE
+    assert message.request_id == 1234567
+    assert message.varbinds == [varbind]
+
+
+def test_decode_long_message():
+    """ Messages longer than 127 bytes use the long form of length """
+    varbinds = [VarBind(f'1.3.6.1.2.1.2.2.1.2.{i}', 'OCTETSTR', f'GigabitEthernet0/{i}') for i in range(50)]
+    data = encode_message(SNMP_VERSION_2C, 'public', PDU_RESPONSE, 42, 0, 0, varbinds)
+    assert decode_message(data).varbinds == varbinds
+
+
+def test_decode_truncated_message():
+    data = encode_message(SNMP_VERSION_2C, 'public', PDU_RESPONSE, 42, 0, 0, [VarBind('1.3.6.1.2.1.1.3.0', 'TICKS', '1')])
+    with pytest.raises(SNMPDecodeError):
+        decode_message(data[:-3])
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+import asyncsnmp
+from benchmark import SimulatedAgent, FakeBackend, FIRST_DEVICE_ID, SENSORS
+
+
+@pytest.mark.parametrize("version,max_repetitions,n_requests", [
+    (asyncsnmp.SNMP_VERSION_2C, 25, 1 + 2),
+    (asyncsnmp.SNMP_VERSION_2C, 0, 1 + 31),
+    (asyncsnmp.SNMP_VERSION_1, 0, 1 + 31),
+])
+def test_simulated_agent(version, max_repetitions, n_requests):
+    loop = asyncio.new_event_loop()
+    try:
+        transport, agent = loop.run_until_complete(loop.create_datagram_endpoint(lambda: SimulatedAgent(3, 30), local_addr=('127.0.0.1', 0)))
+        port = transport.get_extra_info('sockname')[1]
+
+        async def poll():
+            engine = await asyncsnmp.create_engine()
+            client = asyncsnmp.SNMPClient(engine, '127.0.0.1', 'device2', version, port, timeout=1, retries=0)
+            get_results = await client.get(['1.3.6.1.2.1.2.1.0', '1.3.6.1.2.1.2.2.1.2.30'])
+            walk_results = await client.walk('1.3.6.1.2.1.2.2.1.10', max_repetitions)
+            # unknown communities are not answered:
+            with pytest.raises(asyncsnmp.SNMPTimeoutError):
+                await asyncsnmp.SNMPClient(engine, '127.0.0.1', 'device3', version, port, timeout=0.1, retries=0).get(['1.3.6.1.2.1.2.1.0'])
+            engine.transport.close()
+            return get_results, walk_results
+
+        get_results, walk_results = loop.run_until_complete(poll())
+        transport.close()
+    finally:
+        loop.close()
+
+    assert [(v.oid, v.snmp_type, v.value) for v in get_results] == [('1.3.6.1.2.1.2.1.0', 'INTEGER', '30'), ('1.3.6.1.2.1.2.2.1.2.30', 'OCTETSTR', 'eth29')]
+    assert [v.oid for v in walk_results] == [f'1.3.6.1.2.1.2.2.1.10.{i}' for i in range(1, 31)]
+    assert all(v.snmp_type == 'COUNTER' for v in walk_results)
+    assert agent.stats["snmp_requests"] == n_requests
+
+
+def test_fake_backend():
+    backend = FakeBackend(2)
+    assert backend.handle('GET', '/accounts/1/entities/', {}, None) == (200, {"list": [{"id": FIRST_DEVICE_ID, "entity_type": "device"}, {"id": FIRST_DEVICE_ID + 1, "entity_type": "device"}]})
+    status, device = backend.handle('GET', f'/accounts/1/entities/{FIRST_DEVICE_ID + 1}', {}, None)
+    assert device["protocols"]["snmp"]["credential"] == FIRST_DEVICE_ID + 1
+    assert backend.handle('GET', f'/accounts/1/credentials/{FIRST_DEVICE_ID + 1}', {}, None)[1]["details"]["snmpv12_community"] == 'device1'
+    assert backend.handle('GET', '/accounts/1/sensors/2', {}, None)[1]["details"] == SENSORS[2]
+
+    interface = {"name": "eth0", "entity_type": "interface", "parent": FIRST_DEVICE_ID, "details": {"snmp_index": "1", "speed_bps": "1000"}}
+    status, created = backend.handle('POST', '/accounts/1/entities/', {}, interface)
+    assert status == 201
+    assert backend.handle('GET', '/accounts/1/entities/', {"parent": [str(FIRST_DEVICE_ID)]}, None) == (200, {"list": [{**interface, "id": created["id"]}]})
+    assert backend.handle('GET', '/accounts/1/entities/', {"parent": [str(FIRST_DEVICE_ID + 1)]}, None) == (200, {"list": []})
+    assert backend.handle('DELETE', f'/accounts/1/entities/{created["id"]}/', {}, None)[0] == 204
+
+    assert backend.handle('POST', '/accounts/1/values/', {}, [{"p": "a", "v": 1}, {"p": "b", "v": 2}])[0] == 200
+    assert backend.stats["values"] == 2
+    assert backend.stats["entity_changes"] == 2
@@ -0,0 +1,70 @@
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+import pytest
+
+import dbutils
+from dbutils import DBPool, DBConnectionError
+
+
+class FakeConnection(object):
+    def __init__(self, n):
+        self.n = n
+        self.closed = 0
+
+    def get_transaction_status(self):
+        return TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    connections = []
+    def connect(**kwargs):
+        connections.append(FakeConnection(len(connections)))
+        return connections[-1]
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    return connections
+
+
+def test_db_pool_waits_for_connection(connections):
+    pool = DBPool(1, 2, 0.05)
+    conn1, conn2 = pool.getconn(), pool.getconn()
+    assert len(connections) == 2
+
+    # pool is exhausted - checkout times out instead of raising PoolError immediately:
+    with pytest.raises(DBConnectionError):
+        pool.getconn()
+
+    # ...or waits for a connection to be returned:
+    pool.timeout = 5
+    threading.Timer(0.1, lambda: pool.putconn(conn1)).start()
+    assert pool.getconn() is conn1
+    stats = pool.get_stats()
+    assert stats["timeouts"] == 1
+    assert stats["in_use"] == 2
+    assert stats["max_wait_time"] >= 0.05
+
+
+def test_db_pool_replaces_broken_connections(connections):
+    pool = DBPool(2, 2, 1)
+    conn1 = pool.getconn()
+    conn2 = pool.getconn()
+    pool.putconn(conn1)
+    pool.putconn(conn2)
+
+    # a broken connection is replaced, others are kept:
+    conn2.closed = 2
+    conn = pool.getconn()
+    assert conn.n == 2
+    assert pool.getconn() is conn1
+    assert pool.get_stats()["replaced"] == 1
+
+    # connections which failed while being used are not returned to the pool:
+    pool.putconn(conn1, close=True)
+    assert conn1.closed
+    assert pool.getconn().n == 3
@@ -0,0 +1,80 @@
+import pytest
+from mathjspy import MathJS
+import numpy as np
+
+from expressions import compile_expression, ExpressionError
+
+
+@pytest.mark.parametrize("expression", [
+    '$1',
+    '$1 + $2',
+    '$1 * 8 / 1000',
+    '($1 + $2) * 100 / $3',
+    '$1 - $2 - $3',
+    '$1 ^ 2 % 7',
+    'max($1, $2)',
+    'min($1, $2, 3)',
+    'round($1 / 3)',
+    '$1 > $2',
+    'ifElse($1 > $2, $1, $2)',
+    '$1 ? $2 : $3',
+    'pi * $1',
+    '$1 / 0',
+    '($1 * 8) / ($2 - $3)',
+])
+@pytest.mark.parametrize("values", [
+    [0., 0., 0.],
+    [1., 2., 3.],
+    [123456.7, 3.14, 1000.],
+    [-5., 17., 1.],
+])
+def test_compiled_expression_same_as_mathjs(expression, values):
+    mjs = MathJS()
+    for i, v in enumerate(values):
+        mjs.set(f'${i + 1}', v)
+    assert compile_expression(expression)(values) == mjs.eval(expression)
+
+
+@pytest.mark.parametrize("expression,vectorized", [
+    ('$1 * 8 / 1000', True),
+    ('($1 + $2) * 100 / $3', True),
+    ('div($1, $2) - 5', True),
+    ('max($1, $2)', False),
+    ('$1 > $2', False),
+    ('5 * 8', False),
+])
+def test_compiled_expression_columns(expression, vectorized):
+    compiled_expression = compile_expression(expression)
+    if not vectorized:
+        assert compiled_expression.evaluate_columns is None
+        return
+    rows = [[0., 0., 0.], [1., 2., 3.], [123456.7, 3.14, 1000.], [-5., 17., 0.]]
+    columns = [np.array(column) for column in zip(*rows)]
+    assert compiled_expression.evaluate_columns(columns).tolist() == [compiled_expression(row) for row in rows]
+
+
+def test_compiled_expression_variable_indexes():
+    assert compile_expression('($1 + $3) / 8').variable_indexes == {0, 2}
+    assert compile_expression('e').variable_indexes == set()
+
+
+@pytest.mark.parametrize("expression", [
+    '-$1',
+    '$1 +',
+    'foo($1)',
+    '$x * 2',
+    '',
+    '()',
+    '$1)',
+    '$1 $2',
+    '$1, $2',
+    'sqrt $1',
+    'ifElse($1)',
+    'pow($1)',
+    'max()',
+    'max($1,)',
+    'log($1, 2, 3)',
+])
+def test_compile_invalid_expression(expression):
+    with pytest.raises(ExpressionError):
+        compile_expression(expression)
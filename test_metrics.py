@@ -0,0 +1,57 @@
+import multiprocessing
+import time
+import urllib.request
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def collector(monkeypatch):
+    monkeypatch.setattr(metrics, 'collector', None)
+    collector = metrics.start_metrics(0)
+    yield collector
+    collector.stop()
+
+
+def worker():
+    metrics.inc('snmpbot_snmp_varbinds_total', 20, entity_id=1)
+    metrics.observe('snmpbot_snmp_request_seconds', 0.03, entity_id=1, operation='get')
+    metrics.push()
+
+
+def test_metrics_from_workers(collector):
+    metrics.observe('snmpbot_send_seconds', 0.2)  # main process
+    for _ in range(2):
+        p = multiprocessing.get_context('fork').Process(target=worker)
+        p.start()
+        p.join()
+    collector.add_gauge('snmpbot_workers', lambda: {(): 10})
+    collector.add_counter('snmpbot_sender_values_total', lambda: {(('result', 'sent'),): 7})
+
+    for _ in range(100):
+        if collector.registry.counters:
+            break
+        time.sleep(0.01)
+    time.sleep(0.05)
+    url = f'http://127.0.0.1:{collector.server.server_address[1]}/metrics'
+    lines = urllib.request.urlopen(url).read().decode('utf-8').splitlines()
+    assert 'snmpbot_snmp_varbinds_total{entity_id="1"} 40' in lines
+    assert 'snmpbot_snmp_request_seconds_bucket{entity_id="1",operation="get",le="0.025"} 0' in lines
+    assert 'snmpbot_snmp_request_seconds_bucket{entity_id="1",operation="get",le="0.05"} 2' in lines
+    assert 'snmpbot_snmp_request_seconds_bucket{entity_id="1",operation="get",le="+Inf"} 2' in lines
+    assert 'snmpbot_snmp_request_seconds_count{entity_id="1",operation="get"} 2' in lines
+    assert 'snmpbot_send_seconds_count 1' in lines
+    assert 'snmpbot_workers 10' in lines
+    assert '# TYPE snmpbot_sender_values_total counter' in lines
+    assert 'snmpbot_sender_values_total{result="sent"} 7' in lines
+    assert lines.count('# TYPE snmpbot_snmp_request_seconds histogram') == 1
+
+
+def test_metrics_disabled(monkeypatch):
+    monkeypatch.setattr(metrics, 'collector', None)
+    metrics.inc('snmpbot_jobs_total', job='snmp')
+    with metrics.timer('snmpbot_send_seconds'):
+        pass
+    metrics.push()
@@ -0,0 +1,39 @@
+import os
+import signal
+import time
+
+import pytest
+
+from sharding import entity_shard, entity_in_shard, local_shards, stop_on_sigterm
+
+
+def test_entity_in_shard():
+    entity_ids = list(range(1, 10001))
+    shards = [[e for e in entity_ids if entity_in_shard(e, i, 4)] for i in range(4)]
+    # each entity is in exactly one shard, and shards are (roughly) equally big:
+    assert sorted(sum(shards, [])) == entity_ids
+    assert all(2300 < len(shard) < 2700 for shard in shards)
+    # entity ids can be either ints or strings (as in counter idents):
+    assert all(entity_in_shard(str(e), 1, 4) for e in shards[1])
+    assert all(entity_in_shard(e, 0, 1) for e in entity_ids)
+
+
+def test_local_shards():
+    """ Processes of a bot instance handle exactly the entities of its shard """
+    assert local_shards(1, 3, 2) == [(1, 6), (4, 6)]
+    for entity_id in range(1, 1001):
+        instance_shard = entity_shard(entity_id, 3)
+        owners = [(i, local_index) for i in range(3) for local_index, (shard_index, shard_count) in enumerate(local_shards(i, 3, 4)) if entity_in_shard(entity_id, shard_index, shard_count)]
+        assert len(owners) == 1
+        assert owners[0][0] == instance_shard
+
+
+def test_stop_on_sigterm():
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    try:
+        stop_on_sigterm()
+        with pytest.raises(KeyboardInterrupt):
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(1)  # (signal handler is called before sleep ends)
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
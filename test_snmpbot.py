@@ -1,7 +1,21 @@
-from easysnmp import SNMPVariable
+import asyncio
+from datetime import datetime
+from easysnmp import SNMPVariable, EasySNMPError, EasySNMPTimeoutError
+from grafoleancollector.collector import MultipleIntervalsTrigger
+import logging
+import pickle
 import pytest
+from pytz import utc
+import threading
+import time
 
-from snmpbot import _apply_expression_to_results, _convert_counters_to_values, _construct_output_path
+import asyncsnmp
+from snmpresult import SNMPResult
+from counterstore import counter_key
+import metrics
+import sharedstate
+import snmpbot
+from snmpbot import _apply_expression_to_results, _convert_counters_to_values, _construct_output_path, _get_max_repetitions, SNMP_MAX_REPETITIONS, _snmp_get_multiple, SNMPSessionPool, SNMPBot, _is_sensor_valid, _calculate_counter_rates, _align_walk_results, _snmp_walk, _walk_max_rows, _interfaces_change_markers, _interfaces_changed, INTERFACES_MAX_STALENESS, _job_phase_offset, _schedule_drift
 
 
 def test_apply_expression_snmpget():
@@ -125,7 +139,7 @@ def test_convert_counters_no_counters_no_change():
             SNMPVariable(oid='1.3.6.1.4.1.2021.13.16.2.2.2', oid_index='2', value='10', snmp_type='GAUGE'),
         ],
     ]
-    assert _convert_counters_to_values(results, now, "ASDF/1234") == results
+    assert _convert_counters_to_values(results, now, "1/1234") == results
 
 def test_convert_counters_counter():
     """ First expression should be empty, next ones should work """
@@ -133,15 +147,15 @@ def test_convert_counters_counter():
 
     results_0 = [SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.16', oid_index='1', value='1000', snmp_type='COUNTER')]
     expected_0 = [SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.16', oid_index='1', value=None, snmp_type='COUNTER_PER_S')]
-    assert _convert_counters_to_values(results_0, now, "ASDF/1234") == expected_0
+    assert _convert_counters_to_values(results_0, now, "1/1234") == expected_0
 
     results_1 = [SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.16', oid_index='1', value='2000.0', snmp_type='COUNTER')]
     expected_1 = [SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.16', oid_index='1', value='1000.0', snmp_type='COUNTER_PER_S')]
-    assert _convert_counters_to_values(results_1, now + 1.0, "ASDF/1234") == expected_1
+    assert _convert_counters_to_values(results_1, now + 1.0, "1/1234") == expected_1
 
     results_2 = [SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.16', oid_index='1', value='2300.0', snmp_type='COUNTER')]
     expected_2 = [SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.16', oid_index='1', value='100.0', snmp_type='COUNTER_PER_S')]
-    assert _convert_counters_to_values(results_2, now + 1.0 + 3.0, "ASDF/1234") == expected_2
+    assert _convert_counters_to_values(results_2, now + 1.0 + 3.0, "1/1234") == expected_2
 
 def test_convert_counters_overflow():
     """ Counter overflow should cause value to be discarded """
@@ -149,19 +163,56 @@ def test_convert_counters_overflow():
 
     results_0 = [SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.17', oid_index='1', value='123000.0', snmp_type='COUNTER')]
     expected_0 = [SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.17', oid_index='1', value=None, snmp_type='COUNTER_PER_S')]
-    assert _convert_counters_to_values(results_0, now, "ASDF/1234") == expected_0
+    assert _convert_counters_to_values(results_0, now, "1/1234") == expected_0
 
     results_1 = [SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.17', oid_index='1', value='234000.0', snmp_type='COUNTER')]
     expected_1 = [SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.17', oid_index='1', value='111000.0', snmp_type='COUNTER_PER_S')]
-    assert _convert_counters_to_values(results_1, now + 1.0, "ASDF/1234") == expected_1
+    assert _convert_counters_to_values(results_1, now + 1.0, "1/1234") == expected_1
 
     results_2 = [SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.17', oid_index='1', value='1000.0', snmp_type='COUNTER')]
     expected_2 = [SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.17', oid_index='1', value=None, snmp_type='COUNTER_PER_S')]
-    assert _convert_counters_to_values(results_2, now + 1.0 + 3.0, "ASDF/1234") == expected_2
+    assert _convert_counters_to_values(results_2, now + 1.0 + 3.0, "1/1234") == expected_2
 
     results_3 = [SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.17', oid_index='1', value='2000.0', snmp_type='COUNTER')]
     expected_3 = [SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.17', oid_index='1', value='500.0', snmp_type='COUNTER_PER_S')]
-    assert _convert_counters_to_values(results_3, now + 1.0 + 3.0 + 2.0, "ASDF/1234") == expected_3
+    assert _convert_counters_to_values(results_3, now + 1.0 + 3.0 + 2.0, "1/1234") == expected_3
+
+
+def test_convert_counters_walk_and_get():
+    """ Counters from walks and gets are converted in the same pass, non-counters are left alone """
+    now = 1234567890.123456
+
+    results_0 = [
+        [
+            SNMPVariable(oid='.1.3.6.1.2.1.31.1.1.1.6', oid_index='1', value='1000', snmp_type='COUNTER64'),
+            SNMPVariable(oid='.1.3.6.1.2.1.31.1.1.1.6', oid_index='2', value='5000', snmp_type='COUNTER64'),
+        ],
+        SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.5', oid_index='1', value='100', snmp_type='GAUGE'),
+    ]
+    expected_0 = [
+        [
+            SNMPVariable(oid='.1.3.6.1.2.1.31.1.1.1.6', oid_index='1', value=None, snmp_type='COUNTER_PER_S'),
+            SNMPVariable(oid='.1.3.6.1.2.1.31.1.1.1.6', oid_index='2', value=None, snmp_type='COUNTER_PER_S'),
+        ],
+        SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.5', oid_index='1', value='100', snmp_type='GAUGE'),
+    ]
+    assert _convert_counters_to_values(results_0, now, "1/5678") == expected_0
+
+    results_1 = [
+        [
+            SNMPVariable(oid='.1.3.6.1.2.1.31.1.1.1.6', oid_index='1', value='3000', snmp_type='COUNTER64'),
+            SNMPVariable(oid='.1.3.6.1.2.1.31.1.1.1.6', oid_index='2', value='5500', snmp_type='COUNTER64'),
+        ],
+        SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.5', oid_index='1', value='100', snmp_type='GAUGE'),
+    ]
+    expected_1 = [
+        [
+            SNMPVariable(oid='.1.3.6.1.2.1.31.1.1.1.6', oid_index='1', value='1000.0', snmp_type='COUNTER_PER_S'),
+            SNMPVariable(oid='.1.3.6.1.2.1.31.1.1.1.6', oid_index='2', value='250.0', snmp_type='COUNTER_PER_S'),
+        ],
+        SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.5', oid_index='1', value='100', snmp_type='GAUGE'),
+    ]
+    assert _convert_counters_to_values(results_1, now + 2.0, "1/5678") == expected_1
 
 
 output_path_test_results_get = [
@@ -197,4 +248,554 @@ output_path_test_results_walk = [
     ('{$3}.{$index}', output_path_test_results_walk, '1', 'Core-3.1',),  # '.' gets replaced by '-'
 ])
 def test_construct_output_path(template, addressable_results, oid_index, expected):
-    assert expected == _construct_output_path(template, addressable_results, oid_index)
\ No newline at end of file
+    assert expected == _construct_output_path(template, addressable_results, oid_index)
+
+
+@pytest.mark.parametrize("credential_details,sensor_details,expected", [
+    ({"version": "snmpv2c"}, None, SNMP_MAX_REPETITIONS,),
+    ({"version": "snmpv2c"}, {"expression": "$1"}, SNMP_MAX_REPETITIONS,),
+    ({"version": "snmpv2c", "snmp_max_repetitions": 50}, {"expression": "$1"}, 50,),
+    ({"version": "snmpv2c", "snmp_max_repetitions": 50}, {"expression": "$1", "max_repetitions": "5"}, 5,),
+    ({"version": "snmpv2c"}, {"expression": "$1", "max_repetitions": 0}, 0,),
+])
+def test_get_max_repetitions(credential_details, sensor_details, expected):
+    assert expected == _get_max_repetitions(credential_details, sensor_details)
+
+
+
+class FakeGetSession(object):
+    """ Remembers the GET requests and refuses those which have more than `max_varbinds` OIDs """
+    def __init__(self, max_varbinds):
+        self.max_varbinds = max_varbinds
+        self.requests = []
+
+    def get(self, oids):
+        self.requests.append(oids)
+        if len(oids) > self.max_varbinds:
+            raise EasySNMPError('tooBig')
+        return [SNMPVariable(oid=oid, oid_index='0', value='1', snmp_type='GAUGE') for oid in oids]
+
+
+def test_snmp_get_multiple():
+    oids = [f'1.3.6.1.2.1.2.2.1.{i}.0' for i in range(7)]
+    session = FakeGetSession(10)
+    results = _snmp_get_multiple(session, oids, 3)
+    assert session.requests == [oids[0:3], oids[3:6], oids[6:7]]
+    assert list(results.keys()) == oids
+
+def test_snmp_get_multiple_too_big():
+    oids = [f'1.3.6.1.2.1.2.2.1.{i}.0' for i in range(4)]
+    session = FakeGetSession(2)
+    results = _snmp_get_multiple(session, oids, 4)
+    assert session.requests == [oids, oids[0:2], oids[2:4]]
+    assert list(results.keys()) == oids
+
+
+def test_snmp_session_pool(monkeypatch):
+    created = []
+    def create_session(job_info):
+        created.append(job_info["credential_details"]["snmpv12_community"])
+        return object()
+    monkeypatch.setattr(SNMPBot, '_create_snmp_sesssion', staticmethod(create_session))
+
+    pool = SNMPSessionPool(600)
+    job_info = {"details": {"ipv4": "10.0.0.1"}, "credential_details": {"version": "snmpv2c", "snmpv12_community": "public"}}
+    with pool.checkout(job_info) as session1:
+        with pool.checkout(job_info) as session2:
+            assert session1 is not session2  # sessions are not shared between concurrent jobs
+    with pool.checkout(job_info) as session3:
+        assert session3 in (session1, session2)
+    assert created == ['public', 'public']
+
+    # changed credentials invalidate the existing sessions:
+    job_info["credential_details"]["snmpv12_community"] = 'private'
+    with pool.checkout(job_info) as session4:
+        assert session4 not in (session1, session2)
+    assert created == ['public', 'public', 'private']
+
+    # sessions are not returned to the pool if an error occurred while using them:
+    with pytest.raises(EasySNMPError):
+        with pool.checkout(job_info) as session5:
+            raise EasySNMPError('timeout')
+    with pool.checkout(job_info) as session6:
+        assert session6 is not session5
+
+
+def test_snmp_session_pool_max_sessions(monkeypatch):
+    monkeypatch.setattr(SNMPBot, '_create_snmp_sesssion', staticmethod(lambda job_info: object()))
+    clock = [1000.]
+    monkeypatch.setattr(time, 'time', lambda: clock[0])
+    pool = SNMPSessionPool(600, 2)
+    sessions = {}
+    for host in ['10.0.0.1', '10.0.0.2', '10.0.0.1', '10.0.0.3']:
+        clock[0] += 1
+        with pool.checkout({"details": {"ipv4": host}, "credential_details": {"version": "snmpv2c", "snmpv12_community": "public"}}) as session:
+            sessions.setdefault(host, session)
+    # the least recently used session was dropped:
+    assert sorted(key[0] for key in pool.idle_sessions) == ['10.0.0.1', '10.0.0.3']
+    assert pool.idle_sessions[min(pool.idle_sessions)][0][1] is sessions['10.0.0.1']
+
+
+@pytest.mark.parametrize("expression,output_path,n_oids,expected", [
+    ("$1 * 8 / 1000", "uptime", 1, True),
+    ("($1 + $2) * 100 / $3", "if.{$4}.{$index}", 4, True),
+    ("$1 + $2", "uptime", 1, False),
+    ("-$1", "uptime", 1, False),
+    ("foo($1)", "uptime", 1, False),
+    ("$1", "if.{$2}", 1, False),
+    ("$1", "if.{$0}", 1, False),
+    ("$1", "if.{index}", 1, False),
+    ("$1", "if/uptime", 1, False),
+])
+def test_is_sensor_valid(expression, output_path, n_oids, expected):
+    sensor_info = {"sensor_id": 1, "sensor_details": {"expression": expression, "output_path": output_path, "oids": [{"oid": "1.3.6.1.2.1.1.3.0", "fetch_method": "get"}] * n_oids}}
+    assert _is_sensor_valid(1, sensor_info) == expected
+
+
+@pytest.mark.parametrize("expression", ['$1 * 8 / $2', 'ifElse($2 > 0, $1 * 8 / $2, 0)'])
+def test_apply_expression_snmpwalk_columns(expression):
+    """ Vectorized and row-by-row evaluation give the same results """
+    results = [
+        [
+            SNMPVariable(oid='1.3.6.1.2.1.2.2.1.10', oid_index='1', value='1000', snmp_type='COUNTER_PER_S'),
+            SNMPVariable(oid='1.3.6.1.2.1.2.2.1.10', oid_index='2', value=None, snmp_type='COUNTER_PER_S'),
+            SNMPVariable(oid='1.3.6.1.2.1.2.2.1.10', oid_index='3', value='300', snmp_type='COUNTER_PER_S'),
+            SNMPVariable(oid='1.3.6.1.2.1.2.2.1.10', oid_index='4', value='5', snmp_type='COUNTER_PER_S'),
+        ],
+        [
+            SNMPVariable(oid='1.3.6.1.2.1.2.2.1.5', oid_index='1', value='4', snmp_type='GAUGE'),
+            SNMPVariable(oid='1.3.6.1.2.1.2.2.1.5', oid_index='2', value='4', snmp_type='GAUGE'),
+            SNMPVariable(oid='1.3.6.1.2.1.2.2.1.5', oid_index='3', value='0', snmp_type='GAUGE'),
+        ],
+    ]
+    methods = ['walk', 'walk']
+    output_path = 'snmp.interfaces.{$index}'
+    expected_result = [
+        {'p': 'snmp.interfaces.1', 'v': 2000.},
+        {'p': 'snmp.interfaces.3', 'v': 0},
+    ]
+    assert _apply_expression_to_results(results, methods, expression, output_path) == expected_result
+
+
+def test_calculate_counter_rates():
+    now = 1234567890.123456
+    rates, overflows = _calculate_counter_rates(
+        [2**64 - 1, 5, 100],
+        [(2**64 - 1000, now - 3.), (10, now - 1.), (None, None)],
+        now,
+    )
+    assert rates == [333., None, None]
+    assert overflows == [False, True, False]
+
+
+def test_align_walk_results_out_of_order():
+    """ Walk results are joined by oid index, regardless of their order; missing values are None """
+    descr = [
+        SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.2', oid_index='1', value='lo', snmp_type='OCTETSTR'),
+        SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.2', oid_index='2', value='eth0', snmp_type='OCTETSTR'),
+        SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.2', oid_index='10', value='eth1', snmp_type='OCTETSTR'),
+    ]
+    speed = [
+        SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.5', oid_index='10', value='1000000000', snmp_type='GAUGE'),
+        SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.5', oid_index='1', value='10000000', snmp_type='GAUGE'),
+    ]
+    uptime = SNMPVariable(oid='.1.3.6.1.2.1.1.3', oid_index='0', value='123', snmp_type='TICKS')
+    oid_indexes, columns = _align_walk_results([descr, speed, uptime], ['walk', 'walk', 'get'])
+    assert oid_indexes == ['1', '2', '10']
+    assert columns[0] == descr
+    assert columns[1] == [speed[1], None, speed[0]]
+    assert columns[2] == [uptime, uptime, uptime]
+
+
+def test_apply_expression_snmpwalk_out_of_order():
+    results = [
+        [
+            SNMPVariable(oid='1.3.6.1.2.1.2.2.1.10', oid_index='1', value='100', snmp_type='COUNTER_PER_S'),
+            SNMPVariable(oid='1.3.6.1.2.1.2.2.1.10', oid_index='2', value='200', snmp_type='COUNTER_PER_S'),
+        ],
+        [
+            SNMPVariable(oid='1.3.6.1.2.1.2.2.1.2', oid_index='2', value='eth1', snmp_type='OCTETSTR'),
+            SNMPVariable(oid='1.3.6.1.2.1.2.2.1.2', oid_index='1', value='eth0', snmp_type='OCTETSTR'),
+        ],
+    ]
+    expected_result = [
+        {'p': 'snmp.interfaces.eth0', 'v': 800.},
+        {'p': 'snmp.interfaces.eth1', 'v': 1600.},
+    ]
+    assert _apply_expression_to_results(results, ['walk', 'walk'], '$1 * 8', 'snmp.interfaces.{$2}') == expected_result
+
+
+class FakeWalkSession(object):
+    """ Agent with `n` interfaces (and some other OIDs after them), remembers the requests """
+    version = 2
+
+    def __init__(self, n):
+        self.oids = [(f'.1.3.6.1.2.1.2.2.1.2', str(i)) for i in range(1, n + 1)] + [('.1.3.6.1.2.1.2.2.1.3', '1')]
+        self.requests = []
+
+    def get_bulk(self, oids, non_repeaters=0, max_repetitions=10):
+        self.requests.append(max_repetitions)
+        oid, = oids
+        following = [(o, i) for o, i in self.oids if tuple(map(int, f'{o}.{i}'.strip('.').split('.'))) > tuple(map(int, oid.strip('.').split('.')))]
+        return [SNMPVariable(oid=o, oid_index=i, value=f'eth{i}', snmp_type='OCTETSTR') for o, i in following[:max_repetitions]]
+
+
+def test_snmp_walk():
+    session = FakeWalkSession(30)
+    results = _snmp_walk(session, '.1.3.6.1.2.1.2.2.1.2', 25, 0)
+    assert [v.oid_index for v in results] == [str(i) for i in range(1, 31)]
+    assert session.requests == [25, 25]
+
+
+def test_snmp_walk_max_rows():
+    session = FakeWalkSession(100)
+    results = _snmp_walk(session, '.1.3.6.1.2.1.2.2.1.2', 25, 30)
+    assert [v.oid_index for v in results] == [str(i) for i in range(1, 31)]
+    assert session.requests == [25, 6]  # no more rows than needed are requested
+
+
+class FakeWalkSessionV1(FakeWalkSession):
+    """ SNMPv1 agent - with `retry_no_such`, easysnmp reports the end of MIB as NOSUCHNAME result """
+    version = 1
+
+    def get_bulk(self, oids, non_repeaters=0, max_repetitions=10):
+        raise EasySNMPError('GETBULK is not supported in SNMPv1')
+
+    def get_next(self, oids):
+        results = super().get_bulk(oids, max_repetitions=1)
+        return results or [SNMPVariable(oid=oids[0], oid_index='', value='NOSUCHNAME', snmp_type='NOSUCHNAME')]
+
+    def walk(self, oid):
+        raise AssertionError('easysnmp walk is not limited')
+
+
+def test_snmp_walk_v1():
+    session = FakeWalkSessionV1(3)
+    session.oids = session.oids[:-1]  # end of MIB after the interfaces
+    results = _snmp_walk(session, '.1.3.6.1.2.1.2.2.1.2', 25, 0)
+    assert [v.oid_index for v in results] == ['1', '2', '3']
+    assert len(session.requests) == 4
+
+    # walk stops as soon as there are more than max_rows rows:
+    session = FakeWalkSessionV1(100)
+    results = _snmp_walk(session, '.1.3.6.1.2.1.2.2.1.2', 25, 30)
+    assert [v.oid_index for v in results] == [str(i) for i in range(1, 31)]
+    assert len(session.requests) == 31
+
+
+def test_walk_max_rows():
+    sensors = [
+        {"sensor_details": {"oids": [{"oid": "1.3.6.1.2.1.2.2.1.2", "fetch_method": "walk"}, {"oid": "1.3.6.1.2.1.1.3.0", "fetch_method": "get"}], "max_rows": 10}},
+        {"sensor_details": {"oids": [{"oid": "1.3.6.1.2.1.2.2.1.2", "fetch_method": "walk"}, {"oid": "1.3.6.1.2.1.2.2.1.5", "fetch_method": "walk"}], "max_rows": 100}},
+        {"sensor_details": {"oids": [{"oid": "1.3.6.1.2.1.2.2.1.5", "fetch_method": "walk"}], "max_rows": 0}},
+    ]
+    assert _walk_max_rows(sensors) == {"1.3.6.1.2.1.2.2.1.2": 100, "1.3.6.1.2.1.2.2.1.5": 0}
+
+
+def test_snmp_result():
+    """ SNMPResult compares like SNMPVariable (values as strings) and survives pickling (walk cache) """
+    result = SNMPResult('.1.3.6.1.2.1.2.2.1.10', '1', 1000.0, 'COUNTER_PER_S')
+    assert result == SNMPVariable(oid='.1.3.6.1.2.1.2.2.1.10', oid_index='1', value='1000.0', snmp_type='COUNTER_PER_S')
+    assert result != SNMPResult('.1.3.6.1.2.1.2.2.1.10', '2', 1000.0, 'COUNTER_PER_S')
+    assert pickle.loads(pickle.dumps(result)) == result
+    assert not hasattr(result, '__dict__')
+
+
+class FakeResponse(object):
+    def __init__(self, data=None):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class FakeBackendSession(object):
+    def __init__(self, entities):
+        self.entities = entities
+        self.requests = []
+
+    def get(self, url, timeout=None):
+        self.requests.append(('get', None))
+        return FakeResponse({"list": self.entities})
+
+    def request(self, method, url, json=None, timeout=None):
+        self.requests.append((method, json["name"] if json else url.split('/')[-2]))
+        return FakeResponse({"id": 100} if method == 'post' else None)
+
+
+def test_update_interface_entities(monkeypatch):
+    backend = FakeBackendSession([
+        {"id": 11, "name": "eth1", "entity_type": "interface", "parent": 1, "details": {"snmp_index": "1", "speed_bps": "1000"}},
+        {"id": 12, "name": "eth2", "entity_type": "interface", "parent": 1, "details": {"snmp_index": "2", "speed_bps": "1000"}},
+        {"id": 13, "name": "eth3", "entity_type": "interface", "parent": 1, "details": {"snmp_index": "3", "speed_bps": "1000"}},
+    ])
+    monkeypatch.setattr(snmpbot, '_get_backend_session', lambda: backend)
+    monkeypatch.setattr(sharedstate, 'interface_cache', sharedstate.InterfaceCache(3600))
+    job_info = {"entity_id": 1, "account_id": 2, "backend_url": "http://backend", "bot_token": "token"}
+    def walk(oid, values):
+        return [SNMPResult(oid, str(i), v, 'OCTETSTR') for i, v in values]
+
+    descr = walk('.1.3.6.1.2.1.2.2.1.2', [(1, 'eth1'), (2, 'eth2-renamed'), (4, 'eth4')])
+    speed = walk('.1.3.6.1.2.1.2.2.1.5', [(1, '1000'), (2, '1000'), (4, '1000')])
+    SNMPBot._update_interface_entities(job_info, descr, speed)
+    assert backend.requests[0] == ('get', None)
+    assert sorted(backend.requests[1:]) == [('delete', '13'), ('post', 'eth4'), ('put', 'eth2-renamed')]
+    assert sharedstate.interface_cache.get(1)[1] == {"1": ("eth1", "1000", 11), "2": ("eth2-renamed", "1000", 12), "4": ("eth4", "1000", 100)}
+
+    # unchanged interfaces - backend is not contacted at all:
+    backend.requests = []
+    SNMPBot._update_interface_entities(job_info, descr, speed)
+    assert backend.requests == []
+
+    # changed interfaces are diffed against the cached entities:
+    speed[0].value = '100'
+    SNMPBot._update_interface_entities(job_info, descr, speed)
+    assert backend.requests == [('put', 'eth1')]
+
+
+def test_interfaces_change_markers():
+    results = {
+        '1.3.6.1.2.1.2.1.0': SNMPResult('.1.3.6.1.2.1.2.1', '0', '24', 'INTEGER'),
+        '1.3.6.1.2.1.31.1.5.0': SNMPResult('.1.3.6.1.2.1.31.1.5', '0', None, 'NOSUCHOBJECT'),
+        '1.3.6.1.2.1.1.3.0': SNMPResult('.1.3.6.1.2.1.1.3', '0', '123456', 'TICKS'),
+    }
+    assert _interfaces_change_markers(results) == (24, None, 123456)
+
+
+@pytest.mark.parametrize("previous,markers,expected", [
+    (None, (24, 500, 1000), True),
+    ((1000., (24, 500, 1000)), (24, 500, 2000), False),
+    ((1000., (24, 500, 1000)), (25, 500, 2000), True),  # ifNumber changed
+    ((1000., (24, 500, 1000)), (24, 1500, 2000), True),  # ifTableLastChange changed
+    ((1000., (24, 500, 1000)), (24, 500, 100), True),  # agent restarted
+    ((1000., (24, None, 1000)), (24, None, 2000), False),
+    ((1000., (None, None, 1000)), (None, None, 2000), True),
+    ((1000. - INTERFACES_MAX_STALENESS, (24, 500, 1000)), (24, 500, 2000), True),  # too old
+])
+def test_interfaces_changed(previous, markers, expected):
+    assert _interfaces_changed(previous, markers, 1010.) == expected
+
+
+def test_job_phase_offset():
+    offsets = [_job_phase_offset(f'{entity_id}', [60, 300]) for entity_id in range(1000)]
+    assert offsets == [_job_phase_offset(f'{entity_id}', [300, 60]) for entity_id in range(1000)]  # deterministic
+    assert all(0 <= o < 300 for o in offsets)
+    # jobs are spread over the whole interval:
+    assert len(set(o % 60 for o in offsets)) == 60
+    assert _job_phase_offset('1', []) is None
+
+    # trigger fires at the offset within each interval:
+    trigger = MultipleIntervalsTrigger([60, 300], start_ts=137)
+    next_fire = trigger.get_next_fire_time(None, datetime.fromtimestamp(1600000000, tz=utc))
+    assert next_fire.timestamp() % 60 == 137 % 60
+    assert _schedule_drift({"phase_offset": 137}, [60], next_fire.timestamp() + 0.5) == 0.5
+    assert _schedule_drift({"phase_offset": 137}, [60, 300], next_fire.timestamp() + 70) == 70
+
+
+def test_jobs_of_entity_without_valid_sensors(monkeypatch):
+    monkeypatch.setattr(SNMPBot, '_fetch_user_id', lambda self: None)
+    entities = [
+        {"entity_id": 1, "account_id": 2, "details": {"ipv4": "10.0.0.1"}, "credential_details": {},
+         "sensors": [{"sensor_id": 3, "interval": 60, "sensor_details": {"oids": [{"oid": "1.3.6.1.2.1.1.3.0", "fetch_method": "get"}], "expression": "$2", "output_path": "uptime"}}]},
+        {"entity_id": 4, "account_id": 2, "details": {"ipv4": "10.0.0.2"}, "credential_details": {},
+         "sensors": [{"sensor_id": 3, "interval": 60, "sensor_details": {"oids": [{"oid": "1.3.6.1.2.1.1.3.0", "fetch_method": "get"}], "expression": "$1", "output_path": "uptime"}}]},
+    ]
+    monkeypatch.setattr(SNMPBot, 'fetch_job_configs', lambda self, protocol: iter(entities))
+    bot = SNMPBot('http://backend', 'token', 120)
+
+    jobs = list(bot.jobs())
+    # interfaces are still synced, even if there is nothing else to poll:
+    assert [job_id for job_id, _, _, _, _ in jobs] == ['1-interfaces', '4', '4-interfaces']
+    for _, intervals, _, _, start_ts in jobs:
+        MultipleIntervalsTrigger(intervals, start_ts=start_ts)
+
+
+class FlakySession(object):
+    def __init__(self):
+        self.reachable = False
+        self.requests = []
+
+    def get(self, oids):
+        self.requests.append(oids)
+        if not self.reachable:
+            raise EasySNMPTimeoutError('timed out while connecting to remote host')
+        return [SNMPVariable(oid='.1.3.6.1.2.1.1.3', oid_index='0', value='1234', snmp_type='TICKS') for _ in oids]
+
+
+def test_device_circuit_breaker(monkeypatch):
+    session = FlakySession()
+    monkeypatch.setattr(snmpbot, 'snmp_sessions', SNMPSessionPool(600))
+    monkeypatch.setattr(SNMPBot, '_create_snmp_sesssion', staticmethod(lambda job_info: session))
+    sent = []
+    monkeypatch.setattr(snmpbot, 'send_results_to_grafolean', lambda backend_url, bot_token, account_id, values: sent.extend(values))
+    health = sharedstate.DeviceHealth(2, 30, 600)
+    monkeypatch.setattr(sharedstate, 'device_health', health)
+    job_info = {
+        "backend_url": "http://backend", "bot_token": "token", "entity_id": 1, "account_id": 2, "details": {"ipv4": "10.0.0.1"},
+        "credential_details": {"version": "snmpv2c", "snmpv12_community": "public"},
+        "sensors": [{"sensor_id": 3, "interval": 60, "sensor_details": {"oids": [{"oid": "1.3.6.1.2.1.25.1.1.0", "fetch_method": "get"}], "expression": "$1", "output_path": "uptime"}}],
+    }
+
+    for _ in range(2):
+        with pytest.raises(EasySNMPTimeoutError):
+            SNMPBot.do_snmp([60], **job_info)
+    assert health.open_breakers() == {1: 2}
+
+    # device is skipped until it is time to probe it:
+    SNMPBot.do_snmp([60], **job_info)
+    assert len(session.requests) == 2
+
+    # probe is a single GET of sysUpTime:
+    health.entries[1] = (2, time.time() - 1)
+    with pytest.raises(EasySNMPTimeoutError):
+        SNMPBot.do_snmp([60], **job_info)
+    assert session.requests[2:] == [['1.3.6.1.2.1.1.3.0']]
+    assert health.acquire(1) == sharedstate.BREAKER_OPEN
+    assert health.entries[1][1] > time.time() + 59  # backoff doubled
+
+    # when device responds, it is polled normally again:
+    session.reachable = True
+    health.entries[1] = (3, time.time() - 1)
+    SNMPBot.do_snmp([60], **job_info)
+    assert session.requests[3:] == [['1.3.6.1.2.1.1.3.0'], ['1.3.6.1.2.1.25.1.1.0']]
+    assert sent == [{"p": "entity.1.snmp.uptime", "v": 1234.0}]
+    assert health.open_breakers() == {}
+
+
+@pytest.mark.parametrize("sample_rate,level,payload_logged", [
+    (0., logging.INFO, False),
+    (0., logging.DEBUG, True),
+    (1., logging.INFO, True),
+])
+def test_payload_logging(monkeypatch, caplog, sample_rate, level, payload_logged):
+    session = FlakySession()
+    session.reachable = True
+    monkeypatch.setattr(snmpbot, 'snmp_sessions', SNMPSessionPool(600))
+    monkeypatch.setattr(SNMPBot, '_create_snmp_sesssion', staticmethod(lambda job_info: session))
+    monkeypatch.setattr(snmpbot, 'send_results_to_grafolean', lambda backend_url, bot_token, account_id, values: None)
+    monkeypatch.setattr(snmpbot, 'LOG_PAYLOAD_SAMPLE_RATE', sample_rate)
+    job_info = {
+        "backend_url": "http://backend", "bot_token": "token", "entity_id": 1, "account_id": 2, "details": {"ipv4": "10.0.0.1"},
+        "credential_details": {"version": "snmpv2c", "snmpv12_community": "public"},
+        "sensors": [{"sensor_id": 3, "interval": 60, "sensor_details": {"oids": [{"oid": "1.3.6.1.2.1.25.1.1.0", "fetch_method": "get"}], "expression": "$1", "output_path": "uptime"}}],
+    }
+    caplog.set_level(level)
+    SNMPBot.do_snmp([60], **job_info)
+
+    messages = [r.getMessage() for r in caplog.records]
+    assert any(m.startswith("Finished snmp job for account [2], IP [10.0.0.1]: 1 sensors, 1 SNMP results (4 bytes), 1 values in ") for m in messages)
+    assert any(m.startswith("Results of sensor 3: ") for m in messages) == payload_logged
+    assert any(m.startswith("Values: ") for m in messages) == payload_logged
+
+
+def test_fetch_timestamps(monkeypatch):
+    clock = [100.]
+    monkeypatch.setattr(time, 'time', lambda: clock[0])
+    get_sensor = {"sensor_id": 1, "sensor_details": {"oids": [{"oid": "1.3.6.1.2.1.1.3.0", "fetch_method": "get"}]}}
+    walk_sensor = {"sensor_id": 2, "sensor_details": {"oids": [{"oid": "1.3.6.1.2.1.2.2.1.10", "fetch_method": "walk"}]}}
+    both_sensor = {"sensor_id": 3, "sensor_details": {"oids": [{"oid": "1.3.6.1.2.1.1.3.0", "fetch_method": "get"}, {"oid": "1.3.6.1.2.1.2.2.1.10", "fetch_method": "walk"}]}}
+    steps = snmpbot._fetch_steps({"entity_id": 1, "credential_details": {}}, [get_sensor, walk_sensor, both_sensor])
+
+    assert next(steps) == ('get', ['1.3.6.1.2.1.1.3.0'])
+    uptime = SNMPResult('.1.3.6.1.2.1.1.3.0', '', '1234', 'TICKS')
+    clock[0] = 101.
+    request = steps.send({'1.3.6.1.2.1.1.3.0': uptime})
+    assert request[:2] == ('walk', '1.3.6.1.2.1.2.2.1.10')
+    octets = [SNMPResult('.1.3.6.1.2.1.2.2.1.10', '1', '5678', 'COUNTER')]
+    clock[0] = 105.
+    with pytest.raises(StopIteration) as ex:
+        steps.send(octets)
+    # counters are timestamped when they are fetched, not when the values are calculated:
+    assert ex.value.value == [(get_sensor, [uptime], 101.), (walk_sensor, [octets], 105.), (both_sensor, [uptime, octets], 105.)]
+
+
+def test_db_pool_metrics(monkeypatch):
+    class FakeDBPoolStats(object):
+        def get(self):
+            return {"checkouts": 10, "waits": 2, "wait_time": 0.5, "max_wait_time": 0.3, "timeouts": 1, "in_use": 3, "connects": 4, "replaced": 0, "idle": 1}
+    monkeypatch.setattr(snmpbot, 'get_db_pool_stats', lambda: None)  # main process is not connected
+    monkeypatch.setattr(sharedstate, 'db_pool_stats', FakeDBPoolStats())
+    collector = metrics.MetricsCollector(0)
+    snmpbot._add_metrics_callbacks(collector)
+    lines = collector.render().splitlines()
+    assert '# TYPE snmpbot_db_connections gauge' in lines
+    assert '# TYPE snmpbot_db_pool_events_total counter' in lines
+    assert 'snmpbot_db_connections{process="shared_state",state="in_use"} 3' in lines
+    assert 'snmpbot_db_connections{process="shared_state",state="idle"} 1' in lines
+    assert 'snmpbot_db_pool_events_total{event="waits",process="shared_state"} 2' in lines
+    assert 'snmpbot_db_pool_events_total{event="timeouts",process="shared_state"} 1' in lines
+    assert 'snmpbot_db_pool_wait_seconds_total{process="shared_state"} 0.5' in lines
+    assert not any('process="main"' in line for line in lines)
+
+
+def test_async_job_fallback_is_recorded_once(monkeypatch):
+    collector = metrics.MetricsCollector(0)
+    monkeypatch.setattr(metrics, 'collector', collector)
+    monkeypatch.setattr(SNMPBot, '_create_async_snmp_client', lambda snmp_engine, job_info: None)  # for example SNMPv3
+    sync_runs = []
+    monkeypatch.setattr(SNMPBot.do_snmp, '__wrapped__', lambda affecting_intervals, **job_info: sync_runs.append(job_info))
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(SNMPBot.do_snmp_async(None, [60], entity_id=1))
+    finally:
+        loop.close()
+    assert sync_runs == [{"entity_id": 1}]
+    assert collector.registry.counters[('snmpbot_jobs_total', (('job', 'snmp'), ('result', 'ok')))] == 1
+
+
+def test_async_jobs_dont_block_event_loop(monkeypatch):
+    loop_thread = threading.current_thread()
+    shared_state_calls = []
+
+    class FakeSharedState(object):
+        """ Records the calls (and the threads they were made in) to any shared state method """
+        def __init__(self, **retvals):
+            self.retvals = retvals
+
+        def __getattr__(self, name):
+            def method(*args):
+                shared_state_calls.append((name, threading.current_thread() is loop_thread))
+                return self.retvals.get(name)
+            return method
+
+    class FakeAsyncClient(object):
+        async def get(self, oids):
+            return [asyncsnmp.VarBind(oid, 'INTEGER', '5') for oid in oids]
+
+        async def walk(self, oid, max_repetitions, max_rows):
+            return [asyncsnmp.VarBind(f'{oid}.{i}', 'GAUGE', '1000') for i in range(1, 3)]
+
+    monkeypatch.setattr(sharedstate, 'device_health', FakeSharedState(acquire=sharedstate.BREAKER_CLOSED))
+    monkeypatch.setattr(sharedstate, 'walk_cache', FakeSharedState())
+    monkeypatch.setattr(sharedstate, 'interface_cache', FakeSharedState())
+    monkeypatch.setattr(SNMPBot, '_create_async_snmp_client', lambda snmp_engine, job_info: FakeAsyncClient())
+    monkeypatch.setattr(SNMPBot, '_update_interface_entities', staticmethod(lambda job_info, result_descr, result_speed: True))
+    monkeypatch.setattr(snmpbot, 'send_results_to_grafolean', lambda backend_url, bot_token, account_id, values: None)
+    job_info = {
+        "backend_url": "http://backend", "bot_token": "token", "entity_id": 1, "account_id": 2, "details": {"ipv4": "10.0.0.1"},
+        "credential_details": {"version": "snmpv2c", "snmpv12_community": "public"},
+        "sensors": [{"sensor_id": 3, "interval": 60, "sensor_details": {"oids": [{"oid": snmpbot.OID_IF_SPEED, "fetch_method": "walk"}], "expression": "$1", "output_path": "speed"}}],
+    }
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(SNMPBot.do_snmp_async(None, [60], **job_info))
+        loop.run_until_complete(SNMPBot.update_if_entities_async(None, [60], **job_info))
+    finally:
+        loop.close()
+    assert [name for name, _ in shared_state_calls] == [
+        'acquire', 'record_success', 'put',  # snmp job
+        'acquire', 'get_markers', 'get', 'get', 'record_success', 'put_markers',  # interfaces job
+    ]
+    assert not any(in_loop_thread for _, in_loop_thread in shared_state_calls)
+
+
+def test_counter_key():
+    key = counter_key('12/34/0/1/.1.3.6.1.2.1.2.2.1.10/10.0.0.1')
+    assert key[:2] == (12, 34)
+    assert key[3] == '10.0.0.1'
+    assert -2**63 <= key[2] < 2**63
+    # the same OID at a different position is a different counter:
+    assert counter_key('12/34/1/1/.1.3.6.1.2.1.2.2.1.10/10.0.0.1')[2] != key[2]
@@ -0,0 +1,198 @@
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+from valuesender import ValuesSender, ValuesRefusedError
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ''
+
+
+class FakeRequestsSession(object):
+    """ Remembers the POST requests and responds with given status codes (the last one is repeated) """
+    def __init__(self, status_codes):
+        self.status_codes = status_codes
+        self.requests = []
+
+    def post(self, url, data, headers, timeout):
+        self.requests.append((url, data))
+        status_code = self.status_codes.pop(0) if len(self.status_codes) > 1 else self.status_codes[0]
+        if status_code is None:
+            raise requests.exceptions.ConnectionError('Connection refused')
+        return FakeResponse(status_code)
+
+
+def test_values_sender_merges_values():
+    sender = ValuesSender(60, 1000, 100)
+    sender.requests_session = FakeRequestsSession([200])
+    sender.start()
+    sender.enqueue('http://backend', 'token', 1, [{"p": "a", "v": 1}])
+    sender.enqueue('http://backend', 'token', 2, [{"p": "b", "v": 2}])
+    sender.enqueue('http://backend', 'token', 1, [{"p": "c", "v": 3, "t": 123.0}])
+    sender.stop()
+    # accounts are sent by different threads, so the order of requests is not known:
+    requests_values = sorted((url, json.loads(data.decode('utf-8'))) for url, data in sender.requests_session.requests)
+    assert [(url, [(v["p"], v["v"]) for v in values]) for url, values in requests_values] == [
+        ('http://backend/accounts/1/values/?b=token', [("a", 1), ("c", 3)]),
+        ('http://backend/accounts/2/values/?b=token', [("b", 2)]),
+    ]
+    # values are timestamped when they are enqueued (unless they already have a timestamp):
+    assert all(isinstance(v["t"], float) for _, values in requests_values for v in values)
+    assert requests_values[0][1][1]["t"] == 123.0
+    assert sender.stats["sent"] == 3
+
+
+def test_values_sender_accounts_dont_block_each_other():
+    account_2_sent = threading.Event()
+
+    class SlowAccountSession(FakeRequestsSession):
+        def post(self, url, data, headers, timeout):
+            if '/accounts/1/' in url:
+                # account 1 is stuck until account 2 is sent (or the test gives up):
+                self.account_2_was_sent = account_2_sent.wait(5)
+            else:
+                account_2_sent.set()
+            return super().post(url, data, headers, timeout)
+
+    sender = ValuesSender(60, 1000, 100)
+    sender.requests_session = SlowAccountSession([200])
+    sender.start()
+    sender.enqueue('http://backend', 'token', 1, [{"p": "a", "v": 1}])
+    sender.enqueue('http://backend', 'token', 2, [{"p": "b", "v": 2}])
+    sender.stop()
+    assert sender.requests_session.account_2_was_sent
+    assert sender.stats["sent"] == 2
+
+
+def test_values_sender_max_batch_size():
+    sender = ValuesSender(60, 2, 100)
+    sender.requests_session = FakeRequestsSession([200])
+    sender._send_batches({('http://backend', 'token', 1): (123.0, [{"p": "a", "v": i} for i in range(5)])})
+    assert len(sender.requests_session.requests) == 3
+
+
+def test_values_sender_retries():
+    sender = ValuesSender(60, 1000, 100, max_retries=3, retry_backoff=0.001)
+    sender.requests_session = FakeRequestsSession([None, 503, 200])
+    assert sender._post('http://backend/accounts/1/values/?b=token', [{"p": "a", "v": 1}]) is True
+    assert len(sender.requests_session.requests) == 3
+
+    # client errors are not retried:
+    sender.requests_session = FakeRequestsSession([400])
+    with pytest.raises(ValuesRefusedError):
+        sender._post('http://backend/accounts/1/values/?b=token', [{"p": "a", "v": 1}])
+    assert len(sender.requests_session.requests) == 1
+
+
+class FakeSpool(object):
+    def __init__(self):
+        self.rows = []
+
+    def append(self, backend_url, bot_token, account_id, values, ts):
+        self.rows.append((len(self.rows) + 1, backend_url, bot_token, account_id, values))
+
+    def peek(self, max_values):
+        return self.rows[:2]
+
+    def remove(self, ids):
+        self.rows = [r for r in self.rows if r[0] not in ids]
+
+    def is_empty(self):
+        return not self.rows
+
+
+def test_values_sender_spool():
+    spool = FakeSpool()
+    sender = ValuesSender(60, 1000, 100, max_retries=0, spool=spool)
+    sender.requests_session = FakeRequestsSession([503])
+    sender._send_batches({('http://backend', 'token', 1): (123.0, [{"p": "a", "v": 1}])})
+    assert sender.backend_down
+    # while backend is down, values are spooled without trying to send them:
+    sender._send_batches({('http://backend', 'token', 1): (124.0, [{"p": "a", "v": 2, "t": 123.5}])})
+    sender._send_batches({('http://backend', 'token', 2): (125.0, [{"p": "b", "v": 3}])})
+    assert len(sender.requests_session.requests) == 1
+    assert [r[4] for r in spool.rows] == [[{"p": "a", "v": 1, "t": 123.0}], [{"p": "a", "v": 2, "t": 123.5}], [{"p": "b", "v": 3, "t": 125.0}]]
+
+    # when backend is available again, spooled values are sent in order:
+    sender.requests_session = FakeRequestsSession([200])
+    assert sender._replay()
+    assert sender.requests_session.requests == [
+        ('http://backend/accounts/1/values/?b=token', b'[{"p": "a", "v": 1, "t": 123.0}, {"p": "a", "v": 2, "t": 123.5}]'),
+    ]
+    # new values are still spooled until all the spooled values are sent:
+    assert sender.backend_down
+    assert sender._replay()
+    assert not sender._replay()
+    assert len(sender.requests_session.requests) == 2
+    assert spool.rows == []
+    assert not sender.spool_pending
+    assert not sender.backend_down
+
+    # if backend is still down, replaying stops:
+    sender.requests_session = FakeRequestsSession([503])
+    sender._send_batches({('http://backend', 'token', 1): (126.0, [{"p": "a", "v": 4}])})
+    assert not sender._replay()
+    assert sender.backend_down
+
+
+def test_values_sender_account_queue_is_bounded():
+    posting, unblock = threading.Event(), threading.Event()
+
+    class BlockingSession(FakeRequestsSession):
+        def post(self, url, data, headers, timeout):
+            posting.set()
+            unblock.wait(5)
+            return super().post(url, data, headers, timeout)
+
+    sender = ValuesSender(60, 1000, 100, max_pending_batches=1)
+    sender.requests_session = BlockingSession([200])
+    key = ('http://backend', 'token', 1)
+    sender._dispatch_batches({key: (123.0, [{"p": "a", "v": 1}])})
+    assert posting.wait(5)
+    # first batch is being sent, the second one waits, and the third one is dropped:
+    sender._dispatch_batches({key: (124.0, [{"p": "a", "v": 2}])})
+    sender._dispatch_batches({key: (125.0, [{"p": "a", "v": 3}, {"p": "b", "v": 3}])})
+    assert sender.stats["dropped"] == 2
+    unblock.set()
+    sender._stop_account_senders()
+    assert len(sender.requests_session.requests) == 2
+    assert sender.stats["sent"] == 2
+
+
+def test_values_sender_replay_thread(caplog):
+    class BrokenSpool(FakeSpool):
+        def peek(self, max_values):
+            if self.broken:
+                raise ConnectionError("DB is not available")
+            return super().peek(max_values)
+
+    spool = BrokenSpool()
+    spool.broken = True
+    spool.append('http://backend', 'token', 1, [{"p": "a", "v": 1, "t": 120.0}], 120.0)
+    spool.append('http://backend', 'token', 1, [{"p": "a", "v": 2, "t": 121.0}], 121.0)
+    spool.append('http://backend', 'token', 1, [{"p": "a", "v": 3, "t": 122.0}], 122.0)
+    sender = ValuesSender(0.01, 1000, 100, spool=spool, replay_interval=0.01)
+    sender.requests_session = FakeRequestsSession([200])
+    sender.start()
+    # values which were spooled before are sent first, so new values are spooled until then:
+    assert sender.backend_down
+    time.sleep(0.1)
+    # errors are not logged on every attempt:
+    assert len([r for r in caplog.records if 'Error replaying' in r.message]) == 1
+
+    spool.broken = False
+    for _ in range(100):
+        if not sender.backend_down:
+            break
+        time.sleep(0.01)
+    sender.enqueue('http://backend', 'token', 1, [{"p": "b", "v": 4}])
+    sender.stop()
+    assert spool.rows == []
+    assert [json.loads(data.decode('utf-8'))[0]["v"] for _, data in sender.requests_session.requests] == [1, 3, 4]
+    assert sender.stats["replayed"] == 3
@@ -0,0 +1,309 @@
+import gzip
+import json
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+
+import requests
+
+import metrics
+
+
+log = logging.getLogger("{}.{}".format(__name__, "valuesender"))
+
+
+# Values are sent to Grafolean by a single sender in the main process. The jobs (which run in worker
+# processes) only put their values into the sender's queue, which is created before the workers are
+# forked. If the sender is not set, the values are sent synchronously by the jobs themselves.
+sender = None
+
+
+STATS_LOG_INTERVAL = 60
+REQUEST_TIMEOUT = 10
+MAX_RETRY_BACKOFF = 30
+
+
+class ValuesRefusedError(Exception):
+    pass
+
+
+class ValuesSender(object):
+    """
+        Collects the values of all jobs and sends them to Grafolean in batches - values of many
+        entities are merged into a single POST per account, either every `flush_interval` seconds
+        or as soon as `max_batch_size` values are waiting. Each account has its own sending thread,
+        so that retrying failed requests (with exponential backoff) for one account doesn't delay
+        the others. At most `max_pending_batches` batches wait for each account's thread; if there
+        are more of them (because backend is slow), new batches are dropped (like when the queue is
+        full).
+        A single keep-alive connection pool is used for all requests.
+
+        If `spool` is set, values which could not be sent are saved to it instead of being dropped.
+        Until spool is empty again, new values go directly to it (so that the values are sent in
+        order). Spooled values are sent by a separate thread, which tries every `replay_interval`
+        seconds if backend is available, and then sends the oldest values (at most `max_batch_size`
+        of them per request) until spool is empty.
+    """
+    def __init__(self, flush_interval, max_batch_size, queue_size, compress=False, max_retries=5, retry_backoff=0.5, spool=None, replay_interval=1., max_pending_batches=10):
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.compress = compress
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.spool = spool
+        self.replay_interval = replay_interval
+        self.max_pending_batches = max_pending_batches
+        self.spool_pending = False  # are there (possibly) any values in spool?
+        self.backend_down = False  # are new values spooled instead of sent?
+        self.spool_lock = threading.Lock()
+        self.replay_thread = None
+        self.replay_stopping = threading.Event()
+        self.queue = multiprocessing.Queue(queue_size)
+        self.requests_session = requests.Session()
+        self.thread = None
+        self.account_senders = {}  # (backend_url, bot_token, account_id) -> (queue, thread)
+        # stats are only kept by the sending threads (in the main process):
+        self.stats_lock = threading.Lock()
+        self.stats = {"sent": 0, "dropped": 0, "retries": 0, "requests": 0, "spooled": 0, "replayed": 0}
+        self.last_stats_log_ts = time.monotonic()
+
+    def start(self):
+        if self.spool is not None:
+            try:
+                self.spool_pending = not self.spool.is_empty()
+            except Exception:
+                log.exception("Error checking values spool")
+                self.spool_pending = True
+            # values which were spooled before must be sent first:
+            self.backend_down = self.spool_pending
+            self.replay_stopping.clear()
+            self.replay_thread = threading.Thread(target=self._run_replay, name="values-spool-replay", daemon=True)
+            self.replay_thread.start()
+        self.thread = threading.Thread(target=self._run, name="values-sender", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+            Sends the values which are still waiting in the queue and stops the sending thread.
+        """
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        if self.replay_thread is not None:
+            self.replay_stopping.set()
+            self.replay_thread.join()
+            self.replay_thread = None
+
+    def enqueue(self, backend_url, bot_token, account_id, values):
+        """
+            Can be called from any process. Never blocks - if the queue is full, values are dropped.
+        """
+        # values can wait in queue (or be retried) for a while, so they need an explicit timestamp:
+        ts = time.time()
+        values = [v if 't' in v else {**v, 't': ts} for v in values]
+        try:
+            self.queue.put_nowait((backend_url, bot_token, account_id, values))
+            return True
+        except queue.Full:
+            log.warning(f"Values sender queue is full, dropping {len(values)} values for account {account_id}")
+            return False
+
+    def queue_depth(self):
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:  # not available on all platforms
+            return None
+
+    def _run(self):
+        batches = {}  # (backend_url, bot_token, account_id) -> (ts, values)
+        n_values = 0
+        flush_deadline = None
+        while True:
+            timeout = STATS_LOG_INTERVAL if flush_deadline is None else max(0, flush_deadline - time.monotonic())
+            stopping = False
+            try:
+                item = self.queue.get(timeout=timeout)
+                if item is None:
+                    stopping = True
+                else:
+                    backend_url, bot_token, account_id, values = item
+                    if not batches:
+                        flush_deadline = time.monotonic() + self.flush_interval
+                    batches.setdefault((backend_url, bot_token, account_id), (time.time(), []))[1].extend(values)
+                    n_values += len(values)
+            except queue.Empty:
+                pass
+
+            if batches and (stopping or n_values >= self.max_batch_size or time.monotonic() >= flush_deadline):
+                self._dispatch_batches(batches)
+                batches, n_values, flush_deadline = {}, 0, None
+
+            self._log_stats()
+            if stopping:
+                self._stop_account_senders()
+                return
+
+    def _dispatch_batches(self, batches):
+        """
+            Passes the batches to the sending threads of their accounts (starting them if needed).
+        """
+        for key, batch in batches.items():
+            if key not in self.account_senders:
+                account_queue = queue.Queue(self.max_pending_batches)
+                thread = threading.Thread(target=self._run_account_sender, args=(key, account_queue), name=f"values-sender-{key[2]}", daemon=True)
+                thread.start()
+                self.account_senders[key] = (account_queue, thread)
+            try:
+                self.account_senders[key][0].put_nowait(batch)
+            except queue.Full:
+                self._inc_stat("dropped", len(batch[1]))
+                log.warning(f"Too many batches are waiting to be sent for account {key[2]}, dropping {len(batch[1])} values")
+
+    def _run_account_sender(self, key, account_queue):
+        while True:
+            batch = account_queue.get()
+            if batch is None:
+                return
+            try:
+                self._send_batches({key: batch})
+            except:
+                log.exception("Error sending values to Grafolean")
+
+    def _stop_account_senders(self):
+        for account_queue, _ in self.account_senders.values():
+            account_queue.put(None)
+        for _, thread in self.account_senders.values():
+            thread.join()
+        self.account_senders = {}
+
+    def _run_replay(self):
+        last_error_log_ts = None
+        while not self.replay_stopping.wait(self.replay_interval):
+            if not self.spool_pending:
+                continue
+            try:
+                # once backend accepts the values, the spool is emptied as fast as possible:
+                while self._replay() and not self.replay_stopping.is_set():
+                    pass
+            except Exception as ex:
+                # (DB might not be available either, so errors are only logged once in a while)
+                if last_error_log_ts is None or time.monotonic() - last_error_log_ts >= STATS_LOG_INTERVAL:
+                    log.warning(f"Error replaying spooled values: {ex!r}")
+                    last_error_log_ts = time.monotonic()
+
+    def _inc_stat(self, name, n=1):
+        with self.stats_lock:
+            self.stats[name] += n
+
+    def _send_batches(self, batches):
+        for (backend_url, bot_token, account_id), (ts, values) in batches.items():
+            url = '{}/accounts/{}/values/?b={}'.format(backend_url, account_id, bot_token)
+            for i in range(0, len(values), self.max_batch_size):
+                chunk = values[i:i + self.max_batch_size]
+                try:
+                    if not self.backend_down and self._post(url, chunk):
+                        self._inc_stat("sent", len(chunk))
+                        continue
+                except ValuesRefusedError:
+                    self._inc_stat("dropped", len(chunk))
+                    continue
+                self._spool(backend_url, bot_token, account_id, chunk, ts)
+
+    def _spool(self, backend_url, bot_token, account_id, values, ts):
+        if self.spool is not None:
+            # values will be sent later, so they need an explicit timestamp (if they don't have it yet):
+            values = [v if 't' in v else {**v, 't': ts} for v in values]
+            try:
+                with self.spool_lock:
+                    self.spool.append(backend_url, bot_token, account_id, values, ts)
+                    self.spool_pending = True
+                    # until spool is empty, new values are spooled too (so that they are sent in order):
+                    self.backend_down = True
+                self._inc_stat("spooled", len(values))
+                return
+            except Exception:
+                log.exception("Error saving values to spool")
+        self._inc_stat("dropped", len(values))
+        log.error(f"Dropped {len(values)} values for account {account_id}")
+
+    def _replay(self):
+        """
+            Sends the oldest spooled values (merged per account, in order) and removes them from spool.
+            Returns True if they were sent (and there might be more of them).
+        """
+        with self.spool_lock:
+            rows = self.spool.peek(self.max_batch_size)
+            if not rows:
+                # (under lock, so that values which are being spooled are not forgotten)
+                self.spool_pending = False
+                self.backend_down = False
+                return False
+
+        batches = {}  # (backend_url, bot_token, account_id) -> (ids, values)
+        for row_id, backend_url, bot_token, account_id, values in rows:
+            ids, batch_values = batches.setdefault((backend_url, bot_token, account_id), ([], []))
+            ids.append(row_id)
+            batch_values.extend(values)
+        for (backend_url, bot_token, account_id), (ids, values) in batches.items():
+            url = '{}/accounts/{}/values/?b={}'.format(backend_url, account_id, bot_token)
+            # no retries here - if backend is still not available, we will try again later:
+            try:
+                if not self._post(url, values, max_retries=0):
+                    return False
+                self._inc_stat("replayed", len(values))
+            except ValuesRefusedError:
+                self._inc_stat("dropped", len(values))
+            self.spool.remove(ids)
+        return True
+
+    def _post(self, url, values, max_retries=None):
+        body = json.dumps(values).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.compress:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        if max_retries is None:
+            max_retries = self.max_retries
+        for attempt in range(max_retries + 1):
+            if attempt > 0:
+                self._inc_stat("retries")
+                time.sleep(min(self.retry_backoff * 2 ** (attempt - 1), MAX_RETRY_BACKOFF))
+            try:
+                self._inc_stat("requests")
+                with metrics.timer('snmpbot_send_seconds'):
+                    r = self.requests_session.post(url, data=body, headers=headers, timeout=REQUEST_TIMEOUT)
+            except requests.exceptions.RequestException as ex:
+                metrics.inc('snmpbot_send_failures_total')
+                log.warning(f"Error sending values to Grafolean (attempt {attempt + 1}): {ex}")
+                continue
+            if r.status_code < 400:
+                return True
+            metrics.inc('snmpbot_send_failures_total')
+            if r.status_code < 500 and r.status_code != 429:
+                # client errors will not go away if we retry:
+                log.error(f"Grafolean refused {len(values)} values with status {r.status_code}: {r.text}")
+                raise ValuesRefusedError()
+            log.warning(f"Error sending values to Grafolean (attempt {attempt + 1}): status {r.status_code}")
+        return False
+
+    def _log_stats(self):
+        now = time.monotonic()
+        if now - self.last_stats_log_ts < STATS_LOG_INTERVAL:
+            return
+        self.last_stats_log_ts = now
+        log.info("Values sender: queue depth {}, sent {sent}, dropped {dropped}, requests {requests}, retries {retries}, spooled {spooled}, replayed {replayed}".format(self.queue_depth(), **self.stats))
+
+
+def start_values_sender(flush_interval, max_batch_size, queue_size, compress, spool=None):
+    """
+        Starts the values sender. Must be called before the job workers are forked.
+    """
+    global sender
+    sender = ValuesSender(flush_interval, max_batch_size, queue_size, compress, spool=spool)
+    sender.start()
+    return sender
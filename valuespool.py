@@ -0,0 +1,66 @@
+import logging
+import time
+
+from psycopg2.extras import Json
+
+from dbutils import get_db_cursor, DB_PREFIX
+
+
+log = logging.getLogger("{}.{}".format(__name__, "valuespool"))
+
+
+class ValuesSpool(object):
+    """
+        Keeps the values which could not be sent to Grafolean in DB, so that they can be sent later,
+        in the same order. If there are more than `max_values` values in the spool, or if they are
+        older than `max_age` seconds, the oldest ones are dropped. If `max_age` is not positive,
+        the age of values is not limited.
+
+        Like `CounterStore`, the instance lives in the shared state process (see `sharedstate`).
+        All methods raise `DBConnectionError` if DB is not available.
+
+        When entities are sharded, each shard uses only its own part of the spool (and the limits
+        apply to each shard separately), except that too old values are dropped regardless of
+        the shard, so that the values of shards which no longer exist don't stay forever.
+    """
+    def __init__(self, max_values, max_age, shard=0):
+        self.max_values = max_values
+        self.max_age = max_age
+        self.shard = shard
+
+    def append(self, backend_url, bot_token, account_id, values, ts):
+        with get_db_cursor() as c:
+            c.execute(f'INSERT INTO {DB_PREFIX}values_spool (shard, ts, backend_url, bot_token, account_id, n_values, payload) VALUES (%s, %s, %s, %s, %s, %s, %s);',
+                      (self.shard, ts, backend_url, bot_token, account_id, len(values), Json(values)))
+            # enforce the limits by dropping the oldest values:
+            n_dropped = 0
+            if self.max_age > 0:
+                c.execute(f'DELETE FROM {DB_PREFIX}values_spool WHERE ts < %s RETURNING n_values;', (time.time() - self.max_age,))
+                n_dropped += sum(n for n, in c.fetchall())
+            c.execute(f'DELETE FROM {DB_PREFIX}values_spool WHERE id IN ('
+                      f'  SELECT id FROM (SELECT id, SUM(n_values) OVER (ORDER BY id DESC) AS newer_values FROM {DB_PREFIX}values_spool WHERE shard = %s) x WHERE newer_values > %s'
+                      f') RETURNING n_values;', (self.shard, self.max_values,))
+            n_dropped += sum(n for n, in c.fetchall())
+        if n_dropped:
+            log.warning(f"Values spool is over its limits, dropped {n_dropped} oldest values")
+
+    def peek(self, max_values):
+        """
+            Returns the oldest spooled batches with at most `max_values` values in total (but at
+            least one batch, if spool is not empty), as a list of (id, backend_url, bot_token,
+            account_id, values) tuples.
+        """
+        with get_db_cursor() as c:
+            c.execute(f'SELECT id, backend_url, bot_token, account_id, payload FROM ('
+                      f'  SELECT *, SUM(n_values) OVER (ORDER BY id) AS older_values FROM {DB_PREFIX}values_spool WHERE shard = %s'
+                      f') x WHERE older_values - n_values < %s ORDER BY id;', (self.shard, max_values,))
+            return list(c.fetchall())
+
+    def remove(self, ids):
+        with get_db_cursor() as c:
+            c.execute(f'DELETE FROM {DB_PREFIX}values_spool WHERE id = ANY(%s);', (list(ids),))
+
+    def is_empty(self):
+        with get_db_cursor() as c:
+            c.execute(f'SELECT 1 FROM {DB_PREFIX}values_spool WHERE shard = %s LIMIT 1;', (self.shard,))
+            return c.fetchone() is None